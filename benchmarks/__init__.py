@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+benchmarks
+==========
+
+Benchmarks for FM Player, these are not installed with the package.
+"""
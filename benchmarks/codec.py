@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+benchmarks.codec
+================
+
+Compares encode and decode throughput and payload size of the event codecs
+on typical channel events and queue entries::
+
+    python -m benchmarks.codec -n 100000
+"""
+
+# Standard Libs
+import json
+import time
+
+# Third Party Libs
+import click
+
+# First Party Libs
+from fmplayer.codec import CODECS, decode_entry, decode_event, get_codec
+
+
+MESSAGES = {
+    'set_volume': {'event': 'set_volume', 'volume': 60},
+    'play': {
+        'event': 'play',
+        'uri': 'spotify:track:3Esqxo3D31RCjmdgwBPbOO',
+        'user': '5a0a3c3e-0e3a-4d7e-a8f1-1c2bb2a0c6a1',
+    },
+    'entry': {
+        'uri': 'spotify:track:3Esqxo3D31RCjmdgwBPbOO',
+        'user': '5a0a3c3e-0e3a-4d7e-a8f1-1c2bb2a0c6a1',
+    },
+}
+
+
+def rate(function, argument, iterations):
+    """ Returns calls per second of the function.
+    """
+
+    start = time.time()
+    for i in range(iterations):
+        function(argument)
+    return iterations / (time.time() - start)
+
+
+@click.option('--iterations', '-n', type=int, default=100000)
+@click.option('--output', '-o', help='Write JSON results to this file')
+@click.command()
+def run(iterations, output):
+    """ Prints encode, raw decode and validated decode rates and payload
+    sizes for each codec and message.
+    """
+
+    results = {}
+    for name in sorted(CODECS):
+        try:
+            codec = get_codec(name)
+        except RuntimeError as e:
+            click.echo('Skipping {0}: {1}'.format(name, e))
+            continue
+
+        for message, data in sorted(MESSAGES.items()):
+            raw = codec.encode(data)
+            validate = decode_entry if message == 'entry' else decode_event
+            result = {
+                'bytes': len(raw),
+                'encode_per_second': rate(codec.encode, data, iterations),
+                'decode_per_second': rate(codec.decode, raw, iterations),
+                'validated_decode_per_second': rate(validate, raw, iterations),
+            }
+            results['{0}.{1}'.format(name, message)] = result
+            click.echo(
+                '{0:<8} {1:<11} {2:4d}B  encode {3:9.0f}/s  decode {4:9.0f}/s  '
+                'validated {5:9.0f}/s'.format(
+                    name,
+                    message,
+                    result['bytes'],
+                    result['encode_per_second'],
+                    result['decode_per_second'],
+                    result['validated_decode_per_second']))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    run()
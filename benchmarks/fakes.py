@@ -0,0 +1,918 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+benchmarks.fakes
+================
+
+Offline stand-ins for libspotify, ALSA and Redis so the player can be
+benchmarked on a plain Linux box. ``install`` must be called after gevent
+monkey patching and before anything from ``fmplayer`` is imported, it puts
+fake ``spotify`` and ``alsaaudio`` modules into ``sys.modules``.
+
+The fake session resolves tracks after a configurable delay and delivers
+synthetic 16 bit stereo frames to the registered sink, at real time or at
+a multiple of it, firing ``END_OF_TRACK`` once the track has been played.
+"""
+
+# Standard Libs
+import math
+import struct
+import sys
+import time
+import types
+
+# Third Party Libs
+import gevent
+import gevent.event
+import gevent.queue
+from gevent.monkey import get_original
+from redis.exceptions import ConnectionError, ResponseError
+
+
+# Fake devices run in real threads
+sleep = get_original('time', 'sleep')
+
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+
+# Seconds of audio per music delivery
+DELIVERY_PERIOD = 0.02
+
+
+def sine(frequency=440, seconds=DELIVERY_PERIOD, amplitude=8000):
+    """ Returns a block of 16 bit stereo frames of a sine wave.
+    """
+
+    samples = []
+    for i in range(int(SAMPLE_RATE * seconds)):
+        sample = int(amplitude * math.sin(2 * math.pi * frequency * i / SAMPLE_RATE))
+        samples.extend([sample] * CHANNELS)
+    return struct.pack('<{0}h'.format(len(samples)), *samples)
+
+
+# Spotify
+
+class Error(Exception):
+    pass
+
+
+class LibError(Error):
+
+    def __init__(self, error_type, message=None):
+        self.error_type = error_type
+        super(LibError, self).__init__(
+            message or 'libspotify error {0}'.format(error_type))
+
+
+class Timeout(Error):
+    pass
+
+
+class TrackAvailability(object):
+    UNAVAILABLE = 0
+    AVAILABLE = 1
+
+
+class ErrorType(object):
+    OK = 0
+    TRACK_NOT_PLAYABLE = 3
+    BAD_USERNAME_OR_PASSWORD = 6
+    OTHER_PERMANENT = 10
+    OTHER_TRANSIENT = 16
+    NO_CREDENTIALS = 23
+
+
+class SessionEvent(object):
+    CONNECTION_STATE_UPDATED = 'connection_state_updated'
+    CONNECTION_ERROR = 'connection_error'
+    CREDENTIALS_BLOB_UPDATED = 'credentials_blob_updated'
+    END_OF_TRACK = 'end_of_track'
+    LOGGED_IN = 'logged_in'
+    MUSIC_DELIVERY = 'music_delivery'
+    STREAMING_ERROR = 'streaming_error'
+
+
+class ConnectionState(object):
+    LOGGED_OUT = 0
+    LOGGED_IN = 1
+    DISCONNECTED = 2
+    UNDEFINED = 3
+    OFFLINE = 4
+
+
+class PlayerState(object):
+    UNLOADED = 'unloaded'
+    LOADED = 'loaded'
+    PLAYING = 'playing'
+    PAUSED = 'paused'
+
+
+class Bitrate(int):
+    BITRATE_160k = 0
+    BITRATE_320k = 1
+    BITRATE_96k = 2
+
+
+class SampleType(object):
+    INT16_NATIVE_ENDIAN = 0
+
+
+class AudioFormat(object):
+
+    sample_type = SampleType.INT16_NATIVE_ENDIAN
+    sample_rate = SAMPLE_RATE
+    channels = CHANNELS
+
+    def frame_size(self):
+        return 2 * self.channels
+
+
+class Config(object):
+
+    def load_application_key_file(self, filename=b'spotify_appkey.key'):
+        pass
+
+
+class EventLoop(object):
+
+    def __init__(self, session):
+        self.session = session
+
+    def start(self):
+        pass
+
+
+class Sink(object):
+
+    def on(self):
+        self._session.on(SessionEvent.MUSIC_DELIVERY, self._on_music_delivery)
+
+    def off(self):
+        self._session.off(SessionEvent.MUSIC_DELIVERY, self._on_music_delivery)
+
+
+class AlsaSink(Sink):
+    """ Opens the PCM on the first delivery, as the pyspotify sink does.
+    """
+
+    def __init__(self, session, card='default'):
+        self._session = session
+        self._card = card
+        self._device = None
+        self.on()
+
+    def _on_music_delivery(self, session, audio_format, frames, num_frames):
+        if self._device is None:
+            self._device = PCM(card=self._card)
+        return num_frames
+
+
+class Track(object):
+
+    def __init__(self, session, uri):
+        self.session = session
+        self.uri = uri
+        self.link = uri
+        self.name = uri.split(':')[-1]
+        self.duration = session.duration
+        self.availability = TrackAvailability.AVAILABLE
+        self.is_loaded = False
+
+    def load(self, timeout=None):
+        if not self.is_loaded:
+            gevent.sleep(self.session.load_delay)
+            if self.uri in self.session.unplayable:
+                raise LibError(ErrorType.TRACK_NOT_PLAYABLE)
+            if self.uri in self.session.failing:
+                raise LibError(ErrorType.OTHER_TRANSIENT)
+            self.is_loaded = True
+        return self
+
+
+class Connection(object):
+
+    state = ConnectionState.LOGGED_OUT
+
+
+class Player(object):
+    """ Delivers frames from a greenlet, the real player delivers from the
+    libspotify thread.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.state = PlayerState.UNLOADED
+        self.track = None
+        self.position = 0  # Frames
+        self.generation = 0
+        self.format = AudioFormat()
+        self.frames = sine()
+        self.num_frames = len(self.frames) // self.format.frame_size()
+
+    def load(self, track):
+        self.unload()
+        self.track = track
+        self.state = PlayerState.LOADED
+
+    def unload(self):
+        self.generation += 1
+        self.track = None
+        self.position = 0
+        self.state = PlayerState.UNLOADED
+
+    def prefetch(self, track):
+        pass
+
+    def seek(self, offset):
+        self.position = int(offset * SAMPLE_RATE / 1000)
+
+    def play(self, play=True):
+        if not play:
+            self.pause()
+        elif self.state in (PlayerState.LOADED, PlayerState.PAUSED):
+            if self.state == PlayerState.LOADED:
+                gevent.spawn(self.deliver, self.generation)
+            self.state = PlayerState.PLAYING
+
+    def pause(self):
+        if self.state == PlayerState.PLAYING:
+            self.state = PlayerState.PAUSED
+
+    def deliver(self, generation):
+        total = int(self.track.duration * SAMPLE_RATE / 1000)
+        stall = self.session.stalls.get(self.track.uri)
+        stall = total if stall is None else int(stall * SAMPLE_RATE / 1000)
+        speed = self.session.speed
+        while self.generation == generation and self.position < total:
+            if self.state == PlayerState.PLAYING and self.position < stall:
+                consumed = self.session.emit(
+                    SessionEvent.MUSIC_DELIVERY,
+                    self.format,
+                    self.frames,
+                    self.num_frames)
+                self.position += consumed or 0
+            gevent.sleep(DELIVERY_PERIOD / speed if speed else 0)
+        if self.generation == generation:
+            self.session.emit(SessionEvent.END_OF_TRACK)
+
+
+class Session(object):
+    """ Fake ``spotify.Session``, the class level defaults are copied onto
+    each session so they can be set before the player creates it.
+    """
+
+    # Seconds to resolve a track
+    load_delay = 0.05
+
+    # Multiple of real time frames are delivered at, 0 for as fast as
+    # possible
+    speed = 1.0
+
+    # Track duration in milliseconds
+    duration = 180000
+
+    # URIs which fail to load, for good or until removed
+    unplayable = set()
+    failing = set()
+
+    # URIs which stop delivering audio at the given position in ms
+    stalls = {}
+
+    def __init__(self, config=None):
+        self.config = config
+        self.listeners = {}
+        self.connection = Connection()
+        self.player = Player(self)
+        self.bitrate = None
+        self.remembered = False
+
+    def on(self, event, listener, *user_args):
+        self.listeners.setdefault(event, []).append(listener)
+
+    def off(self, event=None, listener=None):
+        if listener in self.listeners.get(event, []):
+            self.listeners[event].remove(listener)
+
+    def emit(self, event, *args):
+        result = None
+        for listener in list(self.listeners.get(event, [])):
+            result = listener(self, *args)
+        return result
+
+    def login(self, username, password=None, remember_me=False, blob=None):
+        self.remembered = remember_me
+        gevent.spawn(self.logged_in)
+
+    def relogin(self):
+        # libspotify can only log back in with remembered credentials
+        if not self.remembered:
+            raise LibError(ErrorType.NO_CREDENTIALS)
+        gevent.spawn(self.logged_in)
+
+    def logged_in(self):
+        self.emit(SessionEvent.LOGGED_IN, ErrorType.OK)
+        self.emit(SessionEvent.CREDENTIALS_BLOB_UPDATED, 'blob')
+        self.connection.state = ConnectionState.LOGGED_IN
+        self.emit(SessionEvent.CONNECTION_STATE_UPDATED)
+
+    def preferred_bitrate(self, bitrate):
+        self.bitrate = bitrate
+
+    def set_cache_size(self, size):
+        pass
+
+    def get_track(self, uri):
+        if not uri.startswith('spotify:track:'):
+            raise ValueError('Not a track URI: {0}'.format(uri))
+        return Track(self, uri)
+
+
+# ALSA
+
+class ALSAAudioError(Exception):
+    pass
+
+
+class Mixer(object):
+
+    def __init__(self, control='Master', id=0, cardindex=-1, device='default'):
+        self.volume = 100
+        self.mute = 0
+
+    def getvolume(self):
+        return [self.volume, self.volume]
+
+    def setvolume(self, volume, channel=None):
+        self.volume = volume
+
+    def getmute(self):
+        return [self.mute, self.mute]
+
+    def setmute(self, mute, channel=None):
+        self.mute = mute
+
+    def polldescriptors(self):
+        return []
+
+    def handleevents(self):
+        return 0
+
+
+try:
+    PCM_DATA = (bytes, buffer)
+except NameError:
+    PCM_DATA = (bytes, )
+PCM_CARD = (bytes, type(u''))
+
+
+class PCM(object):
+    """ Accepts frames at the real time rate of the fake session.
+    """
+
+    def __init__(self, type=0, mode=0, card='default'):
+        # pyalsaaudio parses the card as a string
+        if not isinstance(card, PCM_CARD):
+            raise TypeError('card must be a string')
+        self.rate = SAMPLE_RATE
+        self.channels = CHANNELS
+
+    def setchannels(self, channels):
+        self.channels = channels
+
+    def setrate(self, rate):
+        self.rate = rate
+
+    def setformat(self, format):
+        pass
+
+    def setperiodsize(self, period):
+        pass
+
+    def write(self, data):
+        # pyalsaaudio parses the data with "s#", which only accepts strings
+        # and buffers on Python 2 and bytes on Python 3
+        if not isinstance(data, PCM_DATA):
+            raise TypeError(
+                'write() argument must be string or read-only buffer, '
+                'not {0}'.format(type(data).__name__))
+        frames = len(data) // (2 * self.channels)
+        speed = Session.speed
+        if speed:
+            sleep(float(frames) / self.rate / speed)
+        return frames
+
+
+# Redis
+
+class FakePipeline(object):
+    """ Queues commands and applies them in one simulated round trip.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        self.redis.round_trip()
+        results = []
+        for name, args, kwargs in self.commands:
+            results.append(getattr(self.redis.store, name)(*args, **kwargs))
+        self.commands = []
+        return results
+
+
+class FakePubSub(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.channels = set()
+        self.messages = gevent.queue.Queue()
+
+    def subscribe(self, *channels):
+        for channel in channels:
+            self.channels.add(channel)
+            self.redis.store.subscribers.setdefault(channel, []).append(self)
+            self.messages.put({
+                'type': 'subscribe',
+                'pattern': None,
+                'channel': channel,
+                'data': len(self.channels)})
+
+    def unsubscribe(self, *channels):
+        for channel in channels or list(self.channels):
+            self.channels.discard(channel)
+            self.redis.store.subscribers.get(channel, []).remove(self)
+
+    def close(self):
+        self.unsubscribe()
+
+    def listen(self):
+        while True:
+            yield self.messages.get()
+
+
+class Stream(object):
+    """ Entries and consumer groups of a stream, ids are ``(ms, seq)``
+    tuples and formatted as ``ms-seq`` strings on the way out.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.groups = {}
+        self.last = (0, 0)
+
+    @staticmethod
+    def parse(id):
+        if id in ('$', '>'):
+            return id
+        ms, _, seq = str(id).partition('-')
+        return (int(ms), int(seq or 0))
+
+    @staticmethod
+    def format(id):
+        return '{0}-{1}'.format(*id)
+
+    def add(self, fields, length=None):
+        now = int(time.time() * 1000)
+        self.last = (now, 0) if now > self.last[0] else (self.last[0], self.last[1] + 1)
+        self.entries.append((self.last, list(fields)))
+        if length is not None and len(self.entries) > length:
+            del self.entries[:len(self.entries) - length]
+        return self.format(self.last)
+
+    def fields(self, id):
+        for entry, fields in self.entries:
+            if entry == id:
+                return fields
+        return None
+
+
+class Store(object):
+    """ The data and commands behind ``FakeRedis``, commands here take no
+    simulated round trip so they can also be applied by pipelines.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.subscribers = {}
+        self.pushed = gevent.event.Event()
+
+    def _get(self, name, default=None):
+        expires = self.expires.get(name)
+        if expires is not None and expires <= time.time():
+            self.data.pop(name, None)
+            self.expires.pop(name, None)
+        return self.data.get(name, default)
+
+    def _list(self, name):
+        return self.data.setdefault(name, []) if self._get(name) is None else self.data[name]
+
+    def _hash(self, name):
+        return self.data.setdefault(name, {}) if self._get(name) is None else self.data[name]
+
+    def _notify(self):
+        pushed, self.pushed = self.pushed, gevent.event.Event()
+        pushed.set()
+
+    @staticmethod
+    def _range(items, start, end):
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    @staticmethod
+    def _encode(value):
+        return value if isinstance(value, (bytes, type(u''))) else str(value)
+
+    # Keys
+
+    def get(self, name):
+        return self._get(name)
+
+    def mget(self, *names):
+        return [self._get(name) for name in names]
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        exists = self._get(name) is not None
+        if (nx and exists) or (xx and not exists):
+            return None
+        self.data[name] = self._encode(value)
+        self.expires.pop(name, None)
+        if ex is not None:
+            self.expires[name] = time.time() + ex
+        if px is not None:
+            self.expires[name] = time.time() + px / 1000.0
+        return True
+
+    def delete(self, *names):
+        removed = 0
+        for name in names:
+            if self._get(name) is not None:
+                removed += 1
+            self.data.pop(name, None)
+            self.expires.pop(name, None)
+        return removed
+
+    def incr(self, name, amount=1):
+        value = int(self._get(name) or 0) + amount
+        self.data[name] = str(value)
+        return value
+
+    def expire(self, name, time):
+        return self.pexpire(name, time * 1000)
+
+    def pexpire(self, name, time_ms):
+        if self._get(name) is None:
+            return False
+        self.expires[name] = time.time() + time_ms / 1000.0
+        return True
+
+    def publish(self, channel, message):
+        subscribers = self.subscribers.get(channel, [])
+        for pubsub in subscribers:
+            pubsub.messages.put({
+                'type': 'message',
+                'pattern': None,
+                'channel': channel,
+                'data': message})
+        return len(subscribers)
+
+    # Lists
+
+    def llen(self, name):
+        return len(self._get(name) or [])
+
+    def lpush(self, name, *values):
+        items = self._list(name)
+        for value in values:
+            items.insert(0, self._encode(value))
+        self._notify()
+        return len(items)
+
+    def rpush(self, name, *values):
+        items = self._list(name)
+        items.extend(self._encode(value) for value in values)
+        self._notify()
+        return len(items)
+
+    def lpop(self, name):
+        items = self._get(name)
+        return items.pop(0) if items else None
+
+    def lindex(self, name, index):
+        items = self._get(name) or []
+        return items[index] if -len(items) <= index < len(items) else None
+
+    def lrange(self, name, start, end):
+        return self._range(self._get(name) or [], start, end)
+
+    def ltrim(self, name, start, end):
+        if name in self.data:
+            self.data[name][:] = self._range(self.data[name], start, end)
+        return True
+
+    def lrem(self, name, count, value):
+        items = self._get(name) or []
+        removed = 0
+        while value in items and (count == 0 or removed < abs(count)):
+            items.remove(value)
+            removed += 1
+        return removed
+
+    def lmove(self, source, destination, src='LEFT', dest='RIGHT'):
+        items = self._get(source)
+        if not items:
+            return None
+        value = items.pop(0 if src == 'LEFT' else -1)
+        target = self._list(destination)
+        if dest == 'LEFT':
+            target.insert(0, value)
+        else:
+            target.append(value)
+        return value
+
+    # Streams
+
+    def _stream(self, name):
+        return self.data.setdefault(name, Stream())
+
+    def execute_command(self, *args):
+        name = args[0].upper()
+        command = getattr(self, '_{0}'.format(name.lower()), None)
+        if command is None:
+            raise NotImplementedError(
+                '{0} is not supported by FakeRedis'.format(name))
+        return command(*args[1:])
+
+    def _lmove(self, *args):
+        return self.lmove(*args)
+
+    def _xadd(self, name, *args):
+        args = list(args)
+        length = None
+        if args[0].upper() == 'MAXLEN':
+            args.pop(0)
+            if args[0] in ('~', '='):
+                args.pop(0)
+            length = int(args.pop(0))
+        args.pop(0)  # Auto id
+        id = self._stream(name).add(args, length)
+        self._notify()
+        return id
+
+    def _xgroup(self, subcommand, name, group, id, *options):
+        if name not in self.data and 'MKSTREAM' not in options:
+            raise ResponseError('ERR no such key')
+        stream = self._stream(name)
+        if group in stream.groups:
+            raise ResponseError('BUSYGROUP Consumer Group name already exists')
+        start = stream.last if id == '$' else Stream.parse(id)
+        stream.groups[group] = {'last': start, 'pending': {}}
+        return True
+
+    def _xreadgroup(self, *args):
+        args = list(args)
+        group, consumer = args[1], args[2]
+        options = dict(zip(args[3:args.index('STREAMS')][::2],
+                           args[3:args.index('STREAMS')][1::2]))
+        name, id = args[-2], args[-1]
+        count = int(options.get('COUNT', 0)) or None
+        stream = self._stream(name)
+        state = stream.groups[group]
+
+        if id == '>':
+            found = [(entry, fields) for entry, fields in stream.entries
+                     if entry > state['last']][:count]
+            for entry, fields in found:
+                state['pending'][entry] = consumer
+            if found:
+                state['last'] = found[-1][0]
+        else:
+            after = Stream.parse(id)
+            ids = sorted(entry for entry, owner in state['pending'].items()
+                         if owner == consumer and entry > after)[:count]
+            found = [(entry, stream.fields(entry)) for entry in ids]
+
+        if not found and id == '>':
+            return None
+        return [[name, [[Stream.format(entry), fields] for entry, fields in found]]]
+
+    def _xack(self, name, group, *ids):
+        pending = self._stream(name).groups[group]['pending']
+        return len([pending.pop(Stream.parse(id))
+                    for id in ids if Stream.parse(id) in pending])
+
+    def _xlen(self, name):
+        stream = self._get(name)
+        return len(stream.entries) if stream else 0
+
+    def _xrevrange(self, name, end, start, *options):
+        count = int(options[1]) if options else None
+        stream = self._get(name)
+        found = list(reversed(stream.entries if stream else []))[:count]
+        return [[Stream.format(entry), fields] for entry, fields in found]
+
+    def _xautoclaim(self, name, group, consumer, idle, start, *options):
+        pending = self._stream(name).groups[group]['pending']
+        ids = sorted(entry for entry in pending if entry >= Stream.parse(start))
+        for entry in ids:
+            pending[entry] = consumer
+        return ['0-0', [Stream.format(entry) for entry in ids]]
+
+    # Hashes
+
+    def hget(self, name, key):
+        return (self._get(name) or {}).get(key)
+
+    def hgetall(self, name):
+        return dict(self._get(name) or {})
+
+    def hset(self, name, key, value):
+        values = self._hash(name)
+        new = key not in values
+        values[key] = self._encode(value)
+        return int(new)
+
+    def hmset(self, name, mapping):
+        values = self._hash(name)
+        for key, value in mapping.items():
+            values[key] = self._encode(value)
+        return True
+
+    def hdel(self, name, *keys):
+        values = self._get(name) or {}
+        return len([values.pop(key) for key in keys if key in values])
+
+    def hincrby(self, name, key, amount=1):
+        values = self._hash(name)
+        value = int(values.get(key, 0)) + amount
+        values[key] = str(value)
+        return value
+
+    # Sorted sets
+
+    def _zset(self, name):
+        return self.data.setdefault(name, {}) if self._get(name) is None else self.data[name]
+
+    def zincrby(self, name, value, amount=1):
+        members = self._zset(name)
+        members[value] = members.get(value, 0) + amount
+        return members[value]
+
+    def zunionstore(self, dest, keys):
+        members = {}
+        for key in keys:
+            for member, score in (self._get(key) or {}).items():
+                members[member] = members.get(member, 0) + score
+        self.delete(dest)
+        if members:
+            self.data[dest] = members
+        return len(members)
+
+    def zrevrange(self, name, start, end, withscores=False):
+        members = sorted((self._get(name) or {}).items(),
+                         key=lambda item: (-item[1], item[0]))
+        members = self._range(members, start, end)
+        return [tuple(item) if withscores else item[0] for item in members]
+
+
+class FakeConnection(object):
+    """ A pooled connection, the command sent is run when its reply is
+    parsed. A disconnected connection drops the command so a blocked
+    command stops waiting, as it would on a real server.
+    """
+
+    def __init__(self):
+        self.command = None
+        self.connected = True
+
+    def send_command(self, *args):
+        self.connected = True
+        self.command = args
+
+    def disconnect(self):
+        self.connected = False
+        self.command = None
+
+
+class FakeConnectionPool(object):
+
+    def __init__(self):
+        self.disconnects = 0
+
+    def get_connection(self, command_name, *keys, **options):
+        return FakeConnection()
+
+    def release(self, connection):
+        if not connection.connected:
+            self.disconnects += 1
+
+
+class FakeRedis(object):
+    """ In-process stand-in for ``redis.StrictRedis`` supporting the commands
+    the player uses. Every call, or pipeline execution, sleeps for the
+    configured ``latency`` to simulate a network round trip, and raises a
+    ``ConnectionError`` whilst ``down`` is set.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.down = False
+        self.store = Store()
+        self.connection_pool = FakeConnectionPool()
+
+    def round_trip(self):
+        gevent.sleep(self.latency)
+        if self.down:
+            raise ConnectionError('Error connecting to FakeRedis')
+
+    def __getattr__(self, name):
+        command = getattr(self.store, name)
+
+        def call(*args, **kwargs):
+            self.round_trip()
+            return command(*args, **kwargs)
+        return call
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def parse_response(self, connection, command_name, **options):
+        command, connection.command = connection.command, None
+        return self.execute_command(*command)
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+    def execute_command(self, *args):
+        name = args[0].upper()
+        if name == 'BLMOVE':
+            return self.blmove(*args[1:])
+        if name == 'XREADGROUP' and 'BLOCK' in args:
+            return self.xreadgroup(*args)
+        self.round_trip()
+        return self.store.execute_command(*args)
+
+    def xreadgroup(self, *args):
+        self.round_trip()
+        block = args[list(args).index('BLOCK') + 1]
+        deadline = time.time() + float(block) / 1000 if block else None
+        while True:
+            pushed = self.store.pushed
+            reply = self.store.execute_command(*args)
+            if reply is not None:
+                return reply
+            remaining = deadline - time.time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                return None
+            pushed.wait(remaining)
+
+    def blmove(self, source, destination, src, dest, timeout):
+        self.round_trip()
+        deadline = time.time() + float(timeout) if timeout else None
+        while True:
+            pushed = self.store.pushed
+            value = self.store.lmove(source, destination, src, dest)
+            if value is not None:
+                return value
+            remaining = deadline - time.time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                return None
+            pushed.wait(remaining)
+
+
+def install():
+    """ Installs the fake ``spotify`` and ``alsaaudio`` modules.
+    """
+
+    spotify = types.ModuleType('spotify')
+    spotify.sink = types.ModuleType('spotify.sink')
+    spotify.audio = types.ModuleType('spotify.audio')
+    spotify.sink.Sink = Sink
+    spotify.audio.Bitrate = Bitrate
+    spotify.audio.AudioFormat = AudioFormat
+    for value in [
+            Error, LibError, Timeout, TrackAvailability, ErrorType, SessionEvent,
+            ConnectionState, PlayerState, Bitrate, AudioFormat, Config,
+            EventLoop, AlsaSink, Session]:
+        setattr(spotify, value.__name__, value)
+
+    alsaaudio = types.ModuleType('alsaaudio')
+    alsaaudio.Mixer = Mixer
+    alsaaudio.ALSAAudioError = ALSAAudioError
+    alsaaudio.PCM = PCM
+    alsaaudio.PCM_PLAYBACK = 0
+    alsaaudio.PCM_NORMAL = 0
+    alsaaudio.PCM_FORMAT_S16_LE = 2
+
+    sys.modules['spotify'] = spotify
+    sys.modules['spotify.sink'] = spotify.sink
+    sys.modules['spotify.audio'] = spotify.audio
+    sys.modules['alsaaudio'] = alsaaudio
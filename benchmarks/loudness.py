@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+benchmarks.loudness
+===================
+
+Measures the CPU cost of the loudness analysis per second of audio, feeding
+synthetic 16 bit stereo audio through the analyser in deliveries of
+different sizes::
+
+    python -m benchmarks.loudness --seconds 600
+"""
+
+# Standard Libs
+import json
+import time
+
+# Third Party Libs
+import click
+import numpy
+
+# First Party Libs
+from fmplayer.loudness import LoudnessAnalyser
+
+
+RATE = 44100
+CHANNELS = 2
+
+# Frames per delivery, libspotify usually delivers 2048 or fewer
+DELIVERIES = [256, 1024, 2048, 8192]
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+
+class AudioFormat(object):
+
+    sample_rate = RATE
+    channels = CHANNELS
+
+
+class Sink(object):
+
+    def __init__(self):
+        self.observers = []
+
+
+class Player(object):
+
+    def __init__(self):
+        self.sink = Sink()
+
+
+def audio(seconds):
+    """ Returns interleaved 16 bit stereo frames of a 440Hz tone with noise,
+    rising in level over the duration.
+    """
+
+    t = numpy.arange(int(seconds * RATE)) / float(RATE)
+    level = 0.05 + 0.45 * t / t[-1]
+    tone = level * numpy.sin(2 * numpy.pi * 440 * t)
+    tone += numpy.random.normal(0, 0.01, tone.size)
+    samples = numpy.repeat(tone * 32767, CHANNELS).clip(-32768, 32767)
+    return samples.astype('<i2').tobytes()
+
+
+@click.option(
+    '--seconds',
+    '-s',
+    help='Seconds of audio analysed per delivery size',
+    type=int,
+    default=600)
+@click.option('--output', '-o', help='Write JSON results to this file')
+@click.command()
+def run(seconds, output):
+    """ Prints the CPU seconds spent per second of audio for each delivery
+    size.
+    """
+
+    frames = audio(seconds)
+    frame_size = 2 * CHANNELS
+    results = {}
+    for delivery in DELIVERIES:
+        analyser = LoudnessAnalyser(Player())
+        analyser.start('spotify:track:benchmark')
+        step = delivery * frame_size
+
+        start = cpu_time()
+        for offset in range(0, len(frames), step):
+            chunk = frames[offset:offset + step]
+            analyser.on_music_delivery(
+                AudioFormat,
+                chunk,
+                len(chunk) // frame_size)
+        gain = analyser.finish('spotify:track:benchmark')
+        cpu = cpu_time() - start
+
+        result = {
+            'cpu_seconds': cpu,
+            'cpu_per_audio_second': cpu / seconds,
+            'cpu_percent': 100 * cpu / seconds,
+            'gain': gain,
+        }
+        results[delivery] = result
+        click.echo(
+            '{0:5d} frames/delivery  {1:8.1f}us CPU per second of audio  '
+            '{2:.4f}% of a core  gain {3:+.1f}dB'.format(
+                delivery,
+                result['cpu_per_audio_second'] * 1e6,
+                result['cpu_percent'],
+                gain))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+benchmarks.replay
+=================
+
+Records the traffic a live player receives, the events sent on its channel
+or event stream and the entries pushed onto its playlist queue, and replays
+it against the real player, event handler and watchers running with the
+``FakeSink`` and the fakes from ``benchmarks.fakes``, at real time, a
+multiple of it or as fast as possible. The replay reports the latency from
+each event being sent to its handler finishing and how the backlogs of
+unhandled events and queued tracks grow, showing the rate at which the
+player falls behind.
+
+Recording follows the Redis ``MONITOR`` feed, which has a cost on a busy
+server, and writes one JSON line per message, gzipped if the file name ends
+in ``.gz``. Recordings are read a line at a time so captures spanning days
+can be replayed::
+
+    python -m benchmarks.replay record -r redis://live:6379/ -c fm:player \\
+        -o capture.jsonl.gz
+    python -m benchmarks.replay replay capture.jsonl.gz --speed 10
+"""
+
+# Standard Libs
+import collections
+import gzip
+import json
+import re
+import time
+import urlparse
+
+# Third Party Libs
+import click
+import gevent
+from redis import StrictRedis
+
+# First Party Libs
+from benchmarks import fakes
+from benchmarks.run import CHANNEL, Environment, summarise
+from fmplayer import metrics
+from fmplayer.codec import EVENTS, InvalidMessage, decode_entry, detect
+from fmplayer.events import PLAYLIST_KEY, handlers
+from fmplayer.streams import EVENTS_STREAM, append
+
+
+# A MONITOR line, its time, database and the quoted command arguments
+MONITOR_LINE = re.compile(br'^(\d+\.\d+) \[(\d+) [^\]]*\] (.*)$')
+MONITOR_ARGUMENT = re.compile(br'"((?:[^"\\]|\\.)*)"')
+MONITOR_ESCAPE = re.compile(br'\\(x[0-9a-fA-F]{2}|.)')
+ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'a': b'\a', b'b': b'\b'}
+
+# Seconds between samples of the backlogs during a replay
+SAMPLE_INTERVAL = 1
+
+
+def unescape(argument):
+    """ Returns the bytes of a ``MONITOR`` argument, undoing the escaping of
+    quotes, backslashes and unprintable bytes.
+    """
+
+    def replace(match):
+        escape = match.group(1)
+        if len(escape) == 3:
+            return bytes(bytearray([int(escape[1:], 16)]))
+        return ESCAPES.get(escape, escape)
+
+    return MONITOR_ESCAPE.sub(replace, argument)
+
+
+def monitor(redis):
+    """ Yields ``(time, db, arguments)`` of each command the server runs, as
+    reported by ``MONITOR``.
+    """
+
+    connection = redis.connection_pool.get_connection('MONITOR')
+    try:
+        connection.send_command('MONITOR')
+        connection.read_response()
+        while True:
+            line = connection.read_response()
+            if not isinstance(line, bytes):
+                line = line.encode('utf-8')
+            match = MONITOR_LINE.match(line)
+            if match is None:
+                continue
+            at, db, arguments = match.groups()
+            yield (
+                float(at),
+                int(db),
+                [unescape(a) for a in MONITOR_ARGUMENT.findall(arguments)])
+    finally:
+        connection.disconnect()
+        redis.connection_pool.release(connection)
+
+
+def messages(command, channel, queue, stream):
+    """ Returns the recordable messages of a command as ``(type, data)``
+    tuples, events the player handles published on the channel or added to
+    the stream, and entries pushed onto the queue with the push command.
+    """
+
+    name = command[0].lower() if command else b''
+    arguments = [a.decode('utf-8', 'replace') for a in command[1:3]]
+    found = []
+    if name == b'publish' and arguments[:1] == [channel]:
+        found.append(('event', command[2]))
+    elif name == b'xadd' and arguments[:1] == [stream]:
+        fields = command[command.index(b'*') + 1:] if b'*' in command else []
+        fields = dict(zip(fields[::2], fields[1::2]))
+        if b'data' in fields:
+            found.append(('event', fields[b'data']))
+    elif name in (b'rpush', b'lpush') and arguments[:1] == [queue]:
+        found.extend(('queue', raw) for raw in command[2:])
+
+    recordable = []
+    for kind, raw in found:
+        try:
+            if kind == 'queue':
+                data = decode_entry(raw)
+                data['push'] = name.decode('utf-8')
+            else:
+                data = detect(raw).decode(raw)
+                if not isinstance(data, dict) or data.get('event') not in EVENTS:
+                    continue
+        except (InvalidMessage, ValueError):
+            continue
+        recordable.append((kind, data))
+    return recordable
+
+
+def open_capture(path, mode):
+    """ Opens a capture file, gzipped if the name ends in ``.gz``.
+    """
+
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    return open(path, mode)
+
+
+def read_capture(path):
+    """ Yields the recorded ``(time, type, data)`` messages a line at a time.
+    """
+
+    with open_capture(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                message = json.loads(line)
+                yield message['time'], message['type'], message['data']
+
+
+@click.option(
+    '--redis-uri',
+    '-r',
+    default='redis://localhost:6379/')
+@click.option('--redis-db', '-d', type=int, default=0)
+@click.option(
+    '--redis-channel',
+    '-c',
+    help='Channel the player listens on for events',
+    required=True)
+@click.option(
+    '--queue-key',
+    help='The playlist queue key',
+    default=PLAYLIST_KEY)
+@click.option(
+    '--event-stream',
+    help='Stream the player reads events from with the stream transport',
+    default=EVENTS_STREAM)
+@click.option(
+    '--seconds',
+    '-s',
+    help='Seconds to record for, default until interrupted',
+    type=float)
+@click.option('--output', '-o', help='Capture file to write', required=True)
+@click.command()
+def record(redis_uri, redis_db, redis_channel, queue_key, event_stream,
+           seconds, output):
+    """ Records events and queue pushes from a live deployment.
+    """
+
+    uri = urlparse.urlparse(redis_uri)
+    redis = StrictRedis(
+        host=uri.hostname,
+        port=uri.port,
+        password=uri.password,
+        db=redis_db)
+
+    recorded = 0
+    deadline = time.time() + seconds if seconds else None
+    with open_capture(output, 'w') as f:
+        try:
+            for at, db, command in monitor(redis):
+                if deadline is not None and at >= deadline:
+                    break
+                if db != redis_db:
+                    continue
+                for kind, data in messages(
+                        command, redis_channel, queue_key, event_stream):
+                    line = json.dumps({'time': at, 'type': kind, 'data': data})
+                    f.write((line + '\n').encode('utf-8')
+                            if output.endswith('.gz') else line + '\n')
+                    recorded += 1
+        except KeyboardInterrupt:
+            pass
+
+    click.echo('Recorded {0} messages to {1}'.format(recorded, output))
+
+
+class Replay(object):
+    """ Sends recorded messages to a player environment on the recorded
+    schedule, scaled by the speed, timing each event from being sent to its
+    handler finishing and sampling the backlogs.
+    """
+
+    def __init__(self, env, speed):
+        self.env = env
+        self.speed = speed
+
+        # Send times by sequence number of events waiting to be handled,
+        # latencies in seconds of those handled and the backlog samples
+        self.sent = collections.OrderedDict()
+        self.count = 0
+        self.latencies = []
+        self.samples = []
+
+        # Events superseded by a later event before being handled
+        self.superseded = 0
+
+        # Seconds the sender fell behind the recorded schedule
+        self.lag = []
+
+        for handler in handlers(env.handler).values():
+            name = handler.__name__
+            setattr(env.handler, name, self.timed(handler))
+
+    def timed(self, handler):
+        def timed(data):
+            try:
+                return handler(data)
+            finally:
+                self.handled(data.get('replay'))
+        return timed
+
+    def handled(self, seq):
+        """ Records the latency of a handled event. Events are handled in
+        the order they were sent, any sent before it still waiting were
+        superseded or dropped.
+        """
+
+        sent = self.sent.pop(seq, None)
+        if sent is None:
+            return
+        self.latencies.append(time.time() - sent)
+        while self.sent and next(iter(self.sent)) < seq:
+            self.sent.popitem(last=False)
+            self.superseded += 1
+
+    def send(self, kind, data):
+        env = self.env
+        if kind == 'queue':
+            push = data.pop('push', 'rpush')
+            getattr(env.redis, push)(PLAYLIST_KEY, json.dumps(data))
+            return
+
+        self.count += 1
+        data['replay'] = self.count
+        self.sent[self.count] = time.time()
+        if env.stream is not None:
+            append(env.redis, env.stream.key, json.dumps(data))
+        else:
+            env.redis.publish(CHANNEL, json.dumps(data))
+
+    def sample(self, start):
+        """ Records the unhandled events, events waiting in the dispatcher
+        and tracks waiting in the queue.
+        """
+
+        while True:
+            snapshot = metrics.REGISTRY.snapshot()
+            self.samples.append({
+                'elapsed': time.time() - start,
+                'unhandled': len(self.sent),
+                'dispatcher': snapshot.get('fmplayer_event_queue_depth', 0),
+                'queued': self.env.redis.store.llen(PLAYLIST_KEY),
+            })
+            gevent.sleep(SAMPLE_INTERVAL)
+
+    def run(self, messages):
+        """ Sends the messages, an iterable of ``(time, type, data)``, and
+        returns the number sent.
+        """
+
+        start = time.time()
+        sampler = gevent.spawn(self.sample, start)
+        first = None
+        sent = 0
+        try:
+            for at, kind, data in messages:
+                if first is None:
+                    first = at
+                if self.speed:
+                    due = start + (at - first) / self.speed
+                    wait = due - time.time()
+                    if wait > 0:
+                        gevent.sleep(wait)
+                    else:
+                        self.lag.append(-wait)
+                else:
+                    gevent.sleep(0)
+                self.send(kind, data)
+                sent += 1
+
+            # Give the player a moment to work through what is waiting
+            deadline = time.time() + SAMPLE_INTERVAL * 5
+            while self.sent and time.time() < deadline:
+                gevent.sleep(0.01)
+        finally:
+            sampler.kill()
+        return sent
+
+
+def growth(samples, name):
+    """ Returns the start, max and end of a backlog and its growth per
+    second from the first to the last sample.
+    """
+
+    if not samples:
+        return {}
+    values = [sample[name] for sample in samples]
+    elapsed = samples[-1]['elapsed'] - samples[0]['elapsed']
+    return {
+        'start': values[0],
+        'max': max(values),
+        'end': values[-1],
+        'per_second': (values[-1] - values[0]) / elapsed if elapsed else 0,
+    }
+
+
+@click.argument('capture')
+@click.option(
+    '--speed',
+    help='Multiple of the recorded rate messages are sent at, 0 for max',
+    type=float,
+    default=1)
+@click.option(
+    '--track-seconds',
+    help='Duration of the fake tracks played from the queue',
+    type=float,
+    default=180)
+@click.option(
+    '--latency',
+    help='Seconds of simulated Redis round trip',
+    type=float,
+    default=0.0005)
+@click.option(
+    '--transport',
+    help='How events reach the player',
+    type=click.Choice(['pubsub', 'stream']),
+    default='pubsub')
+@click.option('--output', '-o', help='Write JSON results to this file')
+@click.command()
+def replay(capture, speed, track_seconds, latency, transport, output):
+    """ Replays a capture against a player with the FakeSink and prints the
+    results as JSON.
+    """
+
+    # Tracks play at the same multiple of real time as the capture
+    fakes.Session.speed = speed
+    fakes.Session.duration = int(track_seconds * 1000)
+
+    env = Environment(latency, 'fake', transport)
+    replay = Replay(env, speed)
+    env.start()
+    start = time.time()
+    try:
+        sent = replay.run(read_capture(capture))
+    finally:
+        env.close()
+    elapsed = time.time() - start
+    snapshot = metrics.REGISTRY.snapshot()
+
+    results = {
+        'settings': {
+            'capture': capture,
+            'speed': speed,
+            'track_seconds': track_seconds,
+            'latency': latency,
+            'transport': transport,
+        },
+        'messages': sent,
+        'events': replay.count,
+        'seconds': elapsed,
+        'messages_per_second': sent / elapsed if elapsed else 0,
+        'handler_latency': summarise(replay.latencies),
+        'send_lag': summarise(replay.lag),
+        'superseded': replay.superseded,
+        'coalesced': snapshot.get('fmplayer_events_coalesced_total'),
+        'dropped': snapshot.get('fmplayer_events_dropped_total'),
+        'unhandled': len(replay.sent),
+        'backlog': {
+            'unhandled': growth(replay.samples, 'unhandled'),
+            'dispatcher': growth(replay.samples, 'dispatcher'),
+            'queued': growth(replay.samples, 'queued'),
+        },
+    }
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output is not None:
+        with open(output, 'w') as f:
+            f.write(text)
+    click.echo(text)
+
+
+@click.group()
+def cli():
+    """ Records and replays player traffic.
+    """
+
+
+cli.add_command(record)
+cli.add_command(replay)
+
+
+if __name__ == '__main__':
+    cli()
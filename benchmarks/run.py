@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+benchmarks.run
+==============
+
+Runs the offline benchmark scenarios against the real player, event handler
+and watchers, using the fake Spotify session, ALSA mixer and in-process
+Redis from ``benchmarks.fakes``. Results are written as JSON so runs from
+different versions can be compared::
+
+    python -m benchmarks.run --speed 50 --output results.json
+"""
+
+# Standard Libs
+import json
+import time
+
+# Third Party Libs
+import click
+import gevent
+from gevent import monkey
+
+monkey.patch_all()
+
+# First Party Libs
+from benchmarks import fakes  # noqa
+
+fakes.install()
+
+import fmplayer  # noqa
+from fmplayer import metrics  # noqa
+from fmplayer.events import (  # noqa
+    EventHandler,
+    PLAYLIST_KEY,
+    PROCESSING_KEY,
+    event_watcher,
+    queue_watcher)
+from fmplayer.player import Player  # noqa
+from fmplayer.streams import EVENTS_STREAM, EventStream, append  # noqa
+from fmplayer.watchdog import Watchdog  # noqa
+
+
+CHANNEL = 'fm:player:benchmark'
+
+# Seconds a scenario waits for an expected event before giving up
+TIMEOUT = 60
+
+# Seconds without audio before the watchdog retries and then skips a track
+STALL_WINDOW = 0.5
+
+
+def summarise(samples):
+    """ Returns count, mean, p50, p95 and max of a list of seconds, in
+    milliseconds.
+    """
+
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))] * 1000
+
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples) * 1000,
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'max': samples[-1] * 1000,
+    }
+
+
+def entry(i):
+    return json.dumps({
+        'uri': 'spotify:track:{0:022d}'.format(i),
+        'user': 'benchmark'
+    })
+
+
+class Environment(object):
+    """ A player, handler and in-process Redis with the player's published
+    events recorded as ``(time, event)`` tuples.
+    """
+
+    def __init__(self, latency, sink, transport='pubsub'):
+        self.redis = fakes.FakeRedis(latency)
+        self.player = Player('user', 'password', 'key', sink)
+        self.handler = EventHandler(self.redis, self.player, CHANNEL)
+        self.handler.watchdog = Watchdog(
+            self.player,
+            STALL_WINDOW,
+            interval=STALL_WINDOW / 10)
+        self.stream = None
+        if transport == 'stream':
+            self.stream = EventStream(self.redis, consumer='benchmark')
+        self.published = []
+        self.frames = []
+        self.player.sink.observers.append(self.delivered)
+        self.greenlets = [gevent.spawn(self.record)]
+
+    def delivered(self, audio_format, frames, num_frames):
+        track = self.player.session.player.track
+        self.frames.append((time.time(), track.uri if track else None))
+
+    def record(self):
+        pubsub = self.redis.pubsub()
+        pubsub.subscribe(CHANNEL)
+        for item in pubsub.listen():
+            if item['type'] == 'message':
+                self.published.append((time.time(), json.loads(item['data'])))
+
+    def start(self):
+        self.greenlets.extend([
+            gevent.spawn(
+                event_watcher,
+                self.redis,
+                self.player,
+                self.handler,
+                self.stream),
+            gevent.spawn(queue_watcher, self.redis, self.handler),
+        ])
+        gevent.sleep(0)
+
+    def close(self):
+        gevent.killall(self.greenlets)
+        self.player.session.player.unload()
+
+    def publish(self, event, **data):
+        data['event'] = event
+        if self.stream is not None:
+            append(self.redis, EVENTS_STREAM, json.dumps(data))
+        else:
+            self.redis.publish(CHANNEL, json.dumps(data))
+
+    def burst(self, messages):
+        """ Publishes ``(event, data)`` messages in a single round trip, as
+        a pipeline would, so they arrive back to back without the player
+        getting a turn in between.
+        """
+
+        self.redis.round_trip()
+        for event, data in messages:
+            data = dict(data, event=event)
+            if self.stream is not None:
+                append(self.redis.store, EVENTS_STREAM, json.dumps(data))
+            else:
+                self.redis.store.publish(CHANNEL, json.dumps(data))
+
+    def wait_for(self, predicate, after=0):
+        """ Blocks until a published event matching the predicate arrives
+        after the given time, returns its arrival time.
+        """
+
+        deadline = time.time() + TIMEOUT
+        while time.time() < deadline:
+            for at, event in self.published:
+                if at >= after and predicate(event):
+                    return at
+            gevent.sleep(0.001)
+        raise RuntimeError('Timed out waiting for event')
+
+    def first_frame(self, uri, after):
+        """ Blocks until the first audio frame of the track is delivered
+        after the given time, returns its delivery time.
+        """
+
+        deadline = time.time() + TIMEOUT
+        while time.time() < deadline:
+            for at, playing in self.frames:
+                if at >= after and playing == uri:
+                    return at
+            gevent.sleep(0.001)
+        raise RuntimeError('Timed out waiting for audio')
+
+
+def queue_throughput(env, tracks):
+    """ Plays short tracks back to back from a full queue.
+    """
+
+    for i in range(tracks):
+        env.redis.rpush(PLAYLIST_KEY, entry(i))
+    start = time.time()
+    env.start()
+    while len([e for at, e in env.published if e['event'] == 'end']) < tracks:
+        if time.time() - start > TIMEOUT:
+            raise RuntimeError('Timed out playing queue')
+        gevent.sleep(0.001)
+    elapsed = time.time() - start
+
+    return {
+        'tracks': tracks,
+        'seconds': elapsed,
+        'tracks_per_second': tracks / elapsed,
+        'gap': summarise(
+            [at - end for (end, a), (at, b) in zip(env.published, env.published[1:])
+             if a['event'] == 'end' and b['event'] == 'play']),
+    }
+
+
+def skip_latency(env, skips):
+    """ Skips a playing track and times the next track's play event and
+    first audio frame.
+    """
+
+    for i in range(skips + 1):
+        env.redis.rpush(PLAYLIST_KEY, entry(i))
+    env.start()
+    env.wait_for(lambda e: e['event'] == 'play')
+
+    to_play = []
+    to_audio = []
+    for i in range(1, skips + 1):
+        gevent.sleep(0.05)
+        uri = json.loads(entry(i))['uri']
+        start = time.time()
+        env.publish('stop')
+        to_play.append(env.wait_for(
+            lambda e: e['event'] == 'play' and e['uri'] == uri, start) - start)
+        to_audio.append(env.first_frame(uri, start) - start)
+
+    return {
+        'skips': skips,
+        'skip_to_play': summarise(to_play),
+        'skip_to_first_frame': summarise(to_audio),
+    }
+
+
+def volume_burst(env, iterations):
+    """ Fires a burst of 50 volume changes per iteration, as dragging the
+    volume slider does, and times how long until the final level is applied.
+    The bursts cycle through 0 to 99 and the last ends on 100 so the final
+    level is only seen once every burst has been dispatched.
+    """
+
+    events = iterations * 50
+    env.start()
+    gevent.sleep(0.01)
+    start = time.time()
+    levels = [i % 100 for i in range(events - 1)] + [100]
+    for offset in range(0, events, 50):
+        env.burst(('set_volume', {'volume': level})
+                  for level in levels[offset:offset + 50])
+    done = env.wait_for(
+        lambda e: e['event'] == 'volume_changed' and e['volume'] == 100,
+        start)
+
+    # Let the dispatcher finish the batch before reading its counters
+    gevent.sleep(0.01)
+    snapshot = metrics.REGISTRY.snapshot()
+
+    return {
+        'events': events,
+        'seconds': done - start,
+        'handled': len([e for at, e in env.published if e['event'] == 'volume_changed']),
+        'coalesced': snapshot.get('fmplayer_events_coalesced_total'),
+        'dropped': snapshot.get('fmplayer_events_dropped_total'),
+    }
+
+
+def recovery(env, restarts):
+    """ Restarts the watchers with a track left in the processing list, as
+    after a crash, and times how long until it plays again.
+    """
+
+    samples = []
+    for i in range(restarts):
+        env.redis.rpush(PROCESSING_KEY, entry(i))
+        uri = json.loads(entry(i))['uri']
+        start = time.time()
+        env.start()
+        samples.append(env.wait_for(
+            lambda e: e['event'] == 'play' and e['uri'] == uri, start) - start)
+        gevent.killall(env.greenlets[1:])
+        env.greenlets = env.greenlets[:1]
+        env.player.stop()
+        env.redis.delete(PROCESSING_KEY)
+
+    return {
+        'restarts': restarts,
+        'restart_to_play': summarise(samples),
+    }
+
+
+def stall_recovery(env, stalls):
+    """ Plays tracks which stall part way through and times from the stall
+    until the following track plays, after the watchdog has retried and
+    skipped the stalled track.
+    """
+
+    for i in range(stalls * 2):
+        env.redis.rpush(PLAYLIST_KEY, entry(i))
+        if i % 2 == 0:
+            fakes.Session.stalls[json.loads(entry(i))['uri']] = 1000
+
+    samples = []
+    env.start()
+    try:
+        for i in range(0, stalls * 2, 2):
+            stalled, after = [json.loads(entry(j))['uri'] for j in (i, i + 1)]
+            start = env.wait_for(
+                lambda e: e['event'] == 'play' and e['uri'] == stalled)
+            env.wait_for(
+                lambda e: e['event'] == 'error' and e['uri'] == stalled, start)
+            samples.append(env.wait_for(
+                lambda e: e['event'] == 'play' and e['uri'] == after, start) - start)
+    finally:
+        fakes.Session.stalls = {}
+    snapshot = metrics.REGISTRY.snapshot()
+
+    return {
+        'stalls': stalls,
+        'window': STALL_WINDOW,
+        'play_to_next_play': summarise(samples),
+        'stalls_detected': snapshot.get('fmplayer_stalls_total'),
+    }
+
+
+SCENARIOS = [
+    ('queue_throughput', queue_throughput, 'tracks', 2000),
+    ('skip_latency', skip_latency, 'skips', 180000),
+    ('volume_burst', volume_burst, 'events', 180000),
+    ('recovery', recovery, 'restarts', 180000),
+    ('stall_recovery', stall_recovery, 'stalls', 4000),
+]
+
+
+@click.option(
+    '--speed',
+    help='Multiple of real time audio is delivered at, 0 for max',
+    type=float,
+    default=50)
+@click.option(
+    '--load-delay',
+    help='Seconds the fake session takes to resolve a track',
+    type=float,
+    default=0.05)
+@click.option(
+    '--latency',
+    help='Seconds of simulated Redis round trip',
+    type=float,
+    default=0.0005)
+@click.option(
+    '--sink',
+    help='Audio sink the player uses',
+    type=click.Choice(['fake', 'ring']),
+    default='fake')
+@click.option(
+    '--transport',
+    help='How events reach the player',
+    type=click.Choice(['pubsub', 'stream']),
+    default='pubsub')
+@click.option('--iterations', '-n', type=int, default=20)
+@click.option('--scenario', '-s', multiple=True)
+@click.option('--output', '-o', help='Write JSON results to this file')
+@click.command()
+def run(speed, load_delay, latency, sink, transport, iterations, scenario,
+        output):
+    """ Runs the benchmark scenarios and prints the results as JSON.
+    """
+
+    fakes.Session.speed = speed
+    fakes.Session.load_delay = load_delay
+
+    results = {
+        'version': fmplayer.__version__,
+        'time': time.time(),
+        'settings': {
+            'speed': speed,
+            'load_delay': load_delay,
+            'latency': latency,
+            'sink': sink,
+            'transport': transport,
+            'iterations': iterations,
+        },
+        'scenarios': {},
+    }
+
+    for name, function, argument, duration in SCENARIOS:
+        if scenario and name not in scenario:
+            continue
+        fakes.Session.duration = duration
+        env = Environment(latency, sink, transport)
+        try:
+            results['scenarios'][name] = function(env, iterations)
+        finally:
+            env.close()
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output is not None:
+        with open(output, 'w') as f:
+            f.write(text)
+    click.echo(text)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+benchmarks.transitions
+======================
+
+Compares the latency of the pipelined ``EventHandler`` state transitions
+against the sequential round trips they replaced. Requires a Redis server::
+
+    python -m benchmarks.transitions -r redis://localhost:6379/ -n 1000
+"""
+
+# Standard Libs
+import json
+import time
+import urlparse
+
+# Third Party Libs
+import click
+from redis import StrictRedis
+
+# First Party Libs
+from fmplayer.events import EventHandler
+
+
+CHANNEL = 'fm:player:benchmark'
+
+
+class NullPlayer(object):
+    """ Player which does nothing so only the Redis round trips are timed.
+    """
+
+    def play(self, uri, position=0):
+        return True
+
+    def set_volume(self, v):
+        pass
+
+    def set_mute(self, mute):
+        pass
+
+
+def legacy_play(redis, uri, user):
+    redis.publish(CHANNEL, json.dumps({'event': 'play', 'uri': uri, 'user': user}))
+    redis.set('fm:player:current', json.dumps({'uri': uri, 'user': user}))
+
+
+def legacy_end(redis, uri):
+    current = json.loads(redis.get('fm:player:current'))
+    redis.delete('fm:player:current')
+    redis.publish(CHANNEL, json.dumps({
+        'event': 'end',
+        'uri': uri,
+        'user': current['user']
+    }))
+
+
+def legacy_set_volume(redis, volume):
+    redis.set('fm:player:volume', volume)
+    redis.publish(CHANNEL, json.dumps({
+        'event': 'volume_changed',
+        'volume': volume
+    }))
+
+
+def percentile(samples, p):
+    """ Returns the ``p`` percentile of a sorted list of samples.
+    """
+
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+def timeit(function, iterations):
+    """ Runs a function the given number of times and returns the sorted
+    per call latencies in milliseconds.
+    """
+
+    samples = []
+    for i in range(iterations):
+        start = time.time()
+        function()
+        samples.append((time.time() - start) * 1000)
+    return sorted(samples)
+
+
+@click.option(
+    '--redis-uri',
+    '-r',
+    default='redis://localhost:6379/')
+@click.option('--redis-db', '-d', default=15)
+@click.option('--iterations', '-n', type=int, default=1000)
+@click.command()
+def run(redis_uri, redis_db, iterations):
+    """ Times each transition both ways and prints mean, p50 and p99.
+    """
+
+    uri = urlparse.urlparse(redis_uri)
+    redis = StrictRedis(
+        host=uri.hostname,
+        port=uri.port,
+        password=uri.password,
+        db=redis_db)
+    handler = EventHandler(redis, NullPlayer(), CHANNEL)
+    track = 'spotify:track:3Esqxo3D31RCjmdgwBPbOO'
+
+    def legacy_cycle():
+        legacy_play(redis, track, 'user')
+        legacy_end(redis, track)
+
+    def pipelined_cycle():
+        handler.play(track, 'user')
+        handler.end(track)
+
+    cases = [
+        ('play+end legacy', legacy_cycle),
+        ('play+end pipelined', pipelined_cycle),
+        ('set_volume legacy', lambda: legacy_set_volume(redis, 50)),
+        ('set_volume pipelined', lambda: handler.set_volume({'volume': 50})),
+    ]
+
+    for name, function in cases:
+        samples = timeit(function, iterations)
+        click.echo('{0:<24} mean {1:7.3f}ms  p50 {2:7.3f}ms  p99 {3:7.3f}ms'.format(
+            name,
+            sum(samples) / len(samples),
+            percentile(samples, 50),
+            percentile(samples, 99)))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+benchmarks.volume
+=================
+
+Compares the cost of a volume change through the ALSA mixer, opening the
+mixer and setting the level as ``set_volume`` did before the mixer was kept
+open, with the software volume stage, and measures the CPU cost of the
+software stage per second of audio. The mixer is only timed when the real
+``alsaaudio`` and ``spotify`` modules are installed::
+
+    python -m benchmarks.volume --mixer PCM
+"""
+
+# Standard Libs
+import json
+import time
+
+# Third Party Libs
+import click
+import numpy
+
+try:
+    import alsaaudio
+    import spotify  # noqa
+except ImportError:
+    from benchmarks import fakes
+    fakes.install()
+    alsaaudio = None
+
+# First Party Libs
+from fmplayer.sinks import SoftwareVolume, volume_gain  # noqa
+
+
+RATE = 44100
+CHANNELS = 2
+
+# Frames the ring sink writes at a time
+PERIOD = 1024
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+
+def per_call(function, iterations):
+    """ Returns the mean seconds per call of the function.
+    """
+
+    start = time.time()
+    for i in range(iterations):
+        function(i)
+    return (time.time() - start) / iterations
+
+
+def mixer_event(control, card):
+    def event(i):
+        mixer = alsaaudio.Mixer(control=control, cardindex=card)
+        mixer.setvolume(i % 101)
+        mixer.close()
+    return event
+
+
+def software_event(volume):
+    def event(i):
+        volume.set(volume_gain(i % 101))
+    return event
+
+
+def dsp_cost(seconds, gains):
+    """ Returns CPU seconds per second of audio spent scaling it in periods,
+    cycling the gain through the given values every second.
+    """
+
+    volume = SoftwareVolume(RATE)
+    samples = (numpy.random.normal(0, 3000, PERIOD * CHANNELS)
+               .clip(-32768, 32767).astype(numpy.int16))
+    periods = seconds * RATE // PERIOD
+    per_second = RATE // PERIOD
+
+    start = cpu_time()
+    for i in range(periods):
+        if i % per_second == 0:
+            volume.set(gains[(i // per_second) % len(gains)])
+        volume.apply(samples, CHANNELS)
+    return (cpu_time() - start) / seconds
+
+
+@click.option('--mixer', '-m', help='Mixer control to time', default='PCM')
+@click.option('--card', type=int, default=0)
+@click.option('--iterations', '-n', type=int, default=1000)
+@click.option(
+    '--seconds',
+    '-s',
+    help='Seconds of audio scaled per gain pattern',
+    type=int,
+    default=300)
+@click.option('--output', '-o', help='Write JSON results to this file')
+@click.command()
+def run(mixer, card, iterations, seconds, output):
+    """ Prints the per event cost of each volume control and the software
+    stage's CPU cost per second of audio.
+    """
+
+    results = {
+        'software_event_seconds': per_call(
+            software_event(SoftwareVolume(RATE)),
+            iterations),
+    }
+    click.echo('software  {0:10.2f}us per volume change'.format(
+        results['software_event_seconds'] * 1e6))
+
+    if alsaaudio is None:
+        click.echo('mixer     skipped, alsaaudio is not installed')
+    else:
+        try:
+            results['mixer_event_seconds'] = per_call(
+                mixer_event(mixer, card),
+                iterations)
+            click.echo('mixer     {0:10.2f}us per volume change'.format(
+                results['mixer_event_seconds'] * 1e6))
+        except alsaaudio.ALSAAudioError as e:
+            click.echo('mixer     skipped, {0}'.format(e))
+
+    for name, gains in [
+            ('unity', [1.0]),
+            ('constant', [0.5]),
+            ('ramping', [0.25, 1.0])]:
+        cost = dsp_cost(seconds, gains)
+        results['dsp_{0}_cpu_per_audio_second'.format(name)] = cost
+        click.echo('dsp {0:<9} {1:8.1f}us CPU per second of audio'.format(
+            name,
+            cost * 1e6))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fmplayer.bitrate
+================
+
+Adaptive streaming bitrate. The controller compares the rate frames are
+delivered at with real time, the sink buffer fill and sink underruns, and
+steps the preferred bitrate down when delivery falls behind and back up after
+a sustained healthy period. libspotify applies the preferred bitrate to the
+next track loaded.
+"""
+
+# Standard Libs
+import logging
+import time
+
+# Third Party Libs
+import spotify
+
+# First Party Libs
+from fmplayer import metrics
+
+
+logger = logging.getLogger('fmplayer')
+
+
+# libspotify bitrate values with their kbps, lowest first
+BITRATES = [(2, 96), (0, 160), (1, 320)]
+
+# Maps kbps to the libspotify bitrate value
+KBPS = dict((kbps, value) for value, kbps in BITRATES)
+
+# How often in seconds delivery health is checked
+BITRATE_INTERVAL = 2
+
+# Max multiple the healthy period needed to step up is backed off to
+MAX_BACKOFF = 8
+
+
+class BitrateController(object):
+    """ Picks the preferred bitrate from delivery health. An interval is
+    unhealthy if the sink underran or delivery fell behind real time without
+    enough audio buffered to ride it out. ``down_after`` unhealthy intervals
+    in a row step the bitrate down, ``up_after`` healthy intervals in a row
+    step it back up. Stepping down soon after stepping up doubles the healthy
+    period needed next time so the bitrate does not flap.
+    """
+
+    def __init__(self, player, kbps=320, down_ratio=0.9, low_fill=0.25,
+                 down_after=2, up_after=30):
+        """ Initialises the controller and sets the starting bitrate.
+
+        Arguments
+        ---------
+        player : fmplayer.player.Player
+            The player to control
+        kbps : int
+            Starting bitrate in kbps, default 320
+        down_ratio : float
+            Frames delivered per frame of real time below which delivery is
+            behind, default 0.9
+        low_fill : float
+            Sink buffer fill below which falling behind is unhealthy,
+            default 0.25
+        down_after : int
+            Unhealthy intervals in a row before stepping down, default 2
+        up_after : int
+            Healthy intervals in a row before stepping up, default 30
+        """
+
+        self.player = player
+        self.down_ratio = down_ratio
+        self.low_fill = low_fill
+        self.down_after = down_after
+        self.up_after = up_after
+
+        self.index = [kbps for value, kbps in BITRATES].index(kbps)
+        self.backoff = 1
+
+        # Frames delivered, counted by the sink observer
+        self.frames = 0
+        self.rate = 44100
+
+        # Values at the last check and the health streaks since
+        self.last = None
+        self.ratio = None
+        self.healthy = 0
+        self.unhealthy = 0
+        self.since_up = None
+
+        # Counters
+        self.steps_down = 0
+        self.steps_up = 0
+
+        metrics.REGISTRY.collect(
+            'fmplayer_bitrate_kbps',
+            'Preferred streaming bitrate',
+            lambda: self.kbps)
+        metrics.REGISTRY.collect(
+            'fmplayer_delivery_ratio',
+            'Frames delivered per frame of real time over the last interval',
+            lambda: self.ratio or 0)
+        for name, help in [
+                ('down', 'Bitrate steps down'),
+                ('up', 'Bitrate steps up')]:
+            metrics.REGISTRY.collect(
+                'fmplayer_bitrate_steps_{0}_total'.format(name),
+                help,
+                lambda name=name: getattr(self, 'steps_{0}'.format(name)),
+                kind='counter')
+
+        player.sink.observers.append(self.on_music_delivery)
+        player.set_bitrate(self.value)
+
+    @property
+    def value(self):
+        return BITRATES[self.index][0]
+
+    @property
+    def kbps(self):
+        return BITRATES[self.index][1]
+
+    def on_music_delivery(self, audio_format, frames, num_frames):
+        """ Sink observer, counts delivered frames.
+        """
+
+        self.frames += num_frames
+        self.rate = audio_format.sample_rate
+
+    def update(self):
+        """ Checks delivery health since the last call and steps the bitrate
+        if needed. Intervals in which the track changed or playback was not
+        running are skipped.
+
+        Returns
+        -------
+        str
+            The reason the bitrate was changed, None if unchanged
+        """
+
+        sink = self.player.sink
+        now = (
+            time.time(),
+            self.frames,
+            sink.underruns,
+            self.player.delivered)
+        last, self.last = self.last, now
+
+        playing = (
+            not self.player.stopped.is_set() and
+            self.player.session.player.state == spotify.PlayerState.PLAYING)
+        if last is None or not playing or now[3] < last[3] or now[0] <= last[0]:
+            return None
+
+        self.ratio = (now[1] - last[1]) / (self.rate * (now[0] - last[0]))
+        fill = sink.fill
+        stalled = now[2] > last[2]
+        behind = self.ratio < self.down_ratio and (
+            fill is None or fill < self.low_fill)
+
+        if stalled or behind:
+            self.unhealthy += 1
+            self.healthy = 0
+        else:
+            self.healthy += 1
+            self.unhealthy = 0
+
+        # A step up which lasted a full healthy period clears the backoff
+        if self.since_up is not None:
+            self.since_up += 1
+            if self.since_up > self.up_after:
+                self.backoff = 1
+
+        if self.unhealthy >= self.down_after and self.index > 0:
+            if self.since_up is not None and self.since_up <= self.up_after:
+                self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+            self.steps_down += 1
+            self.since_up = None
+            return self.step(-1, 'underrun' if stalled else 'behind')
+
+        if (self.healthy >= self.up_after * self.backoff and
+                self.index < len(BITRATES) - 1):
+            self.steps_up += 1
+            self.since_up = 0
+            return self.step(1, 'healthy')
+
+        return None
+
+    def step(self, direction, reason):
+        """ Moves the bitrate one step up or down and resets the streaks.
+        """
+
+        self.index += direction
+        self.healthy = 0
+        self.unhealthy = 0
+        logger.info('Bitrate {0} to {1}k: {2}'.format(
+            'up' if direction > 0 else 'down',
+            self.kbps,
+            reason))
+        self.player.set_bitrate(self.value)
+        return reason
@@ -10,6 +10,7 @@ CLI interface for FM Player.
 
 # Standard Libs
 import logging
+import time
 import urlparse
 
 # Third Party Libs
@@ -19,8 +20,37 @@ from gevent import monkey
 from redis import StrictRedis
 
 # First Party Libs
-from fmplayer.events import EventHandler, event_watcher, queue_watcher
+from fmplayer import metrics
+from fmplayer.bitrate import KBPS, BitrateController
+from fmplayer.codec import CODECS, get_codec
+from fmplayer.events import (
+    PLAYLIST_KEY,
+    PROCESSING_KEY,
+    EventHandler,
+    bitrate_watcher,
+    event_watcher,
+    failover_watcher,
+    index_watcher,
+    prefetch,
+    progress_watcher,
+    history_watcher,
+    queue_watcher,
+    restore,
+    warm_cache)
+from fmplayer.history import HISTORY_LENGTH, HISTORY_STREAM, History
+from fmplayer.index import INDEX_SIZE, QueueIndex
+from fmplayer.lease import LEASE_KEY, Lease
+from fmplayer.loudness import LoudnessAnalyser, available
 from fmplayer.player import Player
+from fmplayer.profiler import BlockingDetector, Profiler
+from fmplayer.state import MODES, State
+from fmplayer.watchdog import STALL_WINDOW, Watchdog
+from fmplayer.streams import (
+    EVENTS_STREAM,
+    PUBLISHED_STREAM,
+    STREAM_GROUP,
+    STREAM_LENGTH,
+    EventStream)
 
 
 monkey.patch_all()
@@ -34,6 +64,33 @@ handler.setFormatter(logging.Formatter(LOG_FORMAT))
 logger.addHandler(handler)
 
 
+def timed(timings, name, function, *args, **kwargs):
+    """ Calls the function recording how long it took under the name.
+    """
+
+    start = time.time()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        timings[name] = time.time() - start
+
+
+def prefetch_first(redis, handler, timings):
+    """ Once logged in prefetches the track which will play first, the one
+    being recovered if there is one, otherwise the head of the queue.
+    """
+
+    handler.player.logged_in.wait()
+    return timed(
+        timings,
+        'prefetch',
+        prefetch,
+        redis,
+        handler,
+        handler.processing,
+        handler.queue)
+
+
 @click.option(
     '--log-level',
     '-l',
@@ -55,6 +112,9 @@ logger.addHandler(handler)
     '-k',
     help='Path to Spotify API key',
     required=True)
+@click.option(
+    '--spotify-credentials',
+    help='File to store the Spotify credentials blob in for faster logins')
 @click.option(
     '--redis-uri',
     '-r',
@@ -73,10 +133,180 @@ logger.addHandler(handler)
 @click.option(
     '--audio-sink',
     '-s',
-    type=click.Choice(['alsa', 'fake']))
+    type=click.Choice(['alsa', 'ring', 'fake']))
+@click.option(
+    '--buffer-seconds',
+    help='Seconds of audio buffered by the ring sink',
+    type=float,
+    default=2.0)
+@click.option(
+    '--bitrate',
+    help='Streaming bitrate in kbps, adaptive steps it down when delivery '
+         'falls behind and back up once healthy',
+    type=click.Choice(['96', '160', '320', 'adaptive']),
+    default='320')
+@click.option(
+    '--loudness-target',
+    help='Measure track loudness and bring tracks to this many LUFS from '
+         'their next play, e.g. -14, needs numpy',
+    type=float)
+@click.option(
+    '--audio-cache',
+    help='Directory to cache streamed audio in')
+@click.option(
+    '--audio-cache-size',
+    help='Max audio cache size in MB, 0 for 10% of free disk space',
+    type=int,
+    default=0)
 @click.option('--mixer', '-m')
+@click.option(
+    '--volume-control',
+    help='Set volume and mute on the ALSA mixer or by scaling the audio in '
+         'the sink, software needs numpy',
+    type=click.Choice(['mixer', 'software']),
+    default='mixer')
+@click.option(
+    '--mixer-card',
+    help='Sound card index of the mixer',
+    type=int,
+    default=0)
 @click.option('--min_vol', type=int)
 @click.option('--max_vol', type=int)
+@click.option(
+    '--queue-key',
+    help='Playlist queue key, set per zone when players share a Redis DB',
+    default=PLAYLIST_KEY)
+@click.option(
+    '--processing-key',
+    help='Key of the list tracks are moved onto whilst playing',
+    default=PROCESSING_KEY)
+@click.option(
+    '--index-size',
+    help='Number of upcoming queue entries indexed into <queue key>:index '
+         'with their duration and ETA, e.g. {0}, default 0 disabled'.format(
+             INDEX_SIZE),
+    type=int,
+    default=0)
+@click.option(
+    '--queue-mode',
+    '-q',
+    help='How to consume the playlist queue, poll for Redis < 6.2',
+    type=click.Choice(['blocking', 'poll']),
+    default='blocking')
+@click.option(
+    '--event-transport',
+    help='Receive events from the pub/sub channel or a stream, the stream '
+         'keeps events sent whilst the player is down and needs Redis 6.2',
+    type=click.Choice(['pubsub', 'stream']),
+    default='pubsub')
+@click.option(
+    '--event-stream',
+    help='Stream to read events from with the stream transport',
+    default=EVENTS_STREAM)
+@click.option(
+    '--stream-group',
+    help='Consumer group the player reads the event stream with',
+    default=STREAM_GROUP)
+@click.option(
+    '--published-stream',
+    help='Capped stream published events are also appended to, default '
+         '{0} with the stream transport'.format(PUBLISHED_STREAM))
+@click.option(
+    '--stream-length',
+    help='Approximate max number of events kept in the published stream',
+    type=int,
+    default=STREAM_LENGTH)
+@click.option(
+    '--history/--no-history',
+    help='Record a history of the tracks played, needs Redis 5 or later',
+    default=False)
+@click.option(
+    '--history-stream',
+    help='Capped stream a record of each track played is appended to',
+    default=HISTORY_STREAM)
+@click.option(
+    '--history-length',
+    help='Approximate max number of records kept in the history stream',
+    type=int,
+    default=HISTORY_LENGTH)
+@click.option(
+    '--history-backlog',
+    help='SQLite database history records are kept in whilst Redis is '
+         'unavailable',
+    default='/tmp/fmplayer/history.db')
+@click.option(
+    '--progress-interval',
+    help='Seconds between storing and publishing the playback position',
+    type=float,
+    default=5)
+@click.option(
+    '--stall-window',
+    help='Seconds without audio before a track is retried and then skipped, '
+         'and past its duration before it is stopped, e.g. {0}, default 0 '
+         'disabled'.format(STALL_WINDOW),
+    type=float,
+    default=0)
+@click.option(
+    '--failover',
+    help='Run as one of an active and hot standby pair',
+    is_flag=True)
+@click.option(
+    '--lease-key',
+    help='Redis key of the leader lease when running with --failover',
+    default=LEASE_KEY)
+@click.option(
+    '--lease-ttl',
+    help='Milliseconds the leader lease lasts without renewal',
+    type=int,
+    default=3000)
+@click.option(
+    '--node-name',
+    help='Name of this node in the leader lease, default the host name')
+@click.option(
+    '--track-cache-size',
+    help='Max number of resolved tracks to cache',
+    type=int,
+    default=500)
+@click.option(
+    '--track-cache-ttl',
+    help='Seconds to cache resolved tracks for',
+    type=int,
+    default=86400)
+@click.option(
+    '--codec',
+    help='Encoding of published events, both are always accepted',
+    type=click.Choice(sorted(CODECS)),
+    default='json')
+@click.option(
+    '--state-model',
+    help='Where to keep player state, both whilst migrating to the hash',
+    type=click.Choice(MODES),
+    default='legacy')
+@click.option(
+    '--profile-dir',
+    help='Directory profiles are written to by the profiler_stop event, '
+         'profiling is disabled without one')
+@click.option(
+    '--block-threshold',
+    help='Report greenlets holding the hub longer than this many ms',
+    type=int,
+    default=100)
+@click.option(
+    '--metrics-port',
+    help='Serve Prometheus metrics over HTTP on this port',
+    type=int)
+@click.option(
+    '--metrics-host',
+    help='Address to serve metrics on, 0.0.0.0 for every interface',
+    default='127.0.0.1')
+@click.option(
+    '--metrics-key',
+    help='Redis key to periodically write a metrics snapshot to')
+@click.option(
+    '--metrics-interval',
+    help='Seconds between metrics snapshots',
+    type=int,
+    default=10)
 @click.command()
 def player(*args, **kwargs):
     """FM Player is the thisissoon.fm Player software.
@@ -102,27 +332,184 @@ def player(*args, **kwargs):
         password=uri.password,
         db=kwargs.pop('redis_db'))
 
-    # Blocks until Login is complete
+    queue_mode = kwargs.pop('queue_mode')
+    node_name = kwargs.pop('node_name')
+
+    # Event transport, pub/sub or a stream read through a consumer group
+    stream = None
+    published = kwargs.pop('published_stream')
+    if kwargs.pop('event_transport') == 'stream':
+        stream = EventStream(
+            redis,
+            kwargs.pop('event_stream'),
+            kwargs.pop('stream_group'),
+            node_name)
+        published = published or PUBLISHED_STREAM
+
+    bitrate = kwargs.pop('bitrate')
+    volume_control = kwargs.pop('volume_control')
+    adaptive = bitrate == 'adaptive'
+
+    # Checked before the session starts as track gains are applied with numpy
+    loudness_target = kwargs.pop('loudness_target')
+    if loudness_target is not None and not available():
+        raise click.BadParameter(
+            'numpy is not installed, install the loudness extra',
+            param_hint='--loudness-target')
+
+    # Login runs in the background whilst Redis, the mixer and the first
+    # track are made ready, each startup phase is timed
+    timings = {}
     logger.debug('Creating Playing')
-    player = Player(
+    player = timed(
+        timings,
+        'session',
+        Player,
         kwargs.pop('spotify_user'),
         kwargs.pop('spotify_pass'),
         kwargs.pop('spotify_key'),
         kwargs.pop('audio_sink'),
         kwargs.pop('mixer'),
         kwargs.pop('min_vol'),
-        kwargs.pop('max_vol'))
+        kwargs.pop('max_vol'),
+        cache_size=kwargs.pop('track_cache_size'),
+        cache_ttl=kwargs.pop('track_cache_ttl'),
+        card=kwargs.pop('mixer_card'),
+        buffer_seconds=kwargs.pop('buffer_seconds'),
+        audio_cache=kwargs.pop('audio_cache'),
+        audio_cache_size=kwargs.pop('audio_cache_size'),
+        credentials=kwargs.pop('spotify_credentials'),
+        block=False,
+        bitrate=KBPS[320 if adaptive else int(bitrate)],
+        volume_control=volume_control)
+
+    loudness = None
+    if loudness_target is not None:
+        loudness = LoudnessAnalyser(player, loudness_target)
+
+    codec = get_codec(kwargs.pop('codec'))
+    queue_key = kwargs.pop('queue_key')
+    index = None
+    index_size = kwargs.pop('index_size')
+    if index_size > 0:
+        index = QueueIndex(player, queue_key, size=index_size, codec=codec)
+
+    watchdog = None
+    stall_window = kwargs.pop('stall_window')
+    if stall_window > 0:
+        watchdog = Watchdog(player, stall_window)
+
+    history = None
+    history_stream = kwargs.pop('history_stream')
+    history_length = kwargs.pop('history_length')
+    history_backlog = kwargs.pop('history_backlog')
+    if kwargs.pop('history'):
+        history = History(
+            redis,
+            history_stream,
+            history_length,
+            history_backlog,
+            codec=codec)
+
+    profiler = None
+    detector = None
+    profile_dir = kwargs.pop('profile_dir')
+    block_threshold = kwargs.pop('block_threshold')
+    if profile_dir is not None:
+        profiler = Profiler(profile_dir)
+        detector = BlockingDetector(block_threshold / 1000.0)
 
     # Create Handler Instance
-    handler = EventHandler(redis, player, channel)
-    handler.set_volume({'volume': 60})  # Default volume
-    handler.set_mute({'mute': False})  # Default mute off
-
-    # Threads - Queue and Event Watcher
-    threads = [
-        gevent.spawn(event_watcher, redis, player, handler),
-        gevent.spawn(queue_watcher, redis, handler),
-    ]
+    handler = EventHandler(
+        redis,
+        player,
+        channel,
+        State(kwargs.pop('state_model')),
+        queue_key,
+        kwargs.pop('processing_key'),
+        profiler,
+        detector,
+        codec,
+        published,
+        kwargs.pop('stream_length'),
+        loudness,
+        index,
+        watchdog,
+        history)
+
+    login = gevent.spawn(timed, timings, 'login', player.logged_in.wait)
+    state = gevent.spawn(timed, timings, 'redis', handler.state.read, redis)
+    first = gevent.spawn(prefetch_first, redis, handler, timings)
+    phases = [login, state, first]
+    if volume_control == 'mixer':
+        mixer = gevent.spawn(timed, timings, 'mixer', player.mixer.get)
+        phases.append(mixer)
+    gevent.joinall(phases)
+
+    if volume_control == 'mixer' and mixer.exception is not None:
+        logger.warning('Unable to open mixer: {0}'.format(mixer.exception))
+
+    metrics.STARTUP.set(time.time() - metrics.STARTED)
+    logger.info('Ready after {0:.3f}s ({1})'.format(
+        metrics.STARTUP.value,
+        ', '.join('{0} {1:.3f}s'.format(name, timings[name])
+                  for name in sorted(timings))))
+
+    # Warm the track cache from the play history in the background
+    if history is not None:
+        gevent.spawn(warm_cache, player, history)
+
+    # Threads - Queue, Event and Mixer Watcher, with a standby the queue
+    # and event watchers only run whilst holding the lease
+    threads = []
+    if history is not None:
+        threads.append(gevent.spawn(history_watcher, handler))
+    if volume_control == 'mixer':
+        threads.append(gevent.spawn(player.mixer.watch))
+    if adaptive:
+        threads.append(gevent.spawn(
+            bitrate_watcher,
+            handler,
+            BitrateController(player)))
+    progress_interval = kwargs.pop('progress_interval')
+    if kwargs.pop('failover'):
+        lease = Lease(
+            redis,
+            node_name,
+            kwargs.pop('lease_key'),
+            kwargs.pop('lease_ttl'))
+        threads.append(gevent.spawn(
+            failover_watcher,
+            redis,
+            handler,
+            lease,
+            progress=progress_interval,
+            stream=stream))
+    else:
+        restore(redis, handler, state.value)
+        threads.extend([
+            gevent.spawn(event_watcher, redis, player, handler, stream),
+            gevent.spawn(queue_watcher, redis, handler, queue_mode),
+            gevent.spawn(progress_watcher, handler, progress_interval),
+        ])
+        if index is not None:
+            threads.append(gevent.spawn(index_watcher, redis, handler))
+
+    # Metrics
+    metrics_port = kwargs.pop('metrics_port')
+    if metrics_port is not None:
+        threads.append(gevent.spawn(
+            metrics.serve,
+            metrics_port,
+            kwargs.pop('metrics_host')))
+
+    metrics_key = kwargs.pop('metrics_key')
+    if metrics_key is not None:
+        threads.append(gevent.spawn(
+            metrics.snapshot_watcher,
+            redis,
+            metrics_key,
+            kwargs.pop('metrics_interval')))
 
     # Run
     gevent.joinall(threads)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fmplayer.codec
+==============
+
+Encoding and validation of channel events and queue entries. JSON is the
+default encoding, msgpack can be used if installed. The encoding of each
+message is detected from its first byte so players and services using
+either can share a channel.
+"""
+
+# Standard Libs
+import json
+import numbers
+
+# Third Party Libs
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+# First bytes of a msgpack map: fixmap, map 16 and map 32
+MSGPACK_MAPS = frozenset(list(range(0x80, 0x90)) + [0xde, 0xdf])
+
+
+class InvalidMessage(ValueError):
+    """ Raised when a message can not be decoded or fails validation.
+    """
+
+
+class JsonCodec(object):
+
+    name = 'json'
+
+    def encode(self, data):
+        return json.dumps(data)
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+
+class MsgpackCodec(object):
+
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('msgpack is not installed')
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, raw):
+        return msgpack.unpackb(raw, raw=False)
+
+
+CODECS = {
+    'json': JsonCodec,
+    'msgpack': MsgpackCodec,
+}
+
+
+def get_codec(name):
+    """ Returns a codec instance by name.
+
+    Arguments
+    ---------
+    name : str
+        ``json`` or ``msgpack``
+
+    Returns
+    -------
+    obj
+        The codec
+    """
+
+    return CODECS[name]()
+
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec() if msgpack is not None else None
+
+
+def detect(raw):
+    """ Returns the codec a raw message was encoded with.
+
+    Raises
+    ------
+    InvalidMessage
+        The message is empty or msgpack encoded without msgpack installed
+    """
+
+    if not raw:
+        raise InvalidMessage('Empty message')
+    first = raw[0]
+    if not isinstance(first, int):
+        first = ord(first)
+    if first in MSGPACK_MAPS:
+        if MSGPACK is None:
+            raise InvalidMessage('msgpack message but msgpack is not installed')
+        return MSGPACK
+    return JSON
+
+
+def field(types, required=True, minimum=None, maximum=None):
+    """ Compiles a single field check into a function of the value which
+    returns an error message or ``None``. ``bool`` values are never accepted
+    as numbers.
+    """
+
+    def check(value):
+        if not isinstance(value, types) or (
+                isinstance(value, bool) and bool not in types):
+            return 'must be {0}'.format(' or '.join(t.__name__ for t in types))
+        # Written so NaN fails both bounds
+        if minimum is not None and not value >= minimum:
+            return 'must be at least {0}'.format(minimum)
+        if maximum is not None and not value <= maximum:
+            return 'must be at most {0}'.format(maximum)
+        return None
+
+    check.required = required
+    return check
+
+
+def compile_schema(fields):
+    """ Compiles a schema, a dict of field names to ``field`` checks, into a
+    validation function for decoded messages.
+
+    Returns
+    -------
+    function
+        Takes the decoded dict and raises ``InvalidMessage`` if invalid
+    """
+
+    checks = list(fields.items())
+
+    def validate(data):
+        for name, check in checks:
+            if name not in data:
+                if check.required:
+                    raise InvalidMessage('{0} is required'.format(name))
+                continue
+            error = check(data[name])
+            if error is not None:
+                raise InvalidMessage('{0} {1}'.format(name, error))
+
+    return validate
+
+
+STRING = (type(u''), str)
+NUMBER = (numbers.Real, )
+
+# Validators for inbound events, events without a schema are passed through
+# as the player ignores them, e.g. its own published events
+EVENTS = dict((event, compile_schema(fields)) for event, fields in {
+    'pause': {},
+    'resume': {},
+    'stop': {},
+    'set_volume': {'volume': field(NUMBER, minimum=0, maximum=100)},
+    'set_mute': {'mute': field((bool, int))},
+    'profiler_start': {'interval': field(NUMBER, required=False, minimum=1)},
+    'profiler_stop': {},
+}.items())
+
+ENTRY = compile_schema({
+    'uri': field(STRING),
+    'user': field(STRING + (int, )),
+})
+
+
+def _decode(raw):
+    try:
+        data = detect(raw).decode(raw)
+    except InvalidMessage:
+        raise
+    except Exception as e:
+        raise InvalidMessage('Unable to decode: {0}'.format(e))
+    if not isinstance(data, dict):
+        raise InvalidMessage('Message must be a map')
+    return data
+
+
+def decode_event(raw):
+    """ Decodes and validates an event from the channel.
+
+    Arguments
+    ---------
+    raw : str
+        The raw message
+
+    Returns
+    -------
+    tuple
+        The event name and a dict of the remaining data
+
+    Raises
+    ------
+    InvalidMessage
+        The message could not be decoded or is not valid
+    """
+
+    data = _decode(raw)
+    event = data.pop('event', None)
+    if not isinstance(event, STRING):
+        raise InvalidMessage('event is required')
+    validate = EVENTS.get(event)
+    if validate is not None:
+        validate(data)
+    return event, data
+
+
+def decode_entry(raw):
+    """ Decodes and validates a playlist queue entry.
+
+    Arguments
+    ---------
+    raw : str
+        The raw queue entry
+
+    Returns
+    -------
+    dict
+        The entry, with at least ``uri`` and ``user``
+
+    Raises
+    ------
+    InvalidMessage
+        The entry could not be decoded or is not valid
+    """
+
+    data = _decode(raw)
+    ENTRY(data)
+    return data
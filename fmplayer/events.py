@@ -9,17 +9,58 @@ Event handler classes / helpers.
 """
 
 import gevent
-import json
+import gevent.queue
 import logging
 import random
+import time
+from redis.exceptions import RedisError
 
-from fmplayer.player import STOP_EVENT
+from fmplayer import metrics
+from fmplayer.bitrate import BITRATE_INTERVAL
+from fmplayer.codec import JSON, InvalidMessage, decode_entry, decode_event
+from fmplayer.history import FLUSH_INTERVAL
+from fmplayer.index import INDEX_INTERVAL
+from fmplayer.state import State
+from fmplayer.streams import STREAM_LENGTH, append, execute_blocking
 
 
 logger = logging.getLogger('fmplayer')
 
 
 PLAYLIST_KEY = 'fm:player:queue'
+PROCESSING_KEY = 'fm:player:processing'
+
+# How long in seconds a blocking pop waits on the server before looping
+BLOCK_TIMEOUT = 5
+
+# How often in seconds the playback position is stored and published
+PROGRESS_INTERVAL = 5
+
+# Volume set when no volume has been stored
+DEFAULT_VOLUME = 60
+
+# How often in seconds the head of the queue is checked for a track to
+# prefetch whilst a track is playing
+PREFETCH_INTERVAL = 5
+
+# Max number of received events waiting to be handled, further pub/sub
+# events are dropped until the dispatcher catches up, stream reads wait
+EVENT_QUEUE_SIZE = 256
+
+# Events in the same group supersede each other, only the last event of a
+# group in a batch is handled
+COALESCE_GROUPS = {
+    'set_volume': 'volume',
+    'set_mute': 'mute',
+    'pause': 'playback',
+    'resume': 'playback',
+}
+
+# Groups whose events cancel out when a batch starts with the first event
+# and ends with the second, none of them are handled
+CANCELLING_PAIRS = {
+    'playback': ('pause', 'resume'),
+}
 
 
 class EventHandler(object):
@@ -27,7 +68,10 @@ class EventHandler(object):
     maintaining the player state.
     """
 
-    def __init__(self, redis, player, channel):
+    def __init__(self, redis, player, channel, state=None, queue=PLAYLIST_KEY,
+                 processing=PROCESSING_KEY, profiler=None, detector=None,
+                 codec=JSON, stream=None, stream_length=STREAM_LENGTH,
+                 loudness=None, index=None, watchdog=None, history=None):
         """ Initialises the handler.
 
         Arguments
@@ -38,13 +82,61 @@ class EventHandler(object):
             The Spotify player instance
         channel : str
             The channel to listen on
+        state : fmplayer.state.State
+            Where player state is written, default the legacy keys
+        queue : str
+            The playlist queue key, default ``fm:player:queue``
+        processing : str
+            The list tracks are moved onto whilst playing, default
+            ``fm:player:processing``
+        profiler : fmplayer.profiler.Profiler
+            Sampling profiler controlled by admin events
+        detector : fmplayer.profiler.BlockingDetector
+            Hub blocking detector run whilst profiling
+        codec : obj
+            Codec published events are encoded with, default JSON
+        stream : str
+            Capped stream published events are also appended to, default
+            only the channel
+        stream_length : int
+            Approximate max number of events kept in the stream
+        loudness : fmplayer.loudness.LoudnessAnalyser
+            Measures played tracks, their gains are stored and applied the
+            next time they play
+        index : fmplayer.index.QueueIndex
+            Index of the upcoming queue, entries it has found unplayable are
+            skipped
+        watchdog : fmplayer.watchdog.Watchdog
+            Recovers tracks which stall or overrun whilst playing
+        history : fmplayer.history.History
+            Records each track played
         """
 
         self.redis = redis
         self.player = player
         self.channel = channel
+        self.state = state or State()
+        self.queue = queue
+        self.processing = processing
+        self.profiler = profiler
+        self.detector = detector
+        self.codec = codec
+        self.stream = stream
+        self.stream_length = stream_length
+        self.loudness = loudness
+        self.index = index
+        self.watchdog = watchdog
+        self.history = history
+
+        # The track currently playing, saves reading it back on end
+        self.current = None
+
+        # When in ms and from which position the current track started
+        # playing, and whether it has been skipped, for its history record
+        self.started = None
+        self.skipped = False
 
-    def play(self, uri, user):
+    def play(self, uri, user, position=0):
         """ Handles the play event, this is called directly by the player
         queue watcher.
 
@@ -54,26 +146,126 @@ class EventHandler(object):
             The Spotify URI (spotify:track:1234)(
         user : str
             The User Primary Key
+        position : int
+            Offset in ms to start playing from, default 0
+
+        Returns
+        -------
+        bool
+            ``True`` if the track is playing
         """
 
-        # Publish the Play event - Just the URI needed
-        event = json.dumps({
+        # Publish the Play event and set the current track in one atomic
+        # round trip - current needs to hold the uri and user
+        self.current = {
+            'uri': uri,
+            'user': user
+        }
+        self.started = (int(time.time() * 1000), position)
+        self.skipped = False
+        event = {
             'event': 'play',
             'uri': uri,
             'user': user
-        })
+        }
 
-        self.redis.publish(self.channel, event)
+        # The stored gain is read in the same round trip
+        pipe = self.redis.pipeline()
+        self.publish(pipe, event)
+        self.state.write(pipe, current=self.current, position=position)
+        if self.loudness is not None:
+            pipe.hget(self.loudness.key, uri)
+        results = pipe.execute()
         logger.debug('Play Event: {0}'.format(event))
 
-        # Set the current track - needs to hold the uri and user
-        self.redis.set('fm:player:current', json.dumps({
-            'uri': uri,
-            'user': user
-        }))
+        if self.loudness is not None:
+            self.loudness.start(uri)
+            gain = results[-1]
+            self.player.set_gain(float(gain) if gain is not None else 0.0)
 
         # Start playing the track
-        self.player.play(uri)
+        return self.player.play(uri, position)
+
+    def publish(self, pipe, event):
+        """ Queues publishing an event to the channel, and appending it to the
+        stream if there is one, on the pipeline.
+
+        Arguments
+        ---------
+        pipe : redis.client.BasePipeline
+            The pipeline to queue the publish on
+        event : dict
+            The event, including the ``event`` name
+        """
+
+        payload = self.codec.encode(event)
+        pipe.publish(self.channel, payload)
+        if self.stream is not None:
+            append(pipe, self.stream, payload, self.stream_length)
+
+    def progress(self, position):
+        """ Stores the playback position and publishes a progress event, this
+        is called periodically by the progress watcher.
+
+        Arguments
+        ---------
+        position : int
+            Playback position of the current track in ms
+        """
+
+        pipe = self.redis.pipeline()
+        self.state.write(pipe, position=position)
+        self.publish(pipe, {
+            'event': 'progress',
+            'uri': self.current['uri'],
+            'position': position
+        })
+        pipe.execute()
+
+    def error(self, uri, user, reason):
+        """ Publishes an error event for a track which could not be played.
+
+        Arguments
+        ---------
+        uri : str
+            The Spotify URI
+        user : str
+            The User Primary Key
+        reason : str
+            Why the track could not be played
+        """
+
+        logger.warning('Unable to play {0}: {1}'.format(uri, reason))
+        if self.current is not None and self.current['uri'] == uri:
+            self.skipped = True
+        pipe = self.redis.pipeline()
+        self.publish(pipe, {
+            'event': 'error',
+            'uri': uri,
+            'user': user,
+            'reason': reason,
+        })
+        pipe.execute()
+
+    def bitrate_changed(self, kbps, reason):
+        """ Publishes a bitrate changed event, this is called by the bitrate
+        watcher when the adaptive bitrate steps.
+
+        Arguments
+        ---------
+        kbps : int
+            The new bitrate in kbps
+        reason : str
+            Why it changed, ``healthy``, ``behind`` or ``underrun``
+        """
+
+        pipe = self.redis.pipeline()
+        self.publish(pipe, {
+            'event': 'bitrate_changed',
+            'bitrate': kbps,
+            'reason': reason,
+        })
+        pipe.execute()
 
     def stop(self, data):
         """ Handles the stop event. This triggered when a track should be
@@ -81,22 +273,68 @@ class EventHandler(object):
         """
 
         logger.debug('Stop current track')
-        self.player.stop()
+        metrics.TRACKS_SKIPPED.inc()
+        self.skipped = True
+        self.player.stop(flush=True)
 
     def end(self, uri):
         """ Handles the end event. This is triggered directly by the queue
-        watcher.
+        watcher. State is updated and the event published in one atomic
+        ``MULTI`` round trip.
         """
 
-        logger.debug('Remove current track')
-        current = json.loads(self.redis.get('fm:player:current'))
-        self.redis.delete('fm:player:current')
-        logger.debug('Publish end event')
-        self.redis.publish(self.channel, json.dumps({
+        logger.debug('Remove current track and publish end event')
+        current, self.current = self.current, None
+        user = current['user'] if current else None
+        if self.history is not None and self.started is not None:
+            start, position = self.started
+            self.history.record(
+                uri,
+                user,
+                start,
+                int(time.time() * 1000),
+                max(0, self.player.position - position),
+                self.skipped)
+        self.started = None
+        pipe = self.redis.pipeline()
+        self.state.write(pipe, current=None, position=None)
+        if self.loudness is not None:
+            gain = self.loudness.finish(uri)
+            if gain is not None:
+                pipe.hset(self.loudness.key, uri, '{0:.2f}'.format(gain))
+        self.publish(pipe, {
             'event': 'end',
             'uri': uri,
-            'user': current['user']
-        }))
+            'user': user
+        })
+        pipe.execute()
+
+    def profiler_start(self, data):
+        """ Handles the profiler start admin event. Starts the sampling
+        profiler and hub blocking detector. The sample interval can be given
+        in ms as ``interval``.
+        """
+
+        if self.profiler is None:
+            logger.warning('Profiling is not enabled')
+            return
+
+        interval = data.get('interval')
+        self.profiler.start(interval / 1000.0 if interval else None)
+        if self.detector is not None:
+            self.detector.start()
+
+    def profiler_stop(self, data):
+        """ Handles the profiler stop admin event. Stops profiling and writes
+        the collapsed stacks to the profile directory.
+        """
+
+        if self.profiler is None:
+            return
+
+        if self.detector is not None:
+            self.detector.stop()
+        self.profiler.stop()
 
     def pause(self, data):
         """ Handles the pause event. Calls the ``pause`` method on the player.
@@ -104,7 +342,9 @@ class EventHandler(object):
         """
 
         self.player.pause()
-        self.redis.set('fm:player:paused', 1)
+        pipe = self.redis.pipeline()
+        self.state.write(pipe, paused=True)
+        pipe.execute()
 
     def resume(self, data):
         """ Handles the resume event. Calls the ``resume`` method on the player.
@@ -112,7 +352,9 @@ class EventHandler(object):
         """
 
         self.player.resume()
-        self.redis.set('fm:player:paused', 0)
+        pipe = self.redis.pipeline()
+        self.state.write(pipe, paused=False)
+        pipe.execute()
 
     def set_volume(self, data):
         """ Handles the volume set event. Sets the players volume and sets
@@ -121,13 +363,16 @@ class EventHandler(object):
 
         volume = data.get('volume')
         if volume is not None:
+            volume = int(round(volume))
             logger.debug('Set Volume: {0}'.format(volume))
             self.player.set_volume(volume)
-            self.redis.set('fm:player:volume', volume)
-            self.redis.publish(self.channel, json.dumps({
+            pipe = self.redis.pipeline()
+            self.state.write(pipe, volume=volume)
+            self.publish(pipe, {
                 'event': 'volume_changed',
                 'volume': volume
-            }))
+            })
+            pipe.execute()
 
     def set_mute(self, data):
         """ Handles the mute event. Sets the player mute state and also sets
@@ -138,16 +383,211 @@ class EventHandler(object):
         if mute is not None:
             logger.debug('Set Mute: {0}'.format(mute))
             self.player.set_mute(mute)
-            self.redis.set('fm:player:mute', int(mute))
-            self.redis.publish(self.channel, json.dumps({
+            pipe = self.redis.pipeline()
+            self.state.write(pipe, mute=mute)
+            self.publish(pipe, {
                 'event': 'mute_changed',
                 'mute': mute
-            }))
+            })
+            pipe.execute()
+
+
+class Dispatcher(object):
+    """ Runs event handlers away from the pubsub reading loop. Received events
+    are put onto a bounded queue, the dispatcher takes everything waiting on
+    the queue as a batch and collapses superseded events before running them,
+    e.g. of a burst of ``set_volume`` events only the last is handled and a
+    ``pause`` followed by a ``resume`` cancel out so neither is handled.
+
+    Events read from a stream carry their entry id, once a batch has been
+    handled the ids of the events handled or superseded are acknowledged.
+    """
+
+    def __init__(self, events, size=EVENT_QUEUE_SIZE, ack=None):
+        """ Initialises the dispatcher.
+
+        Arguments
+        ---------
+        events : dict
+            Maps event names to their handler functions
+        size : int
+            Max number of events waiting to be handled, default 256
+        ack : callable
+            Called with the stream ids of each handled batch
+        """
+
+        self.events = events
+        self.queue = gevent.queue.Queue(maxsize=size)
+        self.ack = ack
+
+        # Counters
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
 
+        # Queue depth at the start of the last batch and the highest seen
+        self.depth = 0
+        self.max_depth = 0
 
-def event_watcher(redis, player, handler):
+        for name, help in [
+                ('received', 'Events received'),
+                ('coalesced', 'Events superseded before being handled'),
+                ('dropped', 'Events dropped as the queue was full')]:
+            metrics.REGISTRY.collect(
+                'fmplayer_events_{0}_total'.format(name),
+                help,
+                lambda name=name: getattr(self, name),
+                kind='counter')
+        metrics.REGISTRY.collect(
+            'fmplayer_event_queue_depth',
+            'Events waiting at the start of the last batch',
+            lambda: self.depth)
+        metrics.REGISTRY.collect(
+            'fmplayer_event_queue_max_depth',
+            'Most events seen waiting at the start of a batch',
+            lambda: self.max_depth)
+
+    def put(self, event, data, id=None):
+        """ Queues an event to be handled. Events without a stream id never
+        block and are dropped if the queue is full, stream events wait for
+        space as the stream keeps the backlog.
+
+        Arguments
+        ---------
+        event : str
+            The event name
+        data : dict
+            The event data
+        id : str
+            The stream entry id, default None
+        """
+
+        self.received += 1
+        item = (event, data, time.time(), id)
+        if id is not None:
+            self.queue.put(item)
+            return
+
+        try:
+            self.queue.put_nowait(item)
+        except gevent.queue.Full:
+            self.dropped += 1
+            logger.warning('Event queue full, dropped: {0}'.format(event))
+
+    def batch(self):
+        """ Blocks until at least one event is waiting and then returns every
+        waiting event.
+
+        Returns
+        -------
+        list
+            ``(event, data, received, id)`` tuples in the order they were
+            received
+        """
+
+        items = [self.queue.get()]
+        self.depth = len(items) + self.queue.qsize()
+        self.max_depth = max(self.max_depth, self.depth)
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        return items
+
+    def coalesce(self, items):
+        """ Removes events superseded by a later event of the same group,
+        keeping the order of the remaining events. Groups which start and
+        end on a cancelling pair are removed altogether.
+
+        Arguments
+        ---------
+        items : list
+            ``(event, data, received, id)`` tuples in the order they were
+            received
+
+        Returns
+        -------
+        list
+            The events to handle
+        """
+
+        first = {}
+        last = {}
+        for i, item in enumerate(items):
+            event = item[0]
+            group = COALESCE_GROUPS.get(event)
+            if group is not None:
+                first.setdefault(group, i)
+                last[group] = i
+
+        cancelled = set(
+            group for group, pair in CANCELLING_PAIRS.items()
+            if group in last
+            and (items[first[group]][0], items[last[group]][0]) == pair)
+
+        keep = [
+            item for i, item in enumerate(items)
+            if COALESCE_GROUPS.get(item[0]) is None
+            or (COALESCE_GROUPS[item[0]] not in cancelled
+                and last[COALESCE_GROUPS[item[0]]] == i)]
+        self.coalesced += len(items) - len(keep)
+        return keep
+
+    def run(self):
+        """ Handles events forever, run this in its own greenlet.
+        """
+
+        while True:
+            items = self.batch()
+            failed = set()
+            for event, data, received, id in self.coalesce(items):
+                logger.debug('Fire: {0}'.format(event))
+                try:
+                    self.events[event](data)
+                except Exception:
+                    logger.exception('Handling {0} failed'.format(event))
+                    failed.add(id)
+                metrics.EVENT_LATENCY.time(received)
+
+            ids = [
+                item[3] for item in items
+                if item[3] is not None and item[3] not in failed]
+            if self.ack is not None and ids:
+                try:
+                    self.ack(ids)
+                except Exception:
+                    logger.exception('Acknowledging events failed')
+
+
+def handlers(handler):
+    """ Returns the handler functions of the events accepted from the
+    channel or stream.
+
+    Arguments
+    ---------
+    handler : EventHandler, obj
+        Event handler instance
+
+    Returns
+    -------
+    dict
+        Maps event names to their handler functions
+    """
+
+    return {
+        'pause': handler.pause,
+        'resume': handler.resume,
+        'stop': handler.stop,
+        'set_volume': handler.set_volume,
+        'set_mute': handler.set_mute,
+        'profiler_start': handler.profiler_start,
+        'profiler_stop': handler.profiler_stop,
+    }
+
+
+def event_watcher(redis, player, handler, stream=None):
     """ This method watches the Redis PubSub channel for events. Once a valid
-    event is fired it will execute the desired functionality for that event.
+    event is fired it is handed to a ``Dispatcher`` which will execute the
+    desired functionality for that event, so reading is never held up by
+    slow handlers.
 
     Arguments
     ---------
@@ -157,33 +597,94 @@ def event_watcher(redis, player, handler):
         The Spotify player instance
     hadnler : str
         The event handler instance
+    stream : fmplayer.streams.EventStream
+        Read events from this stream rather than the channel
     """
 
+    if stream is not None:
+        return stream_watcher(redis, handler, stream)
+
     logger.info('Starting Redis Event Loop')
 
     pubsub = redis.pubsub()
     pubsub.subscribe(handler.channel)
 
-    events = {
-        'pause': handler.pause,
-        'resume': handler.resume,
-        'stop': handler.stop,
-        'set_volume': handler.set_volume,
-        'set_mute': handler.set_mute,
-    }
+    events = handlers(handler)
+    dispatcher = Dispatcher(events)
+    running = gevent.spawn(dispatcher.run)
 
-    for item in pubsub.listen():
-        logger.debug('Got Event: {0}'.format(item))
-        if item.get('type') == 'message':
-            data = json.loads(item.get('data'))
-            event = data.pop('event')
-            if event in events:
-                logger.debug('Fire: {0}'.format(event))
-                function = events.get(event)
-                function(data)
+    try:
+        for item in pubsub.listen():
+            logger.debug('Got Event: {0}'.format(item))
+            if item.get('type') == 'message':
+                try:
+                    event, data = decode_event(item.get('data'))
+                except InvalidMessage as e:
+                    metrics.INVALID_MESSAGES.inc()
+                    logger.warning('Invalid Event: {0}'.format(e))
+                    continue
+                if event in events:
+                    dispatcher.put(event, data)
+    finally:
+        running.kill()
+        pubsub.close()
 
 
-def queue_watcher(redis, handler):
+def stream_watcher(redis, handler, stream):
+    """ Reads events from a Redis Stream through its consumer group and
+    hands them to a ``Dispatcher``, which acknowledges them once handled.
+    Entries left pending by a previous run are replayed first.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    handler : EventHandler, obj
+        Event handler instance
+    stream : fmplayer.streams.EventStream
+        The stream to read
+    """
+
+    logger.info('Starting Redis Stream Event Loop on {0}'.format(stream.key))
+
+    stream.create()
+    stream.claim()
+
+    events = handlers(handler)
+    dispatcher = Dispatcher(events, ack=stream.ack)
+    running = gevent.spawn(dispatcher.run)
+
+    # Pending entries are read from the start until none are left, then
+    # only new entries
+    last = '0'
+    try:
+        while True:
+            entries = stream.read(last)
+            if last != '>':
+                last = entries[-1][0] if entries else '>'
+
+            skipped = []
+            for id, raw in entries:
+                if raw is None:
+                    skipped.append(id)
+                    continue
+                try:
+                    event, data = decode_event(raw)
+                except InvalidMessage as e:
+                    metrics.INVALID_MESSAGES.inc()
+                    logger.warning('Invalid Event: {0}'.format(e))
+                    skipped.append(id)
+                    continue
+                if event in events:
+                    dispatcher.put(event, data, id)
+                else:
+                    skipped.append(id)
+            stream.ack(skipped)
+    finally:
+        running.kill()
+
+
+def queue_watcher(redis, handler, mode='blocking', lease=None):
     """ This method watches the playlist queue for tracks, once the queue has
     a track the player will be told to play the track, this will cause the
     method to block until the track has completed playing the track. Once the
@@ -191,33 +692,417 @@ def queue_watcher(redis, handler):
 
     Arguments
     ---------
-    redis : EventHandler, obj
+    redis : obj
+        Redis connection instance
+    handler : EventHandler, obj
+        Event handler instance
+    mode : str
+        ``blocking`` (default) to block on the server with ``BLMOVE`` into
+        the processing list, ``poll`` for the legacy ``LLEN`` / ``LPOP`` loop
+    lease : fmplayer.lease.Lease
+        When running with a standby, the leader lease every pop is fenced
+        with, only supported in ``blocking`` mode
+    """
+
+    if mode == 'poll':
+        return poll_queue(redis, handler)
+
+    recover(redis, handler)
+
+    logger.info('Watching Playlist')
+
+    while True:
+        raw = execute_blocking(
+            redis,
+            'BLMOVE',
+            handler.queue,
+            handler.processing,
+            'LEFT',
+            'RIGHT',
+            BLOCK_TIMEOUT)
+        if raw is None:
+            continue
+        if lease is not None and not lease.fence(handler.queue, handler.processing, raw):
+            logger.warning('Popped track without the lease, returned to queue')
+            return
+        play_entry(redis, handler, raw)
+
+
+def failover_watcher(redis, handler, lease, interval=None,
+                     progress=PROGRESS_INTERVAL, stream=None):
+    """ Runs the player as one of an active and hot standby pair. Whilst on
+    standby the Spotify session stays logged in and the mixer open, once the
+    lease is acquired the event and queue watchers start, recovering any
+    track the previous leader left in the processing list. If the lease is
+    lost the watchers are stopped and the node goes back to standby.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    handler : EventHandler, obj
+        Event handler instance
+    lease : fmplayer.lease.Lease
+        The leader lease
+    interval : float
+        Seconds between lease renewals and acquisition attempts, default a
+        third of the lease ttl
+    progress : float
+        Seconds between playback position updates, default 5
+    stream : fmplayer.streams.EventStream
+        Read events from this stream rather than the channel
+    """
+
+    if interval is None:
+        interval = lease.ttl / 3000.0
+
+    while True:
+        logger.info('Standing by for lease {0}'.format(lease.key))
+        while not lease.acquire():
+            gevent.sleep(interval)
+
+        if lease.seen_renewed is not None:
+            took = time.time() - lease.seen_renewed
+            metrics.FAILOVER.observe(took)
+            logger.info('Took over from previous leader in {0:.3f}s'.format(took))
+        lease.seen_renewed = None
+
+        restore(redis, handler)
+        watchers = [
+            gevent.spawn(
+                event_watcher, redis, handler.player, handler, stream),
+            gevent.spawn(queue_watcher, redis, handler, 'blocking', lease),
+            gevent.spawn(progress_watcher, handler, progress),
+        ]
+        if handler.index is not None:
+            watchers.append(gevent.spawn(index_watcher, redis, handler))
+
+        while lease.renew() and not any(w.ready() for w in watchers):
+            gevent.sleep(interval)
+
+        logger.warning('Leaving leadership, stopping watchers')
+        gevent.killall(watchers)
+        handler.player.stop(flush=True)
+        lease.release()
+
+
+def restore(redis, handler, state=None):
+    """ Applies the last stored volume and mute state to the player, falling
+    back to the defaults.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    handler : EventHandler, obj
+        Event handler instance
+    state : dict, optional
+        State already read at startup, read from Redis if not given
+    """
+
+    if state is None:
+        state = handler.state.read(redis)
+    volume = state.get('volume')
+    handler.set_volume({'volume': volume if volume is not None else DEFAULT_VOLUME})
+    handler.set_mute({'mute': state.get('mute') or False})
+
+
+def recover(redis, handler):
+    """ Plays anything left in the processing list by a previous run, this
+    happens when the player dies between popping a track and finishing it.
+    Entries are played in the order they were popped.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    handler : EventHandler, obj
+        Event handler instance
+    """
+
+    # The stored position belongs to the track which was playing, the first
+    # entry in the processing list
+    state = handler.state.read(redis)
+    current = state['current']
+
+    for raw in redis.lrange(handler.processing, 0, -1):
+        try:
+            uri = decode_entry(raw)['uri']
+        except InvalidMessage as e:
+            metrics.INVALID_MESSAGES.inc()
+            logger.error('Dropping invalid processing entry: {0}'.format(e))
+            redis.lrem(handler.processing, 1, raw)
+            current = None
+            continue
+
+        position = 0
+        if current is not None and current['uri'] == uri:
+            position = state['position'] or 0
+        current = None
+
+        logger.info('Recovering track from processing list at {0}ms'.format(position))
+        play_entry(redis, handler, raw, position)
+
+
+def play_entry(redis, handler, raw, position=0):
+    """ Plays a single queue entry which has already been moved onto the
+    processing list, blocking until the track has finished. The entry is only
+    removed from the processing list once the end event has been handled.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    handler : EventHandler, obj
+        Event handler instance
+    raw : str
+        The raw queue entry as stored in Redis
+    position : int
+        Offset in ms to start playing from, default 0
+    """
+
+    popped = time.time()
+    try:
+        data = decode_entry(raw)
+    except InvalidMessage as e:
+        metrics.INVALID_MESSAGES.inc()
+        logger.error('Dropping invalid queue entry: {0}'.format(e))
+        redis.lrem(handler.processing, 1, raw)
+        return
+    uri = data['uri']
+    user = data['user']
+    logger.debug('Track popped of list: {0}'.format(uri))
+    if handler.index is not None and handler.index.unplayable(uri):
+        metrics.TRACKS_FAILED.inc()
+        handler.error(uri, user, 'unplayable')
+        redis.lrem(handler.processing, 1, raw)
+        return
+    if not handler.play(uri, user, position):
+        handler.error(uri, user, 'failed')
+    metrics.QUEUE_POP_TO_PLAY.time(popped)
+    prefetcher = gevent.spawn(prefetch_watcher, redis, handler)
+    logger.debug('Waiting for {0} to Finish'.format(uri))
+    try:
+        if handler.watchdog is not None:
+            handler.watchdog.wait(handler, uri, user)
+        else:
+            handler.player.stopped.wait()
+    finally:
+        prefetcher.kill()
+    logger.debug('Fire end event')
+    handler.end(uri)
+    redis.lrem(handler.processing, 1, raw)
+
+
+def progress_watcher(handler, interval=PROGRESS_INTERVAL):
+    """ Periodically stores the playback position and publishes it as a
+    ``progress`` event, batching position updates rather than writing on
+    every audio delivery. Nothing is written whilst the position is not
+    moving, e.g. when paused or between tracks.
+
+    Arguments
+    ---------
+    handler : EventHandler, obj
+        Event handler instance
+    interval : float
+        Seconds between updates, default 5
+    """
+
+    last = None
+    while True:
+        gevent.sleep(interval)
+        if handler.current is None:
+            continue
+        position = handler.player.position
+        if position != last:
+            last = position
+            handler.progress(position)
+
+
+def bitrate_watcher(handler, controller, interval=BITRATE_INTERVAL):
+    """ Periodically checks delivery health with the bitrate controller and
+    publishes any change of bitrate.
+
+    Arguments
+    ---------
+    handler : EventHandler, obj
+        Event handler instance
+    controller : fmplayer.bitrate.BitrateController
+        The bitrate controller
+    interval : float
+        Seconds between checks, default 2
+    """
+
+    while True:
+        gevent.sleep(interval)
+        reason = controller.update()
+        if reason is not None:
+            handler.bitrate_changed(controller.kbps, reason)
+
+
+def index_watcher(redis, handler, interval=INDEX_INTERVAL):
+    """ Keeps the index of the upcoming queue up to date.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    handler : EventHandler, obj
+        Event handler instance, with an index
+    interval : float
+        Seconds between checking the queue for changes, default 2
+    """
+
+    logger.info('Indexing Playlist into {0}'.format(handler.index.key))
+
+    while True:
+        try:
+            handler.index.update(redis)
+        except Exception:
+            logger.exception('Updating the queue index failed')
+        gevent.sleep(interval)
+
+
+def history_watcher(handler, interval=FLUSH_INTERVAL):
+    """ Flushes play history records periodically, or as soon as a batch is
+    waiting. First checks the server has streams, turning the history off if
+    not.
+
+    Arguments
+    ---------
+    handler : EventHandler, obj
+        Event handler instance, with a history
+    interval : float
+        Seconds between flushes, default 5
+    """
+
+    history = handler.history
+    while True:
+        try:
+            supported = history.supported()
+            break
+        except RedisError as e:
+            logger.debug('Unable to check for streams: {0}'.format(e))
+            gevent.sleep(interval)
+    if not supported:
+        handler.history = None
+        return
+
+    logger.info('Recording Play History into {0}'.format(history.key))
+
+    while True:
+        history.ready.wait(interval)
+        history.ready.clear()
+        try:
+            history.flush()
+        except Exception:
+            logger.exception('Flushing the play history failed')
+
+
+def warm_cache(player, history):
+    """ Warms the track cache from the tracks most recently played, read
+    from the play history. Nothing is warmed if the history can not be read.
+
+    Arguments
+    ---------
+    player : Player, obj
+        Player instance
+    history : fmplayer.history.History
+        The play history
+    """
+
+    player.tracks.warm(history.recent())
+
+
+def prefetch_watcher(redis, handler):
+    """ Whilst a track is playing peeks at the head of the playlist and has
+    the player prefetch it, so it is ready to go as soon as the current track
+    ends. The head is checked again periodically as tracks can be queued at
+    any time.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    handler : EventHandler, obj
+        Event handler instance
+    """
+
+    while True:
+        prefetch(redis, handler, handler.queue)
+        gevent.sleep(PREFETCH_INTERVAL)
+
+
+def prefetch(redis, handler, *keys):
+    """ Has the player prefetch the entry at the head of the first of the
+    given lists which is not empty.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    handler : EventHandler, obj
+        Event handler instance
+    keys : str
+        List keys to peek at in order
+
+    Returns
+    -------
+    str
+        The URI prefetched, None if the lists are empty
+    """
+
+    for key in keys:
+        raw = redis.lindex(key, 0)
+        if raw is None:
+            continue
+        try:
+            uri = decode_entry(raw)['uri']
+        except InvalidMessage:
+            return None
+        handler.player.prefetch(uri)
+        return uri
+    return None
+
+
+def poll_queue(redis, handler):
+    """ Legacy queue watcher, polls the playlist with ``LLEN`` and ``LPOP``.
+    Kept for Redis servers older than 6.2 which do not support ``BLMOVE``.
+
+    Arguments
+    ---------
+    redis : obj
         Redis connection instance
-    handler : str
+    handler : EventHandler, obj
         Event handler instance
     """
 
-    # If we have a track in current play that first before watching the
-    # playlist
-    current = redis.get('fm:player:current')
+    # If we have a track in current play that first, from where it was,
+    # before watching the playlist
+    state = handler.state.read(redis)
+    current = state['current']
     logger.debug(current)
     if current is not None:
         logger.info('Playing current track before watching playlist')
-        current = json.loads(current)
-        handler.play(current['uri'], current['user'])
-        STOP_EVENT.wait()
+        handler.play(current['uri'], current['user'], state['position'] or 0)
+        handler.player.stopped.wait()
+        handler.end(current['uri'])
 
     logger.info('Watching Playlist')
 
     while True:
-        if redis.llen(PLAYLIST_KEY) > 0:
-            data = json.loads(redis.lpop(PLAYLIST_KEY))
+        if redis.llen(handler.queue) > 0:
+            try:
+                data = decode_entry(redis.lpop(handler.queue))
+            except InvalidMessage as e:
+                logger.error('Dropping invalid queue entry: {0}'.format(e))
+                continue
             uri = data['uri']
             user = data['user']
             logger.debug('Track popped of list: {0}'.format(uri))
             handler.play(uri, user)
             logger.debug('Waiting for {0} to Finish'.format(uri))
-            STOP_EVENT.wait()
+            handler.player.stopped.wait()
             logger.debug('Fire end event')
             handler.end(uri)
 
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fmplayer.history
+================
+
+Play history. A record of each track played, who queued it, when it started
+and ended, how much of it played and whether it was skipped, is kept in
+memory and flushed in batches to a capped Redis stream. Plays are also
+counted in daily sorted sets so the most played tracks, overall, per user or
+the users playing a track, over a window of days can be read without
+scanning the stream. Records which can not be written whilst Redis is
+unavailable are kept in a local SQLite database until it is back. Streams
+need Redis 5 or later, on older servers the history is turned off.
+"""
+
+# Standard Libs
+import logging
+import os
+import sqlite3
+import time
+
+# Third Party Libs
+import gevent.event
+from redis.exceptions import RedisError, ResponseError
+
+# First Party Libs
+from fmplayer import metrics
+from fmplayer.codec import JSON, InvalidMessage, detect
+from fmplayer.streams import append
+
+
+logger = logging.getLogger('fmplayer')
+
+
+HISTORY_STREAM = 'fm:player:history'
+PLAYS_KEY = 'fm:player:plays'
+
+# Approximate max number of records kept in the stream
+HISTORY_LENGTH = 100000
+
+# How often in seconds records are flushed, and the number of records which
+# are flushed straight away
+FLUSH_INTERVAL = 5
+BATCH_SIZE = 50
+
+# Days the daily play counts are kept for
+RETENTION_DAYS = 90
+
+# Number of recent records read for warming the track cache
+RECENT_LENGTH = 200
+
+
+def day(ms):
+    """ Returns the UTC day of a time in ms as ``YYYYMMDD``.
+    """
+
+    return time.strftime('%Y%m%d', time.gmtime(ms / 1000))
+
+
+def plays_key(date, user=None, uri=None, prefix=PLAYS_KEY):
+    """ Returns the sorted set plays on a day are counted in. Tracks are
+    counted per day and per user per day, users are counted per track per
+    day.
+
+    Arguments
+    ---------
+    date : str
+        The day, ``YYYYMMDD``
+    user : str
+        Count the tracks played by this user
+    uri : str
+        Count the users who played this track
+    prefix : str
+        Key prefix, default ``fm:player:plays``
+    """
+
+    if user is not None:
+        return '{0}:{1}:user:{2}'.format(prefix, date, user)
+    if uri is not None:
+        return '{0}:{1}:track:{2}'.format(prefix, date, uri)
+    return '{0}:{1}'.format(prefix, date)
+
+
+def most_played(redis, days=7, user=None, uri=None, count=10, now=None,
+                prefix=PLAYS_KEY):
+    """ Returns the most played tracks over the last ``days`` days, including
+    today, overall or played by a user, or with a ``uri`` the users who have
+    played the track the most. Skipped plays are not counted. The daily sets
+    are summed on the server in one ``MULTI`` round trip.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    days : int
+        Number of days to count, default 7
+    user : str
+        Only count the tracks played by this user
+    uri : str
+        Count the users who played this track instead
+    count : int
+        Max number of results, default 10
+    now : float
+        Time the window ends, default now
+    prefix : str
+        Key prefix, default ``fm:player:plays``
+
+    Returns
+    -------
+    list
+        ``(uri, plays)`` tuples, or ``(user, plays)`` with a ``uri``, most
+        played first
+    """
+
+    end = int((now or time.time()) * 1000)
+    keys = [plays_key(day(end - i * 86400000), user, uri, prefix)
+            for i in range(days)]
+
+    dest = '{0}:query'.format(prefix)
+    pipe = redis.pipeline()
+    pipe.zunionstore(dest, keys)
+    pipe.zrevrange(dest, 0, count - 1, withscores=True)
+    pipe.delete(dest)
+    return [(member, int(plays)) for member, plays in pipe.execute()[1]]
+
+
+class Backlog(object):
+    """ Local SQLite table of encoded records waiting to be written to Redis,
+    kept in memory if no path is given. Records are taken oldest first.
+    """
+
+    def __init__(self, path=None):
+        """ Initialises the backlog, the database is opened when first used.
+
+        Arguments
+        ---------
+        path : str
+            SQLite database file, default in memory
+        """
+
+        self.path = path
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            path = self.path or ':memory:'
+            if self.path is not None:
+                directory = os.path.dirname(self.path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+            self.db = sqlite3.connect(path)
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS history ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, record BLOB NOT NULL)')
+            self.db.commit()
+        return self.db
+
+    def __len__(self):
+        # Nothing is opened, or created, until there is a backlog to count
+        if self.db is None and (
+                self.path is None or not os.path.exists(self.path)):
+            return 0
+        return self.connect().execute(
+            'SELECT COUNT(*) FROM history').fetchone()[0]
+
+    def put(self, payloads):
+        """ Adds encoded records to the end of the backlog.
+        """
+
+        db = self.connect()
+        db.executemany(
+            'INSERT INTO history (record) VALUES (?)',
+            [(sqlite3.Binary(payload if isinstance(payload, bytes)
+                             else payload.encode('utf-8')), )
+             for payload in payloads])
+        db.commit()
+
+    def take(self, count):
+        """ Returns up to ``count`` of the oldest ``(id, payload)`` records,
+        they are kept until removed.
+        """
+
+        rows = self.connect().execute(
+            'SELECT id, record FROM history ORDER BY id LIMIT ?', (count, ))
+        return [(id, bytes(record)) for id, record in rows]
+
+    def remove(self, ids):
+        """ Removes records once they have been written.
+        """
+
+        db = self.connect()
+        db.executemany(
+            'DELETE FROM history WHERE id = ?',
+            [(id, ) for id in ids])
+        db.commit()
+
+
+class History(object):
+    """ Buffers play records and writes them in batches. Each batch is
+    appended to the stream, and the plays not skipped counted, in one
+    pipelined round trip. Whilst anything is in the backlog new records join
+    the end of it so records reach the stream in the order they were played.
+    """
+
+    def __init__(self, redis, key=HISTORY_STREAM, length=HISTORY_LENGTH,
+                 path=None, batch_size=BATCH_SIZE, codec=JSON,
+                 prefix=PLAYS_KEY):
+        """ Initialises the history, nothing is read or written.
+
+        Arguments
+        ---------
+        redis : obj
+            Redis connection instance
+        key : str
+            The capped stream records are appended to, default
+            ``fm:player:history``
+        length : int
+            Approximate max number of records kept in the stream
+        path : str
+            SQLite database records are kept in whilst Redis is
+            unavailable, default in memory
+        batch_size : int
+            Max number of records written in one round trip, a full batch
+            is flushed straight away, default 50
+        codec : obj
+            Codec records are encoded with, default JSON
+        prefix : str
+            Prefix of the daily play count keys, default ``fm:player:plays``
+        """
+
+        self.redis = redis
+        self.key = key
+        self.length = length
+        self.backlog = Backlog(path)
+        self.batch_size = batch_size
+        self.codec = codec
+        self.prefix = prefix
+
+        # Encoded records not yet written and set once a batch is waiting
+        self.pending = []
+        self.ready = gevent.event.Event()
+
+        # Set whilst writes are failing, so an outage is only logged once
+        self.failing = False
+
+        metrics.REGISTRY.collect(
+            'fmplayer_history_pending',
+            'Play records waiting to be written, including the backlog',
+            lambda: len(self.pending) + len(self.backlog))
+
+    def record(self, uri, user, start, end, played, skipped):
+        """ Adds a play record, it is written on the next flush.
+
+        Arguments
+        ---------
+        uri : str
+            The Spotify URI played
+        user : str
+            The User Primary Key who queued it
+        start : int
+            Time in ms the track started playing
+        end : int
+            Time in ms the track ended
+        played : int
+            Ms of the track played
+        skipped : bool
+            ``True`` if the track was stopped before it ended
+        """
+
+        self.pending.append(self.codec.encode({
+            'uri': uri,
+            'user': user,
+            'start': start,
+            'end': end,
+            'played': played,
+            'skipped': skipped,
+        }))
+        if len(self.pending) >= self.batch_size:
+            self.ready.set()
+
+    def write(self, payloads):
+        """ Appends encoded records to the stream and counts the plays in a
+        single round trip.
+        """
+
+        expires = RETENTION_DAYS * 86400
+        pipe = self.redis.pipeline(transaction=False)
+        for payload in payloads:
+            append(pipe, self.key, payload, self.length)
+            try:
+                record = detect(payload).decode(payload)
+            except (InvalidMessage, ValueError):
+                logger.error('Not counting invalid play record')
+                continue
+            if record.get('skipped'):
+                continue
+
+            date = day(record['start'])
+            uri, user = record['uri'], record.get('user')
+            counts = [(plays_key(date, prefix=self.prefix), uri),
+                      (plays_key(date, uri=uri, prefix=self.prefix), user)]
+            if user is not None:
+                counts.append(
+                    (plays_key(date, user=user, prefix=self.prefix), uri))
+            for key, member in counts:
+                if member is None:
+                    continue
+                pipe.zincrby(key, member, 1)
+                pipe.expire(key, expires)
+        pipe.execute()
+
+    def flush(self):
+        """ Writes the pending records and then the backlog, in batches.
+        Records which can not be written are added to the backlog.
+
+        Returns
+        -------
+        int
+            Number of records written
+        """
+
+        payloads, self.pending = self.pending, []
+        if len(self.backlog):
+            self.backlog.put(payloads)
+            payloads = []
+
+        written = 0
+        for offset in range(0, len(payloads), self.batch_size):
+            batch = payloads[offset:offset + self.batch_size]
+            try:
+                self.write(batch)
+            except RedisError as e:
+                self.failed(e)
+                self.backlog.put(payloads[offset:])
+                return written
+            written += len(batch)
+
+        while True:
+            rows = self.backlog.take(self.batch_size)
+            if not rows:
+                break
+            try:
+                self.write([payload for id, payload in rows])
+            except RedisError as e:
+                self.failed(e)
+                return written
+            self.backlog.remove([id for id, payload in rows])
+            written += len(rows)
+
+        if self.failing:
+            self.failing = False
+            logger.info('Play history written, backlog cleared')
+        return written
+
+    def failed(self, error):
+        if not self.failing:
+            self.failing = True
+            logger.warning('Unable to write play history, keeping records '
+                           'locally until Redis is available: {0}'.format(
+                               error))
+
+    def supported(self):
+        """ Returns whether the server can keep the history stream, Redis 5
+        or later. Errors other than the stream commands being refused are
+        raised, as the server could not be asked.
+        """
+
+        try:
+            self.redis.execute_command('XLEN', self.key)
+        except ResponseError as e:
+            logger.warning('Play history turned off, the {0} stream can not '
+                           'be used: {1}'.format(self.key, e))
+            return False
+        return True
+
+    def recent(self, count=RECENT_LENGTH):
+        """ Returns the unique URIs of the most recent records in the stream,
+        ordered least to most recently played, for warming the track cache.
+        Nothing is returned if the stream can not be read.
+
+        Arguments
+        ---------
+        count : int
+            Number of records read, default 200
+
+        Returns
+        -------
+        list
+            Spotify URIs
+        """
+
+        try:
+            reply = self.redis.execute_command(
+                'XREVRANGE', self.key, '+', '-', 'COUNT', count)
+        except RedisError as e:
+            logger.warning('Unable to read the play history: {0}'.format(e))
+            return []
+
+        uris = []
+        for id, fields in reversed(reply or []):
+            fields = dict(zip(fields[::2], fields[1::2]))
+            payload = fields.get(b'data', fields.get('data'))
+            try:
+                uri = detect(payload).decode(payload)['uri']
+            except (InvalidMessage, ValueError, KeyError, TypeError):
+                continue
+            if uri in uris:
+                uris.remove(uri)
+            uris.append(uri)
+        return uris
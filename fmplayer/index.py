@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fmplayer.index
+==============
+
+Index of the upcoming playlist queue. The head of the queue is read in one
+``LRANGE``, entries not seen before are resolved concurrently through the
+track cache, and the duration, start time ETA and whether each entry is
+playable are written to Redis for the API and frontend.
+"""
+
+# Standard Libs
+import logging
+import time
+
+# Third Party Libs
+import gevent.pool
+import spotify
+
+# First Party Libs
+from fmplayer.codec import JSON, InvalidMessage, decode_entry
+
+
+logger = logging.getLogger('fmplayer')
+
+
+# Number of queue entries indexed
+INDEX_SIZE = 50
+
+# libspotify errors which mean a track will never play, others may pass
+UNPLAYABLE_ERRORS = (
+    spotify.ErrorType.TRACK_NOT_PLAYABLE,
+    spotify.ErrorType.OTHER_PERMANENT,
+)
+
+# Max number of tracks resolved at once
+CONCURRENCY = 10
+
+# How often in seconds the queue is checked for changes
+INDEX_INTERVAL = 2
+
+# Drift in ms of the ETAs from those last written before they are rewritten
+MAX_DRIFT = 1000
+
+
+class QueueIndex(object):
+    """ Keeps the index of the head of the queue. Each update only resolves
+    entries pushed since the last, resolutions are kept for as long as the
+    entry is in the index, and the index is only written when its entries
+    change or its ETAs drift, e.g. after a skip or pause.
+
+    The index is written as a map with ``updated``, the time in ms it was
+    written, and ``entries``, a list of ``[uri, duration, eta, unplayable]``
+    in queue order, ``duration`` in ms and ``eta`` the time in ms the entry
+    is expected to start.
+    """
+
+    def __init__(self, player, queue, key=None, size=INDEX_SIZE,
+                 concurrency=CONCURRENCY, codec=JSON):
+        """ Initialises the index, nothing is read until the first update.
+
+        Arguments
+        ---------
+        player : fmplayer.player.Player
+            The player, its track cache resolves entries
+        queue : str
+            The playlist queue key
+        key : str
+            Key the index is written to, default ``<queue>:index``
+        size : int
+            Number of queue entries indexed, default 50
+        concurrency : int
+            Max number of tracks resolved at once, default 10
+        codec : obj
+            Codec the index is encoded with, default JSON
+        """
+
+        self.player = player
+        self.queue = queue
+        self.key = key or '{0}:index'.format(queue)
+        self.size = size
+        self.pool = gevent.pool.Pool(concurrency)
+        self.codec = codec
+
+        # Raw entries last read and the resolved (duration, unplayable) of
+        # each URI in them
+        self.raw = []
+        self.resolved = {}
+
+        # First ETA last written, None if nothing has been written
+        self.written = None
+
+    def resolve(self, uri):
+        """ Resolves a URI to its duration in ms and whether it is playable.
+        Only invalid URIs, unavailable tracks and errors which mean the track
+        will never play are unplayable. Timeouts and other errors are not
+        cached so the URI is tried again on the next update.
+
+        Returns
+        -------
+        tuple
+            ``(duration, unplayable)``
+        """
+
+        try:
+            track = self.player.tracks.get(uri)
+        except spotify.Timeout:
+            logger.warning('Timed out resolving {0}'.format(uri))
+            return None
+        except ValueError as e:
+            logger.warning('Unplayable queue entry {0}: {1}'.format(uri, e))
+            return (0, True)
+        except spotify.Error as e:
+            if getattr(e, 'error_type', None) in UNPLAYABLE_ERRORS:
+                logger.warning('Unplayable queue entry {0}: {1}'.format(uri, e))
+                return (0, True)
+            logger.warning('Unable to resolve {0}: {1}'.format(uri, e))
+            return None
+
+        available = track.availability == spotify.TrackAvailability.AVAILABLE
+        return (track.duration or 0, not available)
+
+    def uri(self, raw):
+        """ Returns the URI of a raw entry, None if it is invalid.
+        """
+
+        try:
+            return decode_entry(raw)['uri']
+        except InvalidMessage:
+            return None
+
+    def unplayable(self, uri):
+        """ Returns ``True`` if the URI has been found to be unplayable.
+        """
+
+        resolved = self.resolved.get(uri)
+        return resolved is not None and resolved[1]
+
+    def update(self, redis):
+        """ Reads the head of the queue, resolves entries not seen before and
+        writes the index if it has changed.
+
+        Arguments
+        ---------
+        redis : obj
+            Redis connection instance
+
+        Returns
+        -------
+        bool
+            ``True`` if the index was written
+        """
+
+        raw = redis.lrange(self.queue, 0, self.size - 1)
+        changed = raw != self.raw
+        if changed:
+            self.raw = raw
+            uris = set(self.uri(entry) for entry in raw)
+            for uri in set(self.resolved) - uris:
+                del self.resolved[uri]
+            new = [uri for uri in uris
+                   if uri is not None and uri not in self.resolved]
+            for uri, resolved in zip(new, self.pool.imap(self.resolve, new)):
+                if resolved is not None:
+                    self.resolved[uri] = resolved
+
+        entries = self.entries()
+        first = entries[0][2] if entries else None
+        if not changed and (first is None or self.written is None or
+                            abs(first - self.written) < MAX_DRIFT):
+            return False
+
+        redis.set(self.key, self.codec.encode({
+            'updated': int(time.time() * 1000),
+            'entries': entries,
+        }))
+        self.written = first
+        return True
+
+    def entries(self):
+        """ Returns the index entries, the ETA of the first entry is when the
+        track playing is expected to end.
+        """
+
+        now = int(time.time() * 1000)
+        eta = now
+        player = self.player
+        if not player.stopped.is_set() and player.duration:
+            eta += max(0, player.duration - player.position)
+
+        entries = []
+        for raw in self.raw:
+            uri = self.uri(raw)
+            duration, unplayable = self.resolved.get(uri, (None, uri is None))
+            entries.append([uri, duration, eta, unplayable])
+            if not unplayable:
+                eta += duration or 0
+        return entries
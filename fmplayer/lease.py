@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fmplayer.lease
+==============
+
+Renewable leader lease in Redis for running an active and a hot standby
+player. Each acquisition takes a new fencing token from an ever increasing
+counter, queue pops are checked against the token so a node which has lost
+the lease can never keep a track it popped.
+"""
+
+# Standard Libs
+import logging
+import socket
+import time
+
+
+logger = logging.getLogger('fmplayer')
+
+
+LEASE_KEY = 'fm:player:lease'
+
+# Takes the lease if it is free, returning the new fencing token
+ACQUIRE = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return nil
+end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], ARGV[1] .. ':' .. token, 'PX', ARGV[2])
+return token
+"""
+
+# Extends the lease if it is still held with the given value
+RENEW = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Deletes the lease if it is still held with the given value
+RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Checks an entry just moved onto the processing list was popped under the
+# current lease, if not it is put back on the head of the queue
+FENCE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return 1
+end
+if redis.call('LREM', KEYS[3], -1, ARGV[2]) == 1 then
+    redis.call('LPUSH', KEYS[2], ARGV[2])
+end
+return 0
+"""
+
+
+class Lease(object):
+    """ A leader lease held by one node at a time. The holder must renew it
+    within ``ttl`` milliseconds or another node may take it.
+    """
+
+    def __init__(self, redis, name=None, key=LEASE_KEY, ttl=3000):
+        """ Initialises the lease, nothing is acquired.
+
+        Arguments
+        ---------
+        redis : obj
+            Redis connection instance
+        name : str
+            This node's name, default the host name
+        key : str
+            The lease key, the fencing counter is kept in ``key:fence``,
+            default ``fm:player:lease``
+        ttl : int
+            Milliseconds the lease lasts without renewal, default 3000
+        """
+
+        self.redis = redis
+        self.name = name or socket.gethostname()
+        self.key = key
+        self.fence_key = '{0}:fence'.format(key)
+        self.ttl = ttl
+
+        # Fencing token and lease value whilst held
+        self.token = None
+        self.value = None
+
+        # When the lease held by another node was last known to be renewed
+        self.seen_renewed = None
+
+        self._acquire = redis.register_script(ACQUIRE)
+        self._renew = redis.register_script(RENEW)
+        self._release = redis.register_script(RELEASE)
+        self._fence = redis.register_script(FENCE)
+
+    @property
+    def held(self):
+        return self.token is not None
+
+    def acquire(self):
+        """ Takes the lease if no other node holds it.
+
+        Returns
+        -------
+        bool
+            ``True`` if the lease was acquired
+        """
+
+        token = self._acquire(
+            keys=[self.key, self.fence_key],
+            args=[self.name, self.ttl])
+        if token is None:
+            remaining = self.redis.pttl(self.key)
+            if remaining is not None and remaining > 0:
+                self.seen_renewed = time.time() - (self.ttl - remaining) / 1000.0
+            return False
+
+        self.token = int(token)
+        self.value = '{0}:{1}'.format(self.name, self.token)
+        logger.info('Acquired lease {0} with token {1}'.format(
+            self.key,
+            self.token))
+        return True
+
+    def renew(self):
+        """ Extends the lease, if it has been lost it is no longer held.
+
+        Returns
+        -------
+        bool
+            ``True`` if the lease is still held
+        """
+
+        if not self.held:
+            return False
+
+        if not self._renew(keys=[self.key], args=[self.value, self.ttl]):
+            logger.warning('Lost lease {0} with token {1}'.format(
+                self.key,
+                self.token))
+            self.token = None
+            self.value = None
+            return False
+
+        return True
+
+    def release(self):
+        """ Gives up the lease so a standby can take over straight away.
+        """
+
+        if self.held:
+            self._release(keys=[self.key], args=[self.value])
+        self.token = None
+        self.value = None
+
+    def fence(self, queue, processing, raw):
+        """ Checks a queue entry moved onto the processing list was popped
+        whilst holding the lease, if not the entry is put back on the queue.
+
+        Arguments
+        ---------
+        queue : str
+            The playlist queue key
+        processing : str
+            The processing list key
+        raw : str
+            The raw queue entry
+
+        Returns
+        -------
+        bool
+            ``True`` if the entry may be played
+        """
+
+        return bool(self._fence(
+            keys=[self.key, queue, processing],
+            args=[self.value or '', raw]))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fmplayer.loudness
+=================
+
+Loudness analysis of delivered audio and per track gain. Frames are analysed
+as they are delivered in 400ms blocks with NumPy, at the end of a track the
+gated loudness, following ITU-R BS.1770 without the K-weighting filter, gives
+the gain which brings the track to the target loudness. Gains are kept in a
+Redis hash and applied the next time the track plays. Requires NumPy.
+"""
+
+# Standard Libs
+import logging
+
+# Third Party Libs
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# First Party Libs
+from fmplayer import metrics
+
+
+logger = logging.getLogger('fmplayer')
+
+
+GAINS_KEY = 'fm:player:gains'
+
+# Loudness tracks are brought to by default in LUFS
+TARGET = -14.0
+
+# Block length in seconds loudness is measured over
+BLOCK_SECONDS = 0.4
+
+# Absolute gate in LUFS and relative gate in LU below the ungated loudness,
+# quieter blocks do not count towards the track loudness
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+# Seconds of a track which must be analysed before its gain is stored
+MIN_SECONDS = 20
+
+# Limits of the stored gain in dB
+MAX_BOOST = 6.0
+MAX_CUT = -20.0
+
+# Full scale of 16 bit samples
+FULL_SCALE = 32768.0
+
+
+def available():
+    """ Returns whether loudness can be measured, it needs numpy.
+    """
+
+    return numpy is not None
+
+
+def lufs(power):
+    """ Returns the loudness in LUFS of a mean square power.
+    """
+
+    return -0.691 + 10 * numpy.log10(power)
+
+
+class LoudnessAnalyser(object):
+    """ Sink observer measuring the loudness of the track playing. The mean
+    square power of each whole block is computed in one vectorised pass per
+    delivery, samples left over are carried to the next delivery.
+    """
+
+    def __init__(self, player, target=TARGET, key=GAINS_KEY):
+        """ Initialises the analyser and registers it with the player's sink.
+
+        Arguments
+        ---------
+        player : fmplayer.player.Player
+            The player whose audio is analysed
+        target : float
+            Loudness to bring tracks to in LUFS, default -14
+        key : str
+            Redis hash gains are stored in, default ``fm:player:gains``
+        """
+
+        if numpy is None:
+            raise RuntimeError('numpy is not installed')
+
+        self.target = target
+        self.key = key
+
+        # Track being analysed, block powers so far and samples not yet
+        # making up a whole block
+        self.uri = None
+        self.powers = []
+        self.remainder = numpy.zeros(0, dtype=numpy.int16)
+        self.block = int(BLOCK_SECONDS * 44100)
+
+        # Loudness of the last whole block
+        self.momentary = None
+
+        metrics.REGISTRY.collect(
+            'fmplayer_loudness_lufs',
+            'Loudness of the last 400ms block analysed',
+            lambda: self.momentary or 0)
+
+        player.sink.observers.append(self.on_music_delivery)
+
+    def start(self, uri):
+        """ Starts analysing a new track.
+
+        Arguments
+        ---------
+        uri : str
+            The Spotify URI of the track
+        """
+
+        self.uri = uri
+        self.powers = []
+        self.remainder = numpy.zeros(0, dtype=numpy.int16)
+
+    def on_music_delivery(self, audio_format, frames, num_frames):
+        """ Sink observer, measures the power of each whole block delivered.
+        """
+
+        if num_frames == 0 or self.uri is None:
+            return
+
+        channels = audio_format.channels
+        self.block = int(BLOCK_SECONDS * audio_format.sample_rate)
+        samples = numpy.frombuffer(
+            frames, dtype='<i2', count=num_frames * channels)
+        if self.remainder.size:
+            samples = numpy.concatenate((self.remainder, samples))
+
+        size = self.block * channels
+        whole = samples.size // size * size
+        if whole:
+            blocks = samples[:whole].reshape(-1, size).astype(numpy.float32)
+            blocks *= 1 / FULL_SCALE
+
+            # Sum over the channels of each channel's mean square
+            powers = numpy.einsum('ij,ij->i', blocks, blocks) / self.block
+            self.powers.extend(powers.tolist())
+            self.momentary = float(lufs(max(powers[-1], 1e-10)))
+
+        self.remainder = samples[whole:].copy()
+
+    @property
+    def seconds(self):
+        return len(self.powers) * BLOCK_SECONDS
+
+    def loudness(self):
+        """ Returns the gated loudness in LUFS of the audio analysed so far,
+        None if it is all below the absolute gate.
+        """
+
+        powers = numpy.array(self.powers)
+        powers = powers[lufs(numpy.maximum(powers, 1e-10)) > ABSOLUTE_GATE]
+        if not powers.size:
+            return None
+
+        threshold = lufs(powers.mean()) + RELATIVE_GATE
+        powers = powers[lufs(powers) > threshold]
+        return float(lufs(powers.mean()))
+
+    def finish(self, uri):
+        """ Stops analysing the track and returns the gain which brings it to
+        the target loudness.
+
+        Arguments
+        ---------
+        uri : str
+            The Spotify URI of the track which ended
+
+        Returns
+        -------
+        float
+            Gain in dB, None if too little of the track was analysed
+        """
+
+        if uri != self.uri or self.seconds < MIN_SECONDS:
+            self.uri = None
+            return None
+
+        loudness = self.loudness()
+        self.uri = None
+        if loudness is None:
+            return None
+
+        gain = min(max(self.target - loudness, MAX_CUT), MAX_BOOST)
+        logger.debug('{0} loudness {1:.1f} LUFS, gain {2:.1f}dB'.format(
+            uri,
+            loudness,
+            gain))
+        return gain
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fmplayer.metrics
+================
+
+Lightweight counters, gauges and histograms for the playback pipeline.
+Metrics are exposed in the Prometheus text format over HTTP and can be
+periodically written to a Redis key as JSON.
+"""
+
+# Standard Libs
+import bisect
+import json
+import logging
+import time
+
+# Third Party Libs
+import gevent
+from gevent.pywsgi import WSGIServer
+from redis.exceptions import RedisError
+
+
+logger = logging.getLogger('fmplayer')
+
+# Default histogram buckets in seconds
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# Time the process started, startup phases are measured from here
+STARTED = time.time()
+
+
+class Counter(object):
+    """ A value which only ever goes up.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+
+class Gauge(object):
+    """ A value which can go up and down. If a function is given it is called
+    to get the value when the metrics are collected, this keeps counters
+    already held by other objects off the hot path.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, function=None, kind=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+        if kind is not None:
+            self.kind = kind
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [(self.name, value)]
+
+
+class Histogram(object):
+    """ Counts observations into fixed buckets, observing is a single
+    bisect and two additions.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self, start):
+        """ Observes the seconds elapsed since ``start``, a ``time.time()``.
+        """
+
+        self.observe(time.time() - start)
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf', ), self.counts):
+            total += count
+            samples.append(('{0}_bucket{{le="{1}"}}'.format(self.name, bound), total))
+        samples.append(('{0}_sum'.format(self.name), self.sum))
+        samples.append(('{0}_count'.format(self.name), self.count))
+        return samples
+
+
+class Registry(object):
+    """ Holds metrics by name, registering a name twice returns the metric
+    already registered.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self.register(Gauge(name, help))
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def collect(self, name, help, function, kind='gauge'):
+        """ Registers a function called at collection time to get a value,
+        replacing any function already registered under the name.
+        """
+
+        metric = Gauge(name, help, function, kind)
+        self.metrics[name] = metric
+        return metric
+
+    def render(self):
+        """ Returns every metric in the Prometheus text format.
+
+        Returns
+        -------
+        str
+            The metrics text
+        """
+
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append('# HELP {0} {1}'.format(name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(name, metric.kind))
+            for sample, value in metric.samples():
+                lines.append('{0} {1}'.format(sample, value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """ Returns every sample as a dict.
+
+        Returns
+        -------
+        dict
+            Sample names to values
+        """
+
+        snapshot = {}
+        for metric in self.metrics.values():
+            snapshot.update(metric.samples())
+        return snapshot
+
+
+REGISTRY = Registry()
+
+# Playback pipeline
+QUEUE_POP_TO_PLAY = REGISTRY.histogram(
+    'fmplayer_queue_pop_to_play_seconds',
+    'Time from a track being popped off the queue to it playing')
+TRACK_LOAD = REGISTRY.histogram(
+    'fmplayer_track_load_seconds',
+    'Time to resolve and load a track')
+FIRST_FRAME = REGISTRY.histogram(
+    'fmplayer_first_frame_seconds',
+    'Time from play to the first audio frame being delivered')
+TRACK_GAP = REGISTRY.histogram(
+    'fmplayer_track_gap_seconds',
+    'Silence between a track stopping and the next one playing')
+EVENT_LATENCY = REGISTRY.histogram(
+    'fmplayer_event_latency_seconds',
+    'Time from an event being received to it being handled')
+
+# Watchdog
+STALL_RECOVERY = REGISTRY.histogram(
+    'fmplayer_stall_recovery_seconds',
+    'Time from a track stalling to audio resuming or the track being skipped',
+    buckets=(.5, 1, 2.5, 5, 10, 20, 30, 60))
+
+# Startup
+STARTUP = REGISTRY.gauge(
+    'fmplayer_startup_seconds',
+    'Time from the process starting to being ready to play')
+FIRST_NOTE = REGISTRY.gauge(
+    'fmplayer_first_note_seconds',
+    'Time from the process starting to the first audio frame')
+
+# Failover
+FAILOVER = REGISTRY.histogram(
+    'fmplayer_failover_seconds',
+    'Time from the previous leader last renewing its lease to taking over')
+
+# Errors
+RELOGINS = REGISTRY.counter(
+    'fmplayer_relogins_total',
+    'Spotify relogins')
+CONNECTION_ERRORS = REGISTRY.counter(
+    'fmplayer_connection_errors_total',
+    'Spotify connection errors')
+TRACKS_SKIPPED = REGISTRY.counter(
+    'fmplayer_tracks_skipped_total',
+    'Tracks stopped before they finished')
+TRACKS_FAILED = REGISTRY.counter(
+    'fmplayer_tracks_failed_total',
+    'Tracks which could not be played')
+STALLS = REGISTRY.counter(
+    'fmplayer_stalls_total',
+    'Tracks which stopped delivering audio whilst playing')
+TRACK_OVERRUNS = REGISTRY.counter(
+    'fmplayer_track_overruns_total',
+    'Tracks stopped after playing past their duration or missing their end')
+INVALID_MESSAGES = REGISTRY.counter(
+    'fmplayer_invalid_messages_total',
+    'Events and queue entries rejected by validation')
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """ Serves the metrics in the Prometheus text format over HTTP, blocks
+    forever so run it in its own greenlet.
+
+    Arguments
+    ---------
+    port : int
+        Port to listen on
+    host : str
+        Address to listen on, default only the local host
+    registry : Registry
+        The metrics to serve, default the global registry
+    """
+
+    def application(environ, start_response):
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4')])
+        return [registry.render()]
+
+    logger.info('Serving metrics on {0}:{1}'.format(host, port))
+    WSGIServer((host, port), application, log=None).serve_forever()
+
+
+def snapshot_watcher(redis, key, interval=10, registry=REGISTRY):
+    """ Periodically writes a JSON snapshot of the metrics to a Redis key,
+    blocks forever so run it in its own greenlet. Failed writes are logged
+    and tried again with the next snapshot.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    key : str
+        Key to write the snapshot to
+    interval : int
+        Seconds between snapshots, default 10
+    registry : Registry
+        The metrics to write, default the global registry
+    """
+
+    while True:
+        gevent.sleep(interval)
+        snapshot = registry.snapshot()
+        snapshot['time'] = time.time()
+        try:
+            redis.set(key, json.dumps(snapshot))
+        except RedisError as e:
+            logger.warning('Unable to write metrics snapshot: {0}'.format(e))
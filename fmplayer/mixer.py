@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fmplayer.mixer
+==============
+
+Long lived ALSA mixer handle which follows changes made by other
+applications.
+"""
+
+# Standard Libs
+import logging
+import select
+import time
+
+# Third Party Libs
+import alsaaudio
+import gevent
+
+
+logger = logging.getLogger('fmplayer')
+
+# Seconds to wait before trying to reopen the mixer after an error
+REOPEN_DELAY = 1
+
+# Seconds after the player changes the mixer in which mixer events are taken
+# to be its own change rather than another application's
+OWN_CHANGE_WINDOW = 0.5
+
+
+class Mixer(object):
+    """ Holds a single ``alsaaudio.Mixer`` open rather than creating a new
+    one on every call. ``watch`` listens on the mixer poll descriptors so the
+    handle sees volume / mute changes made by other applications, the mixer
+    is only reopened after an error or, on pyalsaaudio releases without
+    ``handleevents``, a change made by another application.
+    """
+
+    def __init__(self, control='PCM', cardindex=0):
+        """ Initialises the mixer, the ALSA mixer is opened on first use.
+
+        Arguments
+        ---------
+        control : str
+            Mixer control name, default PCM
+        cardindex : int
+            Sound card index, default 0
+        """
+
+        self.control = control
+        self.cardindex = cardindex
+        self.mixer = None
+
+        # Handle the watcher polls when the mixer can not handle its events,
+        # it is reopened to clear them without touching the player's handle
+        self.watched = None
+
+        # Time the player last changed the mixer
+        self.changed_at = 0
+
+        # Number of external changes seen by the watcher
+        self.changes = 0
+
+    def get(self):
+        """ Returns the open mixer, opening it if needed.
+
+        Returns
+        -------
+        alsaaudio.Mixer
+            The mixer instance
+
+        Raises
+        ------
+        alsaaudio.ALSAAudioError
+            The mixer could not be opened
+        """
+
+        if self.mixer is None:
+            logger.debug('Opening Mixer: {0} on card {1}'.format(
+                self.control,
+                self.cardindex))
+            self.mixer = self.open()
+        return self.mixer
+
+    def open(self):
+        return alsaaudio.Mixer(control=self.control, cardindex=self.cardindex)
+
+    def changed(self):
+        """ Records the player changing the mixer, the events it causes are
+        not taken as changes by another application.
+        """
+
+        self.changed_at = time.time()
+
+    def reset(self):
+        """ Drops the open mixer so it is reopened on next use, called after
+        an error.
+        """
+
+        logger.debug('Resetting Mixer')
+        self.mixer = None
+        self.watched = None
+
+    def handles_events(self):
+        return hasattr(self.get(), 'handleevents')
+
+    def polled(self):
+        """ Returns the handle the watcher polls, the open mixer if it can
+        handle its events.
+        """
+
+        if self.handles_events():
+            return self.mixer
+        if self.watched is None:
+            self.watched = self.open()
+        return self.watched
+
+    def refresh(self):
+        """ Processes pending events on the open mixer so its cached values
+        reflect changes made by other applications. Older pyalsaaudio
+        releases have no ``handleevents``, the polled handle is reopened to
+        clear its events and the open mixer is only reopened if the change
+        was not the player's own.
+        """
+
+        if self.handles_events():
+            self.mixer.handleevents()
+            self.changes += 1
+            return
+
+        self.watched = None
+        if time.time() - self.changed_at < OWN_CHANGE_WINDOW:
+            logger.debug('Ignoring mixer event from own change')
+            return
+        self.mixer = None
+        self.changes += 1
+
+    def watch(self):
+        """ Blocks forever waiting on the mixer poll descriptors, refreshing
+        the mixer whenever another application changes it. Run this in its
+        own greenlet.
+        """
+
+        logger.info('Starting Mixer Watcher')
+
+        while True:
+            try:
+                fds = [fd for fd, mask in self.polled().polldescriptors()]
+                readable, _, _ = select.select(fds, [], [])
+                if readable:
+                    logger.debug('Mixer changed externally')
+                    self.refresh()
+            except (alsaaudio.ALSAAudioError, select.error) as e:
+                logger.debug('Mixer watch failed: {0}'.format(e))
+                self.reset()
+                gevent.sleep(REOPEN_DELAY)
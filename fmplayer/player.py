@@ -9,28 +9,134 @@ Classes and methods for running the Spotify player.
 """
 
 # Standard Libs
+import collections
+import functools
 import logging
+import os
 import threading
+import time
 
 # Third Party Libs
 import alsaaudio
 import spotify
 
 # First Party Libs
-from fmplayer.sinks import FakeSink
+from fmplayer import metrics
+from fmplayer.mixer import Mixer
+from fmplayer.sinks import (
+    AlsaSink,
+    FakeSink,
+    RingBufferSink,
+    SoftwareVolume,
+    volume_gain)
 
 
 logger = logging.getLogger('fmplayer')
 
-LOGGED_IN_EVENT = threading.Event()
-STOP_EVENT = threading.Event()
+
+class TrackCache(object):
+    """ Bounded LRU cache of loaded ``spotify.Track`` objects keyed by URI, so
+    frequently played tracks do not need their metadata resolving again.
+    """
+
+    def __init__(self, session, size=500, ttl=86400):
+        """ Initialises the cache.
+
+        Arguments
+        ---------
+        session : spotify.Session
+            The logged in Spotify session used to resolve tracks
+        size : int
+            Max number of tracks to hold, default 500
+        ttl : int
+            Seconds a track is held before being resolved again, default
+            86400, ``None`` to never expire
+        """
+
+        self.session = session
+        self.size = size
+        self.ttl = ttl
+        self.tracks = collections.OrderedDict()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __contains__(self, uri):
+        return uri in self.tracks
+
+    def get(self, uri):
+        """ Returns the loaded track for the URI, resolving and loading it
+        if it is not cached or has expired.
+
+        Arguments
+        ---------
+        uri : str
+            The Spotify URI - e.g: ``spotify:track:3Esqxo3D31RCjmdgwBPbOO``
+
+        Returns
+        -------
+        spotify.Track
+            The loaded track
+
+        Raises
+        ------
+        ValueError
+            The URI is not a valid track URI
+        spotify.Error
+            The track could not be loaded
+        """
+
+        entry = self.tracks.pop(uri, None)
+        if entry is not None:
+            track, loaded = entry
+            if self.ttl is None or time.time() - loaded < self.ttl:
+                self.tracks[uri] = entry  # Move to most recently used
+                self.hits += 1
+                return track
+
+        self.misses += 1
+        track = self.session.get_track(uri)
+        track.load()
+        self.tracks[uri] = (track, time.time())
+
+        while len(self.tracks) > self.size:
+            self.tracks.popitem(last=False)
+            self.evictions += 1
+
+        return track
+
+    def warm(self, uris):
+        """ Loads a list of URIs into the cache, used at boot to load recently
+        played tracks. URIs should be ordered least to most recently played.
+
+        Arguments
+        ---------
+        uris : list
+            Spotify URIs to load
+        """
+
+        logger.info('Warming track cache with {0} tracks'.format(len(uris)))
+        for uri in uris:
+            try:
+                self.get(uri)
+            except (ValueError, spotify.Error):
+                logger.warning('Unable to warm cache with {0}'.format(uri))
 
 
 class Player(object):
     """ Handles playing music from Spotify.
     """
 
-    def __init__(self, user, password, key, sink, mixer='PCM', min_vol=0, max_vol=100):
+    def __init__(self, user, password, key, sink, mixer='PCM', min_vol=0,
+                 max_vol=100, cache_size=500, cache_ttl=86400, card=0,
+                 buffer_seconds=2.0, audio_cache=None, audio_cache_size=0,
+                 credentials=None, block=True, bitrate=1,
+                 volume_control='mixer'):
         """ Initialises the Spotify Session, logs the user in and starts
         the session event loop. The player does not manage state, it simply
         cares about playing music.
@@ -51,14 +157,62 @@ class Player(object):
             Min volume level, default 0
         max_vol : int
             Max volume level, default 100
+        cache_size : int
+            Max number of resolved tracks to cache, default 500
+        cache_ttl : int
+            Seconds to cache resolved tracks for, default 86400
+        card : int
+            Sound card index of the mixer, default 0
+        buffer_seconds : float
+            Seconds of audio buffered by the ``ring`` sink, default 2.0
+        audio_cache : str
+            Directory libspotify caches streamed audio in, default its
+            own temporary location
+        audio_cache_size : int
+            Max audio cache size in MB, default 0 lets libspotify use up
+            to 10% of the free disk space
+        credentials : str
+            Path of a file the credentials blob is stored in, when it exists
+            the blob is used to login rather than the password
+        block : bool
+            Block until login is complete, default True, otherwise wait on
+            ``logged_in`` before playing
+        bitrate : int
+            The ``spotify.Bitrate`` to stream at, default 1 for 320k
+        volume_control : str
+            ``mixer`` to set volume and mute on the ALSA mixer, ``software``
+            to scale the audio in the sink
         """
 
         # Mixer
-        self.mixer = mixer
-
-        # Volume Levels
+        self.mixer = Mixer(mixer, card)
+
+        # Credentials, the blob libspotify hands back after a login is
+        # reused on the next start as it skips the password exchange
+        self.user = user
+        self.password = password
+        self.credentials = credentials
+        self.blob = None
+
+        # Set once login completes and whenever no track is playing
+        self.logged_in = threading.Event()
+        self.stopped = threading.Event()
+
+        # Next track resolved ahead of time, (uri, track) tuple
+        self.next = None
+
+        # Time the last track stopped and the measured gap in seconds
+        # between it stopping and the following track starting
+        self.stopped_at = None
+        self.gap = None
+
+        # Volume Levels, the last level set and the gain in dB of the track
+        # playing applied on top of it
+        self.volume_control = volume_control
         self.min_vol = min_vol
         self.max_vol = max_vol
+        self.volume = None
+        self.gain = 0.0
 
         # Session Configuration
         logger.debug('Configuring Spotify Session')
@@ -66,30 +220,60 @@ class Player(object):
         config.load_application_key_file(key)
         config.dont_save_metadata_for_playlists = True
         config.initially_unload_playlists = True
+        if audio_cache is not None:
+            config.cache_location = audio_cache
 
         # Create session
         logger.debug('Creating Session')
         self.session = spotify.Session(config)
         self.register_session_events()
-        self.session.preferred_bitrate(spotify.audio.Bitrate(1))
+        self.set_bitrate(bitrate)
+        self.session.set_cache_size(audio_cache_size)
+
+        # Resolved Track Cache
+        self.tracks = TrackCache(self.session, cache_size, cache_ttl)
+        for counter in ['hits', 'misses', 'evictions']:
+            metrics.REGISTRY.collect(
+                'fmplayer_track_cache_{0}_total'.format(counter),
+                'Track cache {0}'.format(counter),
+                lambda counter=counter: getattr(self.tracks, counter),
+                kind='counter')
+
+        # Time play was last called, cleared on the first audio frame
+        self.started_at = None
+
+        # Duration in ms of the track last played
+        self.duration = None
+
+        # Playback position, the offset in ms the track started or was last
+        # sought to plus the frames delivered since at the sample rate
+        self.offset = 0
+        self.delivered = 0
+        self.rate = 44100
+
+        # Set the Audio Sink for the Session, the sink only listens for
+        # music delivery so can be set before login
+        sinks = {
+            'alsa': AlsaSink,
+            'fake': FakeSink,
+            'ring': functools.partial(RingBufferSink, seconds=buffer_seconds),
+        }
+        logger.info('Setting Audio Sink to: {0}'.format(sink))
+        self.sink = sinks.get(sink, FakeSink)(self.session)
+        self.sink.observers.append(self.on_music_delivery)
+        if volume_control == 'software':
+            logger.info('Using software volume')
+            self.sink.volume = SoftwareVolume()
 
         # Set the session event loop going
         logger.debug('Starting Spotify Event Loop')
         loop = spotify.EventLoop(self.session)
         loop.start()
 
-        # Block until Login is complete
-        logger.debug('Waiting for Login to Complete...')
-        self.session.login(user, password, remember_me=True)
-        LOGGED_IN_EVENT.wait()
-
-        # Set the Audio Sink for the Session
-        sinks = {
-            'alsa': spotify.AlsaSink,
-            'fake': FakeSink
-        }
-        logger.info('Settingw Audio Sink to: {0}'.format(sink))
-        sinks.get(sink, FakeSink)(self.session)
+        self.login()
+        if block:
+            logger.debug('Waiting for Login to Complete...')
+            self.logged_in.wait()
 
     def register_session_events(self):
         """ Sets up session events to listen for and set an appropriate
@@ -108,14 +292,71 @@ class Player(object):
             spotify.SessionEvent.CONNECTION_ERROR,
             self.on_connection_error)
 
+        self.session.on(
+            spotify.SessionEvent.LOGGED_IN,
+            self.on_logged_in)
+
+        self.session.on(
+            spotify.SessionEvent.CREDENTIALS_BLOB_UPDATED,
+            self.on_credentials_blob_updated)
+
+    def login(self):
+        """ Starts logging in, with the stored credentials blob if there is
+        one, otherwise the password. Login completes in the background, see
+        ``logged_in``.
+        """
+
+        if self.credentials is not None:
+            try:
+                with open(self.credentials) as f:
+                    self.blob = f.read().strip() or None
+            except IOError:
+                self.blob = None
+
+        if self.blob is not None:
+            logger.debug('Logging in with stored credentials')
+            self.session.login(self.user, remember_me=True, blob=self.blob)
+        else:
+            logger.debug('Logging in with password')
+            self.session.login(self.user, self.password, remember_me=True)
+
+    def on_logged_in(self, session, error):
+        """ Fired when a login attempt completes, a stored blob which has
+        been revoked or expired falls back to the password.
+        """
+
+        if error == spotify.ErrorType.OK or self.blob is None:
+            return
+
+        logger.warning('Stored credentials rejected: {0}'.format(error))
+        self.blob = None
+        session.login(self.user, self.password, remember_me=True)
+
+    def on_credentials_blob_updated(self, session, blob):
+        """ Fired when libspotify has a new credentials blob, stored so the
+        next start can login without the password.
+        """
+
+        if self.credentials is None:
+            return
+
+        try:
+            fd = os.open(
+                self.credentials, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(blob)
+        except EnvironmentError as e:
+            logger.warning('Unable to store credentials: {0}'.format(e))
+
     def on_connection_error(self, session, error):
         """ Fired when a connection error occures.
         """
 
-        logger.error('Connection Error: {0}'.error)
+        logger.error('Connection Error: {0}'.format(error))
+        metrics.CONNECTION_ERRORS.inc()
 
         # Lets try and relogin
-        self.session.relogin()
+        self.relogin()
 
     def on_connection_state_updated(self, session):
         """ Fired when the connect to Spotify changes
@@ -123,7 +364,7 @@ class Player(object):
 
         if session.connection.state is spotify.ConnectionState.LOGGED_IN:
             logger.info('Login Complete')
-            LOGGED_IN_EVENT.set()  # Unblocks the player from starting
+            self.logged_in.set()  # Unblocks the player from starting
 
         # Force a re-login if the session is logged out, offline or disconnected
         if session.connection.state in [
@@ -134,7 +375,33 @@ class Player(object):
             logger.info('Connection State Change: {0}'.format(
                 session.connection.state))
 
-            self.session.relogin()
+            self.relogin()
+
+    def relogin(self):
+        """ Logs the session back in with the remembered credentials.
+        """
+
+        metrics.RELOGINS.inc()
+        self.session.relogin()
+
+    def on_music_delivery(self, audio_format, frames, num_frames):
+        """ Sink observer, counts delivered frames for the playback position
+        and records the time to the first audio frame after a track starts
+        playing, and after the process started.
+        """
+
+        self.delivered += num_frames
+        self.rate = audio_format.sample_rate
+
+        if not metrics.FIRST_NOTE.value and num_frames > 0:
+            metrics.FIRST_NOTE.set(time.time() - metrics.STARTED)
+            logger.info('First note after {0:.3f}s'.format(
+                metrics.FIRST_NOTE.value))
+
+        started_at = self.started_at
+        if started_at is not None and num_frames > 0:
+            self.started_at = None
+            metrics.FIRST_FRAME.time(started_at)
 
     def on_track_end(self, session):
         """ Called when the track finishes playing.
@@ -143,47 +410,149 @@ class Player(object):
         logger.debug('Track Finished Playing')
         self.stop()
 
-    def play(self, uri):
-        """ Plays a given Spotify URI. Ensures the ``STOP_EVENT`` event is set
+    @property
+    def position(self):
+        """ Returns the playback position of the current track in ms, audio
+        delivered but still buffered by the sink is not counted.
+        """
+
+        frames = max(0, self.delivered - self.sink.buffered)
+        return self.offset + frames * 1000 // self.rate
+
+    def play(self, uri, position=0):
+        """ Plays a given Spotify URI. Ensures the ``stopped`` event is set
         back to ``False``, loads and then plays the track.
 
         Arguments
         ---------
         uri : str
             The Spotify URI - e.g: ``spotify:track:3Esqxo3D31RCjmdgwBPbOO``
+        position : int
+            Offset in ms to start playing from, default 0
+
+        Returns
+        -------
+        bool
+            ``True`` if the track is playing, ``False`` if it could not be
+            loaded, the player is then stopped
         """
 
         if not self.session.connection.state == spotify.ConnectionState.LOGGED_IN:
             logger.info('Not logged in, logging in')
-            self.session.relogin()
+            self.relogin()
 
         try:
-            logger.info('Loading Track: {0}'.format(uri))
-            track = self.session.get_track(uri)
-            track.load()
+            if self.next is not None and self.next[0] == uri:
+                logger.info('Using Prefetched Track: {0}'.format(uri))
+                track = self.next[1]
+            else:
+                logger.info('Loading Track: {0}'.format(uri))
+                start = time.time()
+                track = self.tracks.get(uri)
+                metrics.TRACK_LOAD.time(start)
+            logger.info('Loading Track Into Player: {0}'.format(uri))
+            self.session.player.load(track)
         except (ValueError, spotify.Error):
             logger.exception('Unable to play {0} - forcing stop'.format(uri))
+            metrics.TRACKS_FAILED.inc()
             self.stop()
-
-        logger.info('Loading Track Into Player: {0}'.format(uri))
-        self.session.player.load(track)
+            return False
+        finally:
+            self.next = None
+
+        self.duration = track.duration
+        self.offset = 0
+        self.delivered = 0
+        if position:
+            self.seek(position)
         logger.info('Playing Track: {0}'.format(uri))
+        self.started_at = time.time()
         self.session.player.play()
 
-        logger.debug('Block Watcher - STOP_EVENT cleared')
-        STOP_EVENT.clear()  # Reset STOP_EVENT flag to False
+        if self.stopped_at is not None:
+            self.gap = self.started_at - self.stopped_at
+            self.stopped_at = None
+            metrics.TRACK_GAP.observe(self.gap)
+            logger.info('Inter-track gap: {0:.3f}s'.format(self.gap))
+
+        logger.debug('Block Watcher - stopped cleared')
+        self.stopped.clear()  # Reset stopped flag to False
+        return True
 
-    def stop(self):
+    def stop(self, flush=False):
         """ Fired when a playing track finishes, ensures the tack is unloaded
-        and the ``STOP_EVENT`` is set to ``True``.
+        and the ``stopped`` event is set to ``True``.
+
+        Arguments
+        ---------
+        flush : bool
+            Drop audio buffered by the sink, used when skipping a track so
+            it does not keep playing out, default ``False``
         """
 
         logger.info('Stop Track')
         self.session.player.play(False)
         self.session.player.unload()
+        if flush:
+            self.sink.flush()
+
+        self.stopped_at = time.time()
 
-        logger.debug('Unblock Watcher: STOP_EVENT set')
-        STOP_EVENT.set()
+        logger.debug('Unblock Watcher: stopped set')
+        self.stopped.set()
+
+    def seek(self, position):
+        """ Seeks the loaded track, buffered audio is dropped.
+
+        Arguments
+        ---------
+        position : int
+            Offset in ms to seek to
+        """
+
+        logger.info('Seeking to {0}ms'.format(position))
+        self.session.player.seek(position)
+        self.sink.flush()
+        self.offset = position
+        self.delivered = 0
+
+    def prefetch(self, uri):
+        """ Resolves and loads the track which will be played next, and asks
+        libspotify to start buffering it, so ``play`` does not have to wait
+        for metadata and stream setup between tracks.
+
+        Arguments
+        ---------
+        uri : str
+            The Spotify URI - e.g: ``spotify:track:3Esqxo3D31RCjmdgwBPbOO``
+        """
+
+        if self.next is not None and self.next[0] == uri:
+            return
+
+        try:
+            logger.debug('Prefetching Track: {0}'.format(uri))
+            track = self.tracks.get(uri)
+            self.session.player.prefetch(track)
+        except (ValueError, spotify.Error):
+            logger.warning('Unable to prefetch {0}'.format(uri))
+            return
+
+        self.next = (uri, track)
+
+    def set_bitrate(self, bitrate):
+        """ Sets the preferred streaming bitrate, used from the next track
+        loaded.
+
+        Arguments
+        ---------
+        bitrate : int
+            The ``spotify.Bitrate`` value, 0 for 160k, 1 for 320k and 2 for
+            96k
+        """
+
+        self.bitrate = bitrate
+        self.session.preferred_bitrate(spotify.audio.Bitrate(bitrate))
 
     def pause(self):
         """ Pauses the current playback if the track is in a playing state.
@@ -206,9 +575,8 @@ class Player(object):
             logger.debug('Cannot Resume - Not in paused state')
 
     def get_mixer(self):
-        """ Returns the mixer object. The mixer must be recreated every time
-        it is used to be able to  observe volume/mute changes done by other
-        applications.
+        """ Returns the long lived mixer object, changes done by other
+        applications are picked up by ``Mixer.watch``.
 
         Returns
         -------
@@ -216,7 +584,7 @@ class Player(object):
             The mixer instance
         """
 
-        return alsaaudio.Mixer(control=self.mixer, cardindex=0)
+        return self.mixer.get()
 
     def set_volume(self, v):
         """ Set the player audio volume between 0 and 100.
@@ -229,25 +597,68 @@ class Player(object):
             based on the min and max volume levels.
         """
 
+        if not v >= 0 and not v <= 100:
+            logger.error('{0} is not a valid volume level'.format(v))
+            return None
+
+        self.volume = v
+
+        # The mixer is never opened with software volume
+        if self.volume_control == 'software':
+            level = self.min_vol + v * (self.max_vol - self.min_vol) / 100.0
+            self.sink.volume.set(
+                volume_gain(level) * 10 ** (self.gain / 20.0))
+            return int(round(level))
+
         try:
             mixer = self.get_mixer()
         except alsaaudio.ALSAAudioError:
             return None
 
-        if not v >= 0 and not v <= 100:
-            logger.error('{0} is not a valid volume level'.format(v))
-            return None
-
         # Convert the raw volume percentage into a percentage within the
         # min and max volume ranges
         volume = v * int(round(((self.max_vol - self.min_vol) / 100) + self.min_vol))
 
         # Set the level
         logger.debug('Set volume level to {0}'.format(volume))
-        mixer.setvolume(volume)
+        try:
+            self.mixer.changed()
+            mixer.setvolume(volume)
+        except alsaaudio.ALSAAudioError as e:
+            logger.error('Setting volume failed: {0}'.format(e))
+            self.mixer.reset()
+            return None
 
         return volume
 
+    def set_gain(self, gain):
+        """ Sets the gain of the track playing. With software volume it is
+        applied on top of the last volume level set, with the mixer the audio
+        is scaled in the sink and the mixer level is left alone.
+
+        Arguments
+        ---------
+        gain : float
+            Gain in dB, 0 for none
+        """
+
+        if gain == self.gain:
+            return
+
+        self.gain = gain
+        if self.volume_control == 'software':
+            if self.volume is not None:
+                self.set_volume(self.volume)
+            return
+
+        if self.sink.volume is None:
+            try:
+                self.sink.volume = SoftwareVolume()
+            except RuntimeError as e:
+                logger.warning('Not applying track gain: {0}'.format(e))
+                return
+        self.sink.volume.set(10 ** (gain / 20.0))
+
     def get_mute(self):
         """ Returns the current mute state of the player. Amended from:
         https://github.com/mopidy/mopidy-alsamixer
@@ -258,15 +669,19 @@ class Player(object):
             Mute state of the player
         """
 
+        if self.volume_control == 'software':
+            return self.sink.volume.mute
+
         try:
             mixer = self.get_mixer()
-        except alsaaudio.ALSAAudioError as e:
+        except alsaaudio.ALSAAudioError:
             return False
 
         try:
             channels_muted = mixer.getmute()
         except alsaaudio.ALSAAudioError as e:
             logger.debug('Getting mute state failed: {0}'.format(e))
+            self.mixer.reset()
             return None
         if all(channels_muted):
             return True
@@ -284,12 +699,18 @@ class Player(object):
             ``True`` to set mute, ``False`` to remove mute.
         """
 
+        if self.volume_control == 'software':
+            self.sink.volume.mute = bool(mute)
+            return None
+
         try:
             mixer = self.get_mixer()
-        except alsaaudio.ALSAAudioError as e:
+        except alsaaudio.ALSAAudioError:
             return None
 
         try:
+            self.mixer.changed()
             mixer.setmute(int(mute))
         except Exception as e:
             logging.exception(e)
+            self.mixer.reset()
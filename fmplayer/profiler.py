@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fmplayer.profiler
+=================
+
+Low overhead sampling profiler and gevent hub blocking detector which can be
+started and stopped at runtime through admin events on the channel.
+"""
+
+# Standard Libs
+import collections
+import logging
+import os
+import sys
+import time
+import traceback
+
+# Third Party Libs
+import gevent
+from gevent.monkey import get_original
+
+# First Party Libs
+from fmplayer import metrics
+
+
+logger = logging.getLogger('fmplayer')
+
+# Samplers must run in real threads so they see the hub whilst it is busy
+try:
+    start_new_thread = get_original('thread', 'start_new_thread')
+    get_ident = get_original('thread', 'get_ident')
+except ImportError:
+    start_new_thread = get_original('_thread', 'start_new_thread')
+    get_ident = get_original('_thread', 'get_ident')
+sleep = get_original('time', 'sleep')
+
+# Ident of the thread running the gevent hub and every greenlet
+MAIN_THREAD = get_ident()
+
+
+def collapse(frame):
+    """ Returns a frame's stack in the collapsed format, outermost first and
+    separated by semicolons, as read by flamegraph tools.
+    """
+
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{0}:{1}:{2}'.format(
+            os.path.basename(code.co_filename),
+            code.co_name,
+            frame.f_lineno))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class Profiler(object):
+    """ Samples the stacks of every thread from a separate thread. The main
+    thread's stack is whichever greenlet is running, other threads include
+    the libspotify callback thread whilst it is running Python callbacks.
+    """
+
+    def __init__(self, directory, interval=0.005):
+        """ Initialises the profiler, sampling does not start until
+        ``start`` is called.
+
+        Arguments
+        ---------
+        directory : str
+            Directory collapsed stack files are written to
+        interval : float
+            Seconds between samples, default 0.005
+        """
+
+        self.directory = directory
+        self.interval = interval
+        self.running = False
+        self.samples = collections.Counter()
+        self.started = None
+
+    def start(self, interval=None):
+        """ Starts sampling in a new thread, does nothing if already running.
+
+        Arguments
+        ---------
+        interval : float
+            Seconds between samples, default the interval given at creation
+        """
+
+        if self.running:
+            return
+        if interval is not None:
+            self.interval = interval
+        logger.info('Starting Profiler every {0}s'.format(self.interval))
+        self.samples = collections.Counter()
+        self.started = time.time()
+        self.running = True
+        start_new_thread(self.sample, ())
+
+    def sample(self):
+        """ Samples thread stacks until stopped, runs in its own thread.
+        """
+
+        own = get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                thread = 'main' if ident == MAIN_THREAD else 'thread-{0}'.format(ident)
+                self.samples['{0};{1}'.format(thread, collapse(frame))] += 1
+            sleep(self.interval)
+
+    def stop(self):
+        """ Stops sampling and writes the collapsed stacks to a new file in
+        the directory.
+
+        Returns
+        -------
+        str
+            Path of the file written, ``None`` if the profiler was not running
+        """
+
+        if not self.running:
+            return None
+        self.running = False
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(
+            self.directory,
+            'fmplayer-{0}.folded'.format(time.strftime('%Y%m%d-%H%M%S')))
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write('{0} {1}\n'.format(stack, count))
+
+        logger.info('Profiled {0:.1f}s, {1} samples written to {2}'.format(
+            time.time() - self.started,
+            sum(self.samples.values()),
+            path))
+        return path
+
+
+class BlockingDetector(object):
+    """ Reports any greenlet holding the gevent hub for longer than a
+    threshold. A greenlet ticks a heartbeat, a separate thread logs the main
+    thread's stack whenever the heartbeat is late.
+    """
+
+    def __init__(self, threshold=0.1):
+        """ Initialises the detector, it does not run until ``start`` is
+        called.
+
+        Arguments
+        ---------
+        threshold : float
+            Seconds the hub may be held before it is reported, default 0.1
+        """
+
+        self.threshold = threshold
+        self.running = False
+        self.tick = None
+        self.greenlet = None
+        self.blocked = metrics.REGISTRY.counter(
+            'fmplayer_hub_blocked_total',
+            'Times a greenlet held the gevent hub past the threshold')
+
+    def start(self):
+        """ Starts the heartbeat greenlet and monitor thread.
+        """
+
+        if self.running:
+            return
+        logger.info('Starting Blocking Detector at {0}s'.format(self.threshold))
+        self.running = True
+        self.tick = time.time()
+        self.greenlet = gevent.spawn(self.heartbeat)
+        start_new_thread(self.monitor, ())
+
+    def stop(self):
+        self.running = False
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def heartbeat(self):
+        while self.running:
+            self.tick = time.time()
+            gevent.sleep(self.threshold / 2)
+
+    def monitor(self):
+        """ Checks the heartbeat until stopped, runs in its own thread. Each
+        blocking period is reported once.
+        """
+
+        reported = None
+        while self.running:
+            sleep(self.threshold / 2)
+            tick = self.tick
+            late = time.time() - tick
+            if late > self.threshold and reported != tick:
+                reported = tick
+                self.blocked.inc()
+                frame = sys._current_frames().get(MAIN_THREAD)
+                logger.warning('Hub blocked for {0:.3f}s in:\n{1}'.format(
+                    late,
+                    ''.join(traceback.format_stack(frame)) if frame else ''))
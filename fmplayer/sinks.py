@@ -8,22 +8,430 @@ fmplayer.sinks
 Custom Audio Sinks
 """
 
+# Standard Libs
 import logging
+
+# Third Party Libs
+import alsaaudio
 import spotify
+from gevent.monkey import get_original
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# First Party Libs
+from fmplayer import metrics
 
 
 logger = logging.getLogger('fmplayer')
 
+# The ring buffer writer must run in a real thread, not a greenlet, so it
+# keeps feeding the device whilst the gevent hub is busy
+try:
+    start_new_thread = get_original('thread', 'start_new_thread')
+except ImportError:
+    start_new_thread = get_original('_thread', 'start_new_thread')
+sleep = get_original('time', 'sleep')
 
-class FakeSink(spotify.sink.Sink):
-    """ A fake audio sink, doesen't pass the audio to a device, this is for
-    development purposes only.
+# Seconds the writer waits before carrying on after an unexpected error
+WRITER_RETRY = 0.1
+
+# libspotify always delivers 16 bit native endian samples
+BYTES_PER_SAMPLE = 2
+
+# Seconds a software gain change takes to ramp from silence to full scale
+RAMP_SECONDS = 0.05
+
+# Range in dB the software volume levels from 1 to 100 span
+VOLUME_RANGE = 60.0
+
+
+def chunk(data, start, length):
+    """ Returns part of a bytearray to write to the PCM device. pyalsaaudio
+    only accepts strings and buffers on Python 2 so a zero copy ``buffer`` is
+    returned, bytes on Python 3.
+    """
+
+    try:
+        return buffer(data, start, length)
+    except NameError:
+        return bytes(data[start:start + length])
+
+
+def volume_gain(percent):
+    """ Returns the linear gain of a volume level, levels are spaced evenly
+    in dB so each step sounds alike.
+
+    Arguments
+    ---------
+    percent : float
+        Volume level from 0 to 100
+
+    Returns
+    -------
+    float
+        The gain, 0 for silence and 1 for full scale
+    """
+
+    if percent <= 0:
+        return 0.0
+    return 10 ** ((min(percent, 100) / 100.0 - 1) * VOLUME_RANGE / 20)
+
+
+class SoftwareVolume(object):
+    """ Applies gain and mute to 16 bit samples in place. Gain changes are
+    ramped a frame at a time, at most a full scale change per
+    ``RAMP_SECONDS``, so they do not click. Audio at unity gain is left
+    untouched.
     """
 
+    def __init__(self, rate=44100):
+        if numpy is None:
+            raise RuntimeError('numpy is not installed')
+
+        self.gain = 1.0
+        self.target = 1.0
+        self.mute = False
+        self.slope = 1.0 / (RAMP_SECONDS * rate)
+
+    def set(self, gain):
+        """ Sets the gain to ramp to.
+        """
+
+        self.target = gain
+
+    def apply(self, samples, channels):
+        """ Scales interleaved samples in place.
+
+        Arguments
+        ---------
+        samples : numpy.ndarray
+            Writable 16 bit samples
+        channels : int
+            Number of interleaved channels
+        """
+
+        frames = samples.reshape(-1, channels)
+        target = 0.0 if self.mute else self.target
+        current = self.gain
+        if current == target:
+            if target == 1.0:
+                return
+            if target == 0.0:
+                frames.fill(0)
+                return
+            gains = target
+        else:
+            steps = numpy.arange(1, len(frames) + 1) * self.slope
+            if target > current:
+                gains = numpy.minimum(current + steps, target)
+            else:
+                gains = numpy.maximum(current - steps, target)
+            self.gain = float(gains[-1])
+            gains = gains[:, None]
+
+        scaled = frames * numpy.asarray(gains, dtype=numpy.float32)
+        numpy.clip(scaled, -32768, 32767, out=scaled)
+        numpy.copyto(frames, scaled, casting='unsafe')
+
+
+class Sink(spotify.sink.Sink):
+    """ Base audio sink, after each music delivery the registered observers
+    are called with the audio format, frames and number of frames consumed.
+    Observers are called from the libspotify thread so must be quick.
+    """
+
+    # Times the sink ran out of audio whilst playing
+    underruns = 0
+
+    # Software volume stage, None leaves volume to the mixer
+    volume = None
+
     def __init__(self, session):
-        logger.info('Running Fake Audio Sink - There will be no audio output')
         self._session = session
+        self.observers = []
         self.on()
 
     def _on_music_delivery(self, session, audio_format, frames, num_frames):
+        output = frames
+        if self.volume is not None and self.scales_delivery and num_frames:
+            samples = numpy.frombuffer(
+                frames,
+                dtype=numpy.int16,
+                count=num_frames * audio_format.channels).copy()
+            self.volume.apply(samples, audio_format.channels)
+            output = samples.tobytes()
+
+        consumed = self.deliver(session, audio_format, output, num_frames)
+        for observer in self.observers:
+            observer(audio_format, frames, consumed)
+        return consumed
+
+    # Whether the software volume is applied to a copy of delivered frames,
+    # buffering sinks apply it as they play instead
+    scales_delivery = True
+
+    def deliver(self, session, audio_format, frames, num_frames):
+        """ Passes frames to the output, returns the number of frames
+        consumed.
+        """
+
+        raise NotImplementedError
+
+    def flush(self):
+        """ Drops any audio delivered but not yet played, called when a track
+        is skipped.
+        """
+
+        pass
+
+    @property
+    def buffered(self):
+        """ Returns the number of frames delivered but not yet played.
+        """
+
+        return 0
+
+    @property
+    def fill(self):
+        """ Returns the fraction of the buffer holding audio, None for sinks
+        without a buffer.
+        """
+
+        return None
+
+
+class FakeSink(Sink):
+    """ A fake audio sink, doesen't pass the audio to a device, this is for
+    development purposes only.
+    """
+
+    def __init__(self, session):
+        logger.info('Running Fake Audio Sink - There will be no audio output')
+        super(FakeSink, self).__init__(session)
+
+    def deliver(self, session, audio_format, frames, num_frames):
         return num_frames
+
+
+class AlsaSink(Sink, spotify.AlsaSink):
+    """ The pyspotify ALSA sink with delivery observers.
+    """
+
+    def __init__(self, session, card='default'):
+        self.observers = []
+        spotify.AlsaSink.__init__(self, session, card)
+
+    def deliver(self, session, audio_format, frames, num_frames):
+        return spotify.AlsaSink._on_music_delivery(
+            self, session, audio_format, frames, num_frames)
+
+
+class RingBufferSink(Sink):
+    """ Copies delivered frames into a preallocated ring buffer which a
+    dedicated writer thread drains to the ALSA PCM device, so stalls in the
+    libspotify callback or the gevent process do not cause underruns. When
+    the buffer is full fewer frames are consumed and libspotify delivers
+    them again later.
+
+    The software volume is applied in place on the ring buffer by the writer
+    just before audio is written, so volume changes are not held back by
+    the buffered audio.
+    """
+
+    scales_delivery = False
+
+    def __init__(self, session, device='default', seconds=2.0, rate=44100,
+                 channels=2, period=1024):
+        """ Initialises the sink and starts the writer thread, the device
+        is opened on the first delivery.
+
+        Arguments
+        ---------
+        session : spotify.Session
+            The Spotify session
+        device : str
+            ALSA PCM device name, default ``default``
+        seconds : float
+            Seconds of audio the buffer holds, default 2.0
+        rate : int
+            Sample rate the buffer is sized for, default 44100
+        channels : int
+            Channels the buffer is sized for, default 2
+        period : int
+            Frames written to the device at a time, default 1024
+        """
+
+        logger.info('Running Ring Buffer Audio Sink - {0}s buffer'.format(seconds))
+
+        self.device = device
+        self.period = period
+        self.pcm = None
+        self.frame_size = BYTES_PER_SAMPLE * channels
+
+        self.size = int(seconds * rate) * self.frame_size
+        self.buffer = bytearray(self.size)
+        self.view = memoryview(self.buffer)
+
+        # Total bytes written into and read out of the buffer, only the
+        # callback moves head and only the writer moves tail. Bytes up to
+        # scaled have had the software volume applied
+        self.head = 0
+        self.tail = 0
+        self.scaled = 0
+        self.samples = (
+            numpy.frombuffer(self.buffer, dtype=numpy.int16)
+            if numpy is not None else None)
+        self.flushing = False
+        self.starved = False
+
+        # Counters
+        self.underruns = 0
+        self.overruns = 0
+
+        metrics.REGISTRY.collect(
+            'fmplayer_sink_buffer_fill',
+            'Fraction of the sink ring buffer holding audio',
+            lambda: self.fill)
+        metrics.REGISTRY.collect(
+            'fmplayer_sink_underruns_total',
+            'Times the sink ran out of audio whilst playing',
+            lambda: self.underruns,
+            kind='counter')
+        metrics.REGISTRY.collect(
+            'fmplayer_sink_overruns_total',
+            'Deliveries which did not fit in the sink buffer',
+            lambda: self.overruns,
+            kind='counter')
+
+        super(RingBufferSink, self).__init__(session)
+        start_new_thread(self.writer, ())
+
+    def flush(self):
+        self.flushing = True
+
+    @property
+    def buffered(self):
+        return (self.head - self.tail) // self.frame_size
+
+    @property
+    def fill(self):
+        """ Returns the fraction of the buffer holding audio.
+        """
+
+        return float(self.head - self.tail) / self.size
+
+    def open(self, audio_format):
+        """ Opens the PCM device for the delivered audio format.
+        """
+
+        logger.debug('Opening PCM: {0}'.format(self.device))
+        pcm = alsaaudio.PCM(
+            type=alsaaudio.PCM_PLAYBACK,
+            mode=alsaaudio.PCM_NORMAL,
+            card=self.device)
+        pcm.setchannels(audio_format.channels)
+        pcm.setrate(audio_format.sample_rate)
+        pcm.setformat(alsaaudio.PCM_FORMAT_S16_LE)
+        pcm.setperiodsize(self.period)
+        self.frame_size = audio_format.frame_size()
+        self.pcm = pcm
+
+    def deliver(self, session, audio_format, frames, num_frames):
+        # libspotify delivers no frames to drop buffered audio, e.g. on seek
+        if num_frames == 0:
+            self.flush()
+            return 0
+
+        if self.pcm is None:
+            self.open(audio_format)
+
+        free = self.size - (self.head - self.tail)
+        consumed = min(num_frames, free // self.frame_size)
+        if consumed < num_frames:
+            self.overruns += 1
+        if consumed == 0:
+            return 0
+
+        length = consumed * self.frame_size
+        start = self.head % self.size
+        first = min(length, self.size - start)
+        source = memoryview(frames)
+        self.view[start:start + first] = source[:first]
+        if first < length:
+            self.view[:length - first] = source[first:length]
+        self.head += length
+
+        return consumed
+
+    def writer(self):
+        """ Drains the buffer to the device forever, runs in its own thread.
+        Errors are logged so the thread never stops.
+        """
+
+        while True:
+            try:
+                self.drain()
+            except Exception:
+                logger.exception('Ring buffer writer failed')
+                sleep(WRITER_RETRY)
+
+    def drain(self):
+        """ Writes the next chunk of buffered audio to the device, or waits a
+        moment if there is nothing to write.
+        """
+
+        if self.flushing:
+            self.flushing = False
+            self.tail = self.head
+
+        # Hold buffered audio whilst paused, it is still played out after a
+        # track ends or is unloaded
+        state = self._session.player.state
+        if state == spotify.PlayerState.PAUSED:
+            sleep(0.005)
+            return
+
+        available = self.head - self.tail
+        if available == 0 or self.pcm is None:
+            if not self.starved and state == spotify.PlayerState.PLAYING:
+                self.starved = True
+                self.underruns += 1
+            sleep(0.005)
+            return
+
+        self.starved = False
+        start = self.tail % self.size
+        length = min(
+            available,
+            self.size - start,
+            self.period * self.frame_size)
+        length -= length % self.frame_size
+        if self.volume is not None:
+            self.scale(start, length)
+        try:
+            written = self.pcm.write(chunk(self.buffer, start, length))
+        except alsaaudio.ALSAAudioError as e:
+            logger.error('PCM write failed: {0}'.format(e))
+            self.pcm = None
+            return
+        self.tail += written * self.frame_size
+
+    def scale(self, start, length):
+        """ Applies the software volume to the part of a chunk about to be
+        written which has not been scaled yet, a chunk is only partly
+        written if the device is busy.
+        """
+
+        self.scaled = max(self.scaled, self.tail)
+        done = self.scaled - self.tail
+        if done >= length:
+            return
+
+        channels = self.frame_size // BYTES_PER_SAMPLE
+        first = (start + done) // BYTES_PER_SAMPLE
+        last = (start + length) // BYTES_PER_SAMPLE
+        self.volume.apply(self.samples[first:last], channels)
+        self.scaled = self.tail + length
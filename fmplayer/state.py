@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fmplayer.state
+==============
+
+Player state storage. State is either kept in the legacy individual keys,
+in a single versioned hash or both whilst consumers are migrated.
+"""
+
+import json
+import time
+
+
+STATE_KEY = 'fm:player:state'
+
+# Legacy keys, one per state field
+LEGACY_KEYS = {
+    'current': 'fm:player:current',
+    'paused': 'fm:player:paused',
+    'volume': 'fm:player:volume',
+    'mute': 'fm:player:mute',
+    'position': 'fm:player:position',
+}
+
+MODES = ['legacy', 'hash', 'both']
+
+
+class State(object):
+    """ Writes player state changes onto a Redis pipeline so they are applied
+    in the same round trip as the event which caused them.
+    """
+
+    def __init__(self, mode='legacy', key=STATE_KEY):
+        """ Initialises the state writer.
+
+        Arguments
+        ---------
+        mode : str
+            ``legacy`` writes the individual keys, ``hash`` writes the
+            versioned hash, ``both`` writes both, default ``legacy``
+        key : str
+            The state hash key, default ``fm:player:state``
+        """
+
+        if mode not in MODES:
+            raise ValueError('{0} is not a valid state mode'.format(mode))
+
+        self.key = key
+        self.legacy = mode in ('legacy', 'both')
+        self.hash = mode in ('hash', 'both')
+
+    def write(self, pipe, **fields):
+        """ Queues the state changes on the pipeline. A field set to ``None``
+        is removed. Every write to the hash bumps its ``version`` and sets
+        ``updated`` to the current unix time.
+
+        Arguments
+        ---------
+        pipe : redis.client.BasePipeline
+            The pipeline to queue the commands on
+        **fields
+            State fields to set - ``current``, ``paused``, ``volume``,
+            ``mute`` or ``position``
+        """
+
+        values = {}
+        removed = []
+        for field, value in fields.items():
+            if value is None:
+                removed.append(field)
+            elif field == 'current':
+                values[field] = json.dumps(value)
+            else:
+                values[field] = int(value)
+
+        if self.legacy:
+            for field, value in values.items():
+                pipe.set(LEGACY_KEYS[field], value)
+            for field in removed:
+                pipe.delete(LEGACY_KEYS[field])
+
+        if self.hash:
+            values['updated'] = time.time()
+            pipe.hmset(self.key, values)
+            if removed:
+                pipe.hdel(self.key, *removed)
+            pipe.hincrby(self.key, 'version', 1)
+
+    def read(self, redis):
+        """ Reads the stored state, from the hash if it is written otherwise
+        from the legacy keys.
+
+        Arguments
+        ---------
+        redis : obj
+            Redis connection instance
+
+        Returns
+        -------
+        dict
+            The player state, see ``snapshot``
+        """
+
+        if self.hash:
+            return snapshot(redis, self.key)
+
+        current, paused, volume, mute, position = redis.mget(
+            LEGACY_KEYS['current'],
+            LEGACY_KEYS['paused'],
+            LEGACY_KEYS['volume'],
+            LEGACY_KEYS['mute'],
+            LEGACY_KEYS['position'])
+
+        return {
+            'current': json.loads(current) if current is not None else None,
+            'paused': bool(int(paused or 0)),
+            'volume': int(volume) if volume is not None else None,
+            'mute': bool(int(mute or 0)),
+            'position': int(position) if position is not None else None,
+        }
+
+
+def snapshot(redis, key=STATE_KEY):
+    """ Returns an atomic snapshot of the player state hash in a single
+    ``HGETALL``.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    key : str
+        The state hash key, default ``fm:player:state``
+
+    Returns
+    -------
+    dict
+        The player state::
+
+            {
+                'version': 12,
+                'updated': 1428073485.5,
+                'current': {'uri': 'spotify:track:1234', 'user': '1'},
+                'paused': False,
+                'volume': 60,
+                'mute': False,
+                'position': 73500
+            }
+    """
+
+    data = redis.hgetall(key)
+    current = data.get('current')
+
+    return {
+        'version': int(data.get('version', 0)),
+        'updated': float(data['updated']) if 'updated' in data else None,
+        'current': json.loads(current) if current is not None else None,
+        'paused': bool(int(data.get('paused', 0))),
+        'volume': int(data['volume']) if 'volume' in data else None,
+        'mute': bool(int(data.get('mute', 0))),
+        'position': int(data['position']) if 'position' in data else None,
+    }
+
+
+def version(redis, key=STATE_KEY):
+    """ Returns the current state version so consumers can cheaply skip
+    fetching a state they have already seen.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    key : str
+        The state hash key, default ``fm:player:state``
+
+    Returns
+    -------
+    int
+        The state version, 0 if no state has been written
+    """
+
+    return int(redis.hget(key, 'version') or 0)
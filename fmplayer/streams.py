@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fmplayer.streams
+================
+
+Redis Streams event transport. Unlike pub/sub, events added to the stream
+whilst the player is restarting or reconnecting are kept, each player reads
+them through its consumer group and only acknowledges an event once it has
+been handled, anything left unacknowledged is replayed on the next start.
+Requires Redis 6.2 or later.
+"""
+
+# Standard Libs
+import logging
+import socket
+
+# Third Party Libs
+from redis.exceptions import ResponseError
+
+
+logger = logging.getLogger('fmplayer')
+
+
+EVENTS_STREAM = 'fm:player:events'
+PUBLISHED_STREAM = 'fm:player:published'
+STREAM_GROUP = 'fmplayer'
+
+# Approximate max number of entries kept in a stream the player appends to
+STREAM_LENGTH = 10000
+
+# Max number of entries read in one round trip
+READ_COUNT = 64
+
+# How long in ms a read waits on the server for new entries before looping
+READ_BLOCK = 5000
+
+
+def execute_blocking(redis, *args):
+    """ Runs a blocking command, e.g. ``BLMOVE`` or ``XREADGROUP BLOCK``, on
+    a connection of its own. If the command is interrupted, e.g. the greenlet
+    waiting on it is killed, the connection is disconnected rather than put
+    back in the pool with the command still blocked on the server, where it
+    could still move or read an entry and leave its reply to the next
+    command sent on the connection.
+
+    Arguments
+    ---------
+    redis : obj
+        Redis connection instance
+    *args
+        The command and its arguments
+
+    Returns
+    -------
+    obj
+        The command's reply
+    """
+
+    pool = redis.connection_pool
+    connection = pool.get_connection(args[0])
+    try:
+        connection.send_command(*args)
+        return redis.parse_response(connection, args[0])
+    except BaseException:
+        connection.disconnect()
+        raise
+    finally:
+        pool.release(connection)
+
+
+def append(pipe, key, payload, length=STREAM_LENGTH):
+    """ Appends an encoded event to a capped stream, trimming it to around
+    ``length`` entries.
+
+    Arguments
+    ---------
+    pipe : obj
+        Redis connection or pipeline instance
+    key : str
+        The stream key
+    payload : str
+        The encoded event
+    length : int
+        Approximate max number of entries kept, default 10000
+    """
+
+    pipe.execute_command(
+        'XADD', key, 'MAXLEN', '~', length, '*', 'data', payload)
+
+
+def entries(reply):
+    """ Flattens stream entries from an ``XREADGROUP`` or ``XAUTOCLAIM``
+    reply into ``(id, payload)`` tuples, the payload is ``None`` for
+    entries trimmed from the stream since they were read.
+    """
+
+    result = []
+    for id, fields in reply or []:
+        payload = None
+        if fields:
+            fields = dict(zip(fields[::2], fields[1::2]))
+            payload = fields.get(b'data', fields.get('data'))
+        result.append((id, payload))
+    return result
+
+
+class EventStream(object):
+    """ A stream of inbound events read through a consumer group. Players
+    running as an active and standby pair share the group, only the leader
+    reads so it takes over anything the previous leader left pending.
+    """
+
+    def __init__(self, redis, key=EVENTS_STREAM, group=STREAM_GROUP,
+                 consumer=None, count=READ_COUNT, block=READ_BLOCK):
+        """ Initialises the stream, nothing is read.
+
+        Arguments
+        ---------
+        redis : obj
+            Redis connection instance
+        key : str
+            The stream key, default ``fm:player:events``
+        group : str
+            The consumer group, default ``fmplayer``
+        consumer : str
+            This node's consumer name, default the host name
+        count : int
+            Max number of entries read in one round trip, default 64
+        block : int
+            Milliseconds a read waits for new entries, default 5000
+        """
+
+        self.redis = redis
+        self.key = key
+        self.group = group
+        self.consumer = consumer or socket.gethostname()
+        self.count = count
+        self.block = block
+
+    def create(self):
+        """ Creates the consumer group, and the stream if needed, starting
+        from new entries. An existing group is left as it is.
+        """
+
+        try:
+            self.redis.execute_command(
+                'XGROUP', 'CREATE', self.key, self.group, '$', 'MKSTREAM')
+            logger.info('Created consumer group {0} on {1}'.format(
+                self.group,
+                self.key))
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def claim(self):
+        """ Takes over entries left pending by other consumers in the group,
+        e.g. a previous leader or the same host under an old name.
+
+        Returns
+        -------
+        int
+            Number of entries claimed
+        """
+
+        claimed = 0
+        start = '0-0'
+        while True:
+            reply = self.redis.execute_command(
+                'XAUTOCLAIM', self.key, self.group, self.consumer, 0, start,
+                'COUNT', self.count, 'JUSTID')
+            start, ids = reply[0], reply[1]
+            claimed += len(ids)
+            if start in (b'0-0', '0-0'):
+                break
+
+        if claimed:
+            logger.info('Claimed {0} pending events'.format(claimed))
+        return claimed
+
+    def read(self, id='>'):
+        """ Reads a batch of entries, ``>`` reads new entries waiting up to
+        ``block`` ms for them, any other id reads this consumer's pending
+        entries after it.
+
+        Arguments
+        ---------
+        id : str
+            Id to read after, default ``>``
+
+        Returns
+        -------
+        list
+            ``(id, payload)`` tuples
+        """
+
+        args = ['XREADGROUP', 'GROUP', self.group, self.consumer,
+                'COUNT', self.count]
+        if id == '>':
+            args.extend(['BLOCK', self.block])
+        args.extend(['STREAMS', self.key, id])
+
+        if id == '>':
+            reply = execute_blocking(self.redis, *args)
+        else:
+            reply = self.redis.execute_command(*args)
+        if not reply:
+            return []
+        return entries(reply[0][1])
+
+    def ack(self, ids):
+        """ Acknowledges handled entries so they are not replayed.
+
+        Arguments
+        ---------
+        ids : list
+            The entry ids
+        """
+
+        if ids:
+            self.redis.execute_command('XACK', self.key, self.group, *ids)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+fmplayer.watchdog
+=================
+
+Playback watchdog. Whilst a track plays the watchdog checks audio frames
+keep being delivered and the track does not play on past its duration, so a
+stalled stream or a missing ``END_OF_TRACK`` can not silence the player. A
+stalled track is played again from where it stalled, if it stalls again it
+is skipped.
+"""
+
+# Standard Libs
+import logging
+import time
+
+# Third Party Libs
+import spotify
+
+# First Party Libs
+from fmplayer import metrics
+
+
+logger = logging.getLogger('fmplayer')
+
+
+# Seconds without audio before a track is considered stalled
+STALL_WINDOW = 10
+
+# How often in seconds delivery is checked
+CHECK_INTERVAL = 1
+
+
+class Watchdog(object):
+    """ Watches the track playing until it stops, recovering it if audio
+    stops being delivered for ``window`` seconds or it plays ``window``
+    seconds past its duration.
+    """
+
+    def __init__(self, player, window=STALL_WINDOW, retries=1,
+                 interval=CHECK_INTERVAL):
+        """ Initialises the watchdog.
+
+        Arguments
+        ---------
+        player : fmplayer.player.Player
+            The player to watch
+        window : float
+            Seconds without audio before a track is stalled, and past its
+            duration before it is stopped, default 10
+        retries : int
+            Times a stalled track is played again before it is skipped,
+            default 1
+        interval : float
+            Seconds between checks, default 1
+        """
+
+        self.player = player
+        self.window = window
+        self.retries = retries
+        self.interval = interval
+
+    def wait(self, handler, uri, user):
+        """ Blocks until the track playing stops, recovering it if it stalls
+        or overruns.
+
+        Arguments
+        ---------
+        handler : EventHandler, obj
+            Event handler, publishes the error if the track is skipped
+        uri : str
+            The Spotify URI playing
+        user : str
+            The User Primary Key who queued it
+        """
+
+        player = self.player
+        retries = 0
+        stalled_at = None
+        frames = player.delivered
+        progressed = time.time()
+
+        while True:
+            player.stopped.wait(self.interval)
+            if player.stopped.is_set():
+                return
+
+            now = time.time()
+            paused = player.session.player.state == spotify.PlayerState.PAUSED
+            if paused or player.delivered != frames:
+                frames = player.delivered
+                progressed = now
+                if stalled_at is not None:
+                    metrics.STALL_RECOVERY.time(stalled_at)
+                    logger.info('Recovered {0} after {1:.3f}s'.format(
+                        uri,
+                        now - stalled_at))
+                    stalled_at = None
+                if self.overrun():
+                    return self.stop('Played past its duration')
+                continue
+
+            if now - progressed < self.window:
+                continue
+
+            # The end of track was missed if the track stalled at its end
+            if self.overrun(-self.window):
+                return self.stop('Missed the end of track')
+
+            if stalled_at is None:
+                stalled_at = now
+                metrics.STALLS.inc()
+
+            position = player.position
+            if retries < self.retries:
+                retries += 1
+                logger.warning('{0} stalled at {1}ms, retrying'.format(
+                    uri,
+                    position))
+                if not player.play(uri, position):
+                    metrics.STALL_RECOVERY.time(stalled_at)
+                    handler.error(uri, user, 'failed')
+                    return
+                frames = player.delivered
+                progressed = time.time()
+                continue
+
+            logger.error('{0} stalled at {1}ms, skipping'.format(uri, position))
+            metrics.STALL_RECOVERY.time(stalled_at)
+            handler.error(uri, user, 'stalled')
+            player.stop(flush=True)
+            return
+
+    def overrun(self, margin=None):
+        """ Returns ``True`` if the track has played further than its
+        duration plus the margin in seconds, default the window.
+        """
+
+        if margin is None:
+            margin = self.window
+        duration = self.player.duration
+        return bool(duration) and (
+            self.player.position > duration + margin * 1000)
+
+    def stop(self, reason):
+        """ Stops a track which has overrun.
+        """
+
+        logger.warning('Stopping track: {0}'.format(reason))
+        metrics.TRACK_OVERRUNS.inc()
+        self.player.stop()
@@ -77,14 +77,19 @@ setup(
     long_description=open('README.rst').read(),
     packages=find_packages(
         exclude=[
-            'tests'
+            'tests',
+            'benchmarks',
+            'benchmarks.*'
         ]),
     include_package_data=True,
     zip_safe=False,
     # Dependencies
     install_requires=INSTALL_REQS,
     extras_require={
-        'develop': DEVELOP_REQS
+        'develop': DEVELOP_REQS,
+        'msgpack': ['msgpack>=0.5.2'],
+        'loudness': ['numpy>=1.9'],
+        'software-volume': ['numpy>=1.9'],
     },
     # Testing
     tests_require=TESTING_REQS,